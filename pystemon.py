@@ -15,44 +15,62 @@ To be implemented:
 '''
 
 try:
-    from queue import Queue
+    from queue import Queue, Empty, Full
 except ImportError:
-    from Queue import Queue
-from collections import deque
+    from Queue import Queue, Empty, Full
+from collections import OrderedDict, deque
 from datetime import datetime
 try:
     from email.mime.multipart import MIMEMultipart
 except ImportError:
     from email.MIMEMultipart import MIMEMultipart
 
+try:
+    from email.header import Header
+except ImportError:
+    from email.Header import Header
 try:
     from email.mime.text import MIMEText
 except ImportError:
     from email.MIMEText import MIMEText
+import base64
 import gzip
 import hashlib
+import json
+import heapq
 import logging.handlers
+import mailbox
+import mmap
+import multiprocessing
 import optparse
 import os
 import random
 import re
+import signal
 import smtplib
 import socket
 import sys
+import tempfile
 import traceback
 import threading
 import time
-import urllib
-import urllib2
-import httplib
-import ssl
+import zlib
 from io import open
 import requests
-
-# try:
-#     from urllib.error import HTTPError, URLError
-# except ImportError:
-#     from urllib2 import HTTPError, URLError
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 try:
     import redis
@@ -64,15 +82,46 @@ try:
 except ImportError:
     exit('ERROR: Cannot import the yaml Python library. Are you sure it is installed?')
 
+try:
+    import xxhash  # optional, faster content hash for the deduplication
+except ImportError:
+    xxhash = None
+
+try:
+    import zstandard  # optional, zstd compression of the archive segments
+except ImportError:
+    zstandard = None
+
+iter_entry_points = None
+try:
+    from importlib.metadata import entry_points  # finds the site adapters of other packages
+except ImportError:
+    entry_points = None
+    try:
+        from pkg_resources import iter_entry_points  # the same, before python 3.8
+    except ImportError:
+        pass
+
+try:
+    import ahocorasick  # optional, speeds up the literal prefilter of the search engine
+except ImportError:
+    ahocorasick = None
+
 try:
     if sys.version_info < (2, 7):
         exit('You need python version 2.7 or newer.')
 except Exception as exc:
     exit('You need python version 2.7 or newer.')
 
-retries_paste = 3
-retries_client = 5
-retries_server = 100
+retry_defaults = {
+    'delay': 10,      # seconds before the first retry, doubled for every next retry
+    'max-delay': 600,
+    'client': 5,      # maximum number of retries per kind of error, see RetryLater
+    'server': 100,
+    'slowdown': 100,
+    'network': 100,
+    'notready': 3,
+}
 
 socket.setdefaulttimeout(10)  # set a default timeout of 10 seconds to download the page (default = unlimited)
 true_socket = socket.socket
@@ -86,6 +135,385 @@ def make_bound_socket(source_ip):
     return bound_socket
 
 
+class SeenIndex(object):
+    '''
+    Set of recently seen keys, with an optional value per key.
+    Lookups are O(1), the oldest keys are evicted when the maximum size or
+    the time to live is reached. If a filename is given every new key is
+    appended to that log file, which is loaded again at startup so the
+    index survives restarts.
+    '''
+    def __init__(self, filename=None, max_size=100000, ttl=0):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (timestamp, value), oldest first
+        self.filename = filename
+        self.max_size = max_size
+        self.ttl = ttl
+        self.log = None
+        self.log_lines = 0
+        if self.filename:
+            self.load()
+            self.log = open(self.filename, 'ab')
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                self.log_lines += 1
+                try:
+                    timestamp, key, value = line.decode('utf8').rstrip('\n').split('\t', 2)
+                    timestamp = float(timestamp)
+                except ValueError:
+                    continue  # truncated line, for example after a crash
+                self.entries.pop(key, None)
+                self.entries[key] = (timestamp, value or None)
+        self.expire()
+        logger.debug('Loaded {count} seen entries from "{file}"'.format(count=len(self.entries), file=self.filename))
+        if self.log_lines > 2 * len(self.entries) + 1000:
+            self.compact()
+
+    def compact(self):
+        ''' Rewrite the log file with only the entries still in memory. '''
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            for key, (timestamp, value) in self.entries.items():
+                f.write(self.format_line(timestamp, key, value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+        self.log_lines = len(self.entries)
+        if self.log:
+            self.log.close()
+            self.log = open(self.filename, 'ab')
+
+    @staticmethod
+    def format_line(timestamp, key, value):
+        return u'{0:.0f}\t{1}\t{2}\n'.format(timestamp, key, value or u'').encode('utf8')
+
+    def expire(self):
+        ''' Evict the oldest entries. Must be called with the lock held. '''
+        deadline = time.time() - self.ttl if self.ttl else None
+        while self.entries:
+            key = next(iter(self.entries))
+            timestamp = self.entries[key][0]
+            if len(self.entries) <= self.max_size and (deadline is None or timestamp >= deadline):
+                break
+            del self.entries[key]
+
+    def __contains__(self, key):
+        return self.get(key, False) is not False
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or (self.ttl and entry[0] < time.time() - self.ttl):
+            return default
+        return entry[1]
+
+    def add(self, key, value=None):
+        '''
+        Remember the key. Returns False if the key was already known.
+        '''
+        with self.lock:
+            if key in self:
+                return False
+            timestamp = time.time()
+            self.entries.pop(key, None)
+            self.entries[key] = (timestamp, value)
+            self.expire()
+            if self.log:
+                self.log.write(self.format_line(timestamp, key, value))
+                self.log.flush()
+                self.log_lines += 1
+                if self.log_lines > 2 * self.max_size:
+                    self.compact()
+            return True
+
+    def close(self):
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+
+
+def content_hash_algorithm():
+    if deduplicator:
+        return deduplicator.algorithm
+    return 'md5'
+
+
+def new_content_hasher():
+    ''' Return a new hash object for the content hash of a pastie. '''
+    if content_hash_algorithm() == 'xxhash':
+        return xxhash.xxh64()
+    return hashlib.md5()
+
+
+class ContentDeduplicator(object):
+    '''
+    Recognizes pasties with the same content as an earlier pastie, also when
+    reposted under another id or mirrored on another site. The content hashes
+    are kept in a SeenIndex, with the site and id of the first pastie that
+    had that content.
+    '''
+    def __init__(self, config):
+        self.algorithm = config.get('hash', 'md5')
+        if self.algorithm not in ('md5', 'xxhash'):
+            exit('ERROR: Unknown dedup hash "{0}", use md5 or xxhash.'.format(self.algorithm))
+        if self.algorithm == 'xxhash' and not xxhash:
+            exit('ERROR: Cannot import the xxhash Python library. Are you sure it is installed?')
+        filename = config.get('file')
+        if filename and os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.index = SeenIndex(filename, config.get('max', 100000), config.get('ttl', 0))
+
+    def original_of(self, pastie):
+        '''
+        Remember the content of the pastie. Returns "site/id" of the first
+        pastie with the same content, or None if the content is new.
+        '''
+        if self.index.add(pastie.content_hash, u'{0}/{1}'.format(pastie.site.name, pastie.id)):
+            return None
+        return self.index.get(pastie.content_hash)
+
+
+class PollScheduler(object):
+    '''
+    Chooses the time between two polls of the archive page of a site, between
+    update-min and update-max of the site. The interval is shortened when few of
+    the pasties on the archive page were already known at the last poll, as
+    pasties may then have scrolled off the page in between, and lengthened when
+    most of them were known. A poll where none of the pasties were known yet
+    probably missed pasties, this is logged as a possible gap.
+    '''
+    def __init__(self, site, config):
+        self.site = site
+        self.adaptive = config.get('adaptive', True)
+        self.target = config.get('target-seen', 0.5)  # fraction of known pasties per poll aimed at
+        self.factor = config.get('factor', 1.5)  # maximum change of the interval per poll
+        self.interval = None
+        self.polls = 0
+        self.gaps = 0
+
+    def record(self, total, known):
+        '''
+        Adjust the interval to a poll that found total pasties, of which known
+        were already downloaded or queued.
+        '''
+        self.polls += 1
+        if not total:
+            return
+        if not known and self.polls > 1:
+            self.gaps += 1
+            logger.warning("None of the {total} pasties of {site} were seen at the previous poll, some pasties were probably missed. "
+                           "Consider lowering update-min.".format(total=total, site=self.site.name))
+        if self.interval is None:
+            self.interval = (self.site.update_min + self.site.update_max) / 2.0
+        seen = float(known) / total
+        # move the interval by at most factor, in proportion to the distance to the target
+        if seen < self.target:
+            self.interval /= 1 + (self.factor - 1) * (self.target - seen) / self.target
+        elif seen > self.target:
+            self.interval *= 1 + (self.factor - 1) * (seen - self.target) / (1 - self.target)
+        self.interval = min(max(self.interval, self.site.update_min), self.site.update_max)
+
+    def next_delay(self):
+        ''' Return the number of seconds to wait before the next poll. '''
+        if not self.adaptive or self.interval is None:
+            return random.randint(self.site.update_min, self.site.update_max)
+        # some jitter, so the polls do not follow a recognizable pattern
+        delay = self.interval * random.uniform(0.9, 1.1)
+        return int(round(min(max(delay, self.site.update_min), self.site.update_max)))
+
+
+class SiteAdapter(object):
+    '''
+    How pystemon lists and downloads the pasties of a site. The adapter of a
+    site is chosen with the adapter setting of the site: one of the built-in
+    adapters (regex, json), the name of an adapter another package registers in
+    the pystemon.adapters entry point group, or module:class.
+    The adapter gets the PastieSite and the configuration of the site.
+    '''
+    def __init__(self, site, config):
+        self.site = site
+        self.config = config
+
+    def list_recent(self):
+        '''
+        Return the most recent pasties as (pastie id, metadata dict) pairs,
+        newest first, or None if the list could not be downloaded or did not
+        change. An iterator is read only up to the pasties that were known at
+        the previous poll.
+        May raise RetryLater.
+        '''
+        raise NotImplementedError
+
+    def fetch(self, pastie):
+        '''
+        Return the raw content (bytes) of the pastie, or None if the download
+        failed. May raise RetryLater.
+        '''
+        raise NotImplementedError
+
+    def fetch_bulk(self, pasties):
+        '''
+        Optionally download the content of many new pasties in one go, returns
+        a dict of pastie id -> raw content. The pasties that are not in it are
+        downloaded one by one with fetch().
+        '''
+        return {}
+
+
+class ArchivePageAdapter(SiteAdapter):
+    '''
+    Lists the pasties of the site from its archive-url page, and downloads them
+    one by one from the download-url. Subclasses extract the pasties from the
+    archive page in parse_listing().
+    '''
+    def list_recent(self):
+        response = download_url(self.site.archive_url, headers=self.site.archive_headers(), rate_limiter=self.site.rate_limiter,
+                                threads=self.site.threads)
+        if response is None or self.site.archive_not_modified(response.status_code, response.headers):
+            return None
+        if not response.text:
+            logger.warning("No HTML content for page {url}".format(url=self.site.archive_url))
+            return None
+        return self.parse_listing(response.text)
+
+    def parse_listing(self, page):
+        ''' Return the (pastie id, metadata dict) pairs on the archive page, newest first. '''
+        raise NotImplementedError
+
+    def listing_error(self, page, message):
+        if "DOES NOT HAVE ACCESS" in page:
+            print("Problem with configured IP address")
+        logger.error("{message} Dumping htmlPage \n {html}".format(message=message, html=page))
+
+    def fetch(self, pastie):
+        if self.site.stream:
+            return self.fetch_stream(pastie)
+        response = download_url(pastie.url, rate_limiter=self.site.rate_limiter, threads=self.site.threads)
+        if response is None:
+            return None
+        if self.site.max_size and len(response.content) > self.site.max_size:
+            self.site.too_large(pastie.id)
+            return None
+        return response.content
+
+    def fetch_stream(self, pastie):
+        '''
+        Download the pastie in chunks: stop as soon as it gets larger than the
+        maximum size of the site, and hash and search the chunks as they arrive.
+        '''
+        response = download_url(pastie.url, stream=True, rate_limiter=self.site.rate_limiter, threads=self.site.threads)
+        if response is None:
+            return None
+        max_size = self.site.max_size
+        try:
+            if max_size and int(response.headers.get('Content-Length') or 0) > max_size:
+                self.site.too_large(pastie.id)
+                return None
+            hasher = new_content_hasher()
+            matcher = search_engine.stream() if isinstance(search_engine, SearchEngine) else None
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(self.site.chunk_size):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    self.site.too_large(pastie.id)
+                    return None
+                hasher.update(chunk)
+                if matcher:
+                    matcher.feed(chunk)
+                chunks.append(chunk)
+        finally:
+            response.close()
+        content = b''.join(chunks)
+        if size < 1024 and classify_response(response.status_code, content.decode('utf8', 'replace')):
+            raise RetryLater(pastie.url, 'notready')
+        pastie.content_hash = hasher.hexdigest()
+        pastie.stream_matcher = matcher
+        return content
+
+
+class RegexAdapter(ArchivePageAdapter):
+    ''' Extracts the pastie ids from the archive page with the archive-regex of the site. '''
+    def parse_listing(self, page):
+        found = False
+        for match in re.finditer(self.site.archive_regex, page):
+            found = True
+            yield (match.group(1) if match.groups() else match.group(0)), {}
+        if not found:
+            self.listing_error(page, "No last pasties matches for regular expression site:{site} regex:{regex}. Error in your regex?".format(site=self.site.name, regex=self.site.archive_regex))
+
+
+class JsonAdapter(ArchivePageAdapter):
+    '''
+    Reads the archive page as a JSON list of objects, like the pastebin
+    scraping API. The pastie id is the archive-key member of the objects, the
+    other members are the metadata of the pastie. If the objects hold the
+    content of the pasties as well, in the content-key member, the pasties
+    are not downloaded one by one.
+    '''
+    def __init__(self, site, config):
+        ArchivePageAdapter.__init__(self, site, config)
+        self.archive_key = config.get('archive-key', 'key')
+        self.content_key = config.get('content-key')
+
+    def parse_listing(self, page):
+        try:
+            entries = json.loads(page)
+        except ValueError:
+            entries = None
+        if not isinstance(entries, list):
+            self.listing_error(page, "The archive page of site:{site} is not a JSON list.".format(site=self.site.name))
+            return []
+        return [(u'{0}'.format(entry[self.archive_key]), entry) for entry in entries if isinstance(entry, dict) and self.archive_key in entry]
+
+    def fetch_bulk(self, pasties):
+        if not self.content_key:
+            return {}
+        contents = {}
+        for pastie in pasties:
+            content = pastie.metadata.get(self.content_key)
+            if content is not None:
+                contents[pastie.id] = content.encode('utf8') if not isinstance(content, bytes) else content
+        return contents
+
+
+site_adapters = {
+    'regex': RegexAdapter,
+    'json': JsonAdapter,
+}
+
+
+def load_site_adapter(name):
+    '''
+    Return the SiteAdapter class called name: a built-in adapter, an adapter
+    registered in the pystemon.adapters entry point group, or module:class.
+    Raises ValueError if there is no such adapter.
+    '''
+    if name in site_adapters:
+        return site_adapters[name]
+    if entry_points:
+        found = entry_points()
+        # the selection API of python 3.10, a dict of groups before
+        group = found.select(group='pystemon.adapters') if hasattr(found, 'select') else found.get('pystemon.adapters', [])
+        for entry_point in group:
+            if entry_point.name == name:
+                return entry_point.load()
+    elif iter_entry_points:
+        for entry_point in iter_entry_points('pystemon.adapters', name):
+            return entry_point.load()
+    if ':' in name:
+        module_name, class_name = name.split(':', 1)
+        try:
+            return getattr(__import__(module_name, fromlist=[class_name]), class_name)
+        except (ImportError, AttributeError) as e:
+            raise ValueError('Cannot load the site adapter {name}: {e}'.format(name=name, e=e))
+    raise ValueError('Unknown site adapter {name}'.format(name=name))
+
+
 class PastieSite(threading.Thread):
     '''
     Instances of these threads are responsible for downloading the list of
@@ -114,96 +542,261 @@ class PastieSite(threading.Thread):
         self.archive_compress = yamlconfig['archive']['compress']
         self.update_max = 30  # TODO set by config file
         self.update_min = 10  # TODO set by config file
+        self.threads = yamlconfig['threads']  # number of download threads (or concurrent downloads for the async engine)
+        self.retry = retry_defaults.copy()
+        self.retry.update(yamlconfig.get('retry') or {})
+        self.pending = set()  # ids of the pasties in the download queue or waiting for a retry
+        self.journal = None  # DownloadJournal of the pending pasties, if they are kept across restarts
+        download_config = yamlconfig.get('download') or {}
+        self.stream = download_config.get('stream', False)
+        self.chunk_size = download_config.get('chunk-size', 65536)
+        self.max_size = download_config.get('max-size', 0)
         self.pastie_classname = None
-        self.seen_pasties = deque('', 1000)  # max number of pasties ids in memory
+        self.queue_config = {}  # overrides of the queues/download settings for this site
+        self.rate_limiter = RateLimiter(name, yamlconfig.get('rate-limit') or {})
+        polling_config = yamlconfig.get('polling') or {}
+        self.poll_scheduler = PollScheduler(self, polling_config)
+        self.adapter = RegexAdapter(self, {})  # lists and downloads the pasties, see SiteAdapter
+        self.incremental = polling_config.get('incremental', True)
+        self.last_ids = []  # ids on the archive page at the previous poll, newest first
+        self.conditional = polling_config.get('conditional', True)
+        self.archive_validators = {}  # ETag and Last-Modified of the archive page at the previous poll
+        seen_config = yamlconfig.get('seen') or {}
+        seen_filename = None
+        if seen_config.get('dir'):
+            if not os.path.exists(seen_config['dir']):
+                os.makedirs(seen_config['dir'])
+            seen_filename = seen_config['dir'] + os.sep + name + '.seen'
+        self.seen_pasties = SeenIndex(seen_filename,
+                                      seen_config.get('max', 100000),  # max number of pasties ids in memory
+                                      seen_config.get('ttl', 0))
 
     def run(self):
         while not self.kill_received:
-            sleep_time = random.randint(self.update_min, self.update_max)
+            if cluster and not cluster.should_poll(self):
+                # another node of the cluster polls this site, check again later if it still does
+                if shutting_down.wait(self.poll_scheduler.next_delay()):
+                    break
+                continue
             try:
                 # grabs site from queue
-                logger.info(
-                    'Downloading list of new pastes from {name}. '
-                    'Will check again in {time} seconds'.format(
-                        name=self.name, time=sleep_time))
+                logger.info('Downloading list of new pastes from {name}.'.format(name=self.name))
                 # get the list of last pasties, but reverse it
                 # so we first have the old entries and then the new ones
                 last_pasties = self.get_last_pasties()
                 if last_pasties:
                     for pastie in reversed(last_pasties):
                         queues[self.name].put(pastie)  # add pastie to queue
+                    queue = queues[self.name]
                     logger.info("Found {amount} new pasties for site {site}. There are now {qsize} pasties to be downloaded.".format(amount=len(last_pasties),
                                                                                                                                      site=self.name,
-                                                                                                                                     qsize=queues[self.name].qsize()))
+                                                                                                                                     qsize=queue.qsize()))
+                    if queue.dropped or queue.spilled:
+                        logger.warning("The download queue of {site} is full: {dropped} pasties dropped "
+                                       "and {spilled} spilled to disk so far.".format(site=self.name, dropped=queue.dropped, spilled=queue.spilled))
+                waiting, retries, gave_up = retry_scheduler.site_stats(self.name)
+                if waiting or retries:
+                    logger.info("Site {site} has {waiting} pasties waiting for a retry, {retries} retries "
+                                "and {gave_up} given up so far.".format(site=self.name, waiting=waiting, retries=retries, gave_up=gave_up))
+            except RetryLater as e:
+                logger.warning("Could not download the list of pastes from {name}, will try again at the next check: {e}".format(name=self.name, e=e))
             # catch unknown errors
             except Exception as e:
                 msg = 'Thread for {name} crashed unexpectectly, '\
                       'recovering...: {e}'.format(name=self.name, e=e)
                 logger.error(msg)
                 logger.debug(traceback.format_exc())
-            time.sleep(sleep_time)
+            sleep_time = self.poll_scheduler.next_delay()
+            logger.info('Will check {name} again in {time} seconds'.format(name=self.name, time=sleep_time))
+            if shutting_down.wait(sleep_time):
+                break
 
     def get_last_pasties(self):
-        # reset the pasties list
-        pasties = []
         # populate queue with data
-        response = download_url(self.archive_url)
-        htmlPage = response.text
+        start = time.time()
+        listing = self.adapter.list_recent()
+        if listing is None:
+            return False
+        last_pasties = self.queue_listing(listing)
+        stats.observe('pystemon_archive_poll_seconds', (('site', self.name),), time.time() - start)
+        return last_pasties
+
+    def archive_headers(self):
+        ''' Return the headers of a conditional request for the archive page. '''
+        headers = {}
+        if self.conditional:
+            if 'etag' in self.archive_validators:
+                headers['If-None-Match'] = self.archive_validators['etag']
+            if 'last-modified' in self.archive_validators:
+                headers['If-Modified-Since'] = self.archive_validators['last-modified']
+        return headers
+
+    def archive_not_modified(self, status_code, headers):
+        '''
+        Remember the validators of the archive page, and return True if
+        the page did not change since the previous poll (HTTP 304).
+        '''
+        if status_code == 304:
+            logger.debug("The archive page of {site} did not change.".format(site=self.name))
+            # nothing new at all: all the pasties were known
+            self.poll_scheduler.record(len(self.last_ids), len(self.last_ids))
+            return True
+        for name in ('etag', 'last-modified'):
+            if headers.get(name):
+                self.archive_validators[name] = headers[name]
+            else:
+                self.archive_validators.pop(name, None)
+        return False
+
+    def parse_last_pasties(self, htmlPage):
+        ''' Queue the new pasties of the archive page, for the adapters that read an archive page. '''
         if not htmlPage:
             logger.warning("No HTML content for page {url}".format(url=self.archive_url))
             return False
-        pasties_ids = re.findall(self.archive_regex, htmlPage)
-        if pasties_ids:
-            for pastie_id in pasties_ids:
-                # check if the pastie was already downloaded
-                # and remember that we've seen it
-                if self.seen_pastie(pastie_id):
-                    # do not append the seen things again in the queue
-                    continue
-                # pastie was not downloaded yet. Add it to the queue
-                if self.pastie_classname:
-                    class_name = globals()[self.pastie_classname]
-                    pastie = class_name(self, pastie_id)
-                else:
-                    pastie = Pastie(self, pastie_id)
-                pasties.append(pastie)
-            return pasties
-        if "DOES NOT HAVE ACCESS" in htmlPage.encode('utf8'):
-            print("Problem with configured IP address")
+        return self.queue_listing(self.adapter.parse_listing(htmlPage))
 
-        logger.error("No last pasties matches for regular expression site:{site} regex:{regex}. Error in your regex? Dumping htmlPage \n {html}".format(site=self.name, regex=self.archive_regex, html=htmlPage.encode('utf8')))
-        return False
+    def new_listing(self, listing):
+        '''
+        Return the (pastie id, metadata) pairs of the listing, newest first,
+        up to the first pastie that was listed at the previous poll: the ones
+        after it are older, so they were listed at the previous poll as well.
+        Also returns the number of pasties assumed to be in the listing.
+        '''
+        last_ids = set(self.last_ids) if self.incremental else ()
+        entries = []
+        stopped = False
+        for pastie_id, metadata in listing:
+            if pastie_id in last_ids:
+                stopped = True
+                break
+            entries.append((pastie_id, metadata))
+        new_ids = [pastie_id for pastie_id, metadata in entries]
+        if stopped:
+            # the rest of the listing was known, assume it is as long as the previous one
+            total = max(len(entries) + 1, len(self.last_ids))
+            self.last_ids = (new_ids + self.last_ids)[:total]
+        elif entries:
+            total = len(entries)
+            self.last_ids = new_ids
+        else:
+            # nothing listed at all
+            total = len(self.last_ids)
+        return entries, total
+
+    def queue_listing(self, listing):
+        ''' Return the new pasties of the listing, which are not downloaded or queued yet. '''
+        # reset the pasties list
+        pasties = []
+        entries, total = self.new_listing(listing)
+        known = total - len(entries)
+        for pastie_id, metadata in entries:
+            # check if the pastie was already downloaded
+            # and remember that we've seen it
+            if self.seen_pastie(pastie_id) or pastie_id in self.pending:
+                # do not append the seen or already queued things again in the queue
+                known += 1
+                continue
+            if cluster and not cluster.claim(self.name, pastie_id):
+                # another node of the cluster downloads this one, it is not
+                # marked seen: the node can release it when it gives up
+                known += 1
+                continue
+            self.pending.add(pastie_id)
+            if self.journal:
+                self.journal.enqueue(pastie_id)
+            # pastie was not downloaded yet. Add it to the queue
+            pasties.append(self.make_pastie(pastie_id, metadata))
+        self.poll_scheduler.record(total, known)
+        if pasties:
+            # the pasties the adapter can download at once are not downloaded one by one
+            contents = self.adapter.fetch_bulk(pasties)
+            for pastie in pasties:
+                if pastie.id in contents:
+                    pastie.pastie_content = contents[pastie.id]
+        return pasties
+
+    def make_pastie(self, pastie_id, metadata=None):
+        if self.pastie_classname:
+            class_name = globals()[self.pastie_classname]
+            pastie = class_name(self, pastie_id)
+        else:
+            pastie = Pastie(self, pastie_id)
+        pastie.metadata = metadata or {}
+        return pastie
+
+    def make_queue(self):
+        ''' Return the download queue of the site, as set in the queues section. '''
+        queue_config = dict((yamlconfig.get('queues') or {}).get('download') or {})
+        queue_config.update(self.queue_config)
+        return BoundedQueue(self.name,
+                            queue_config.get('size', 0),
+                            queue_config.get('policy', 'block'),
+                            (yamlconfig.get('queues') or {}).get('spill-dir', 'spill'),
+                            encode=self.encode_pastie,
+                            decode=self.decode_pastie,
+                            on_drop=lambda pastie: self.done(pastie.id, downloaded=False))
+
+    def encode_pastie(self, pastie):
+        ''' Turn a pastie into a line of the spill file, with what is known of it before the download. '''
+        item = {'id': pastie.id, 'metadata': pastie.metadata, 'retries': pastie.retries}
+        if pastie.pastie_content is not None:
+            # downloaded with the listing, see SiteAdapter.fetch_bulk()
+            item['content'] = base64.b64encode(pastie.pastie_content).decode('ascii')
+        return json.dumps(item)
+
+    def decode_pastie(self, line):
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if not isinstance(item, dict):
+            # spilled by an older version, only the id was kept
+            return self.make_pastie(line)
+        pastie = self.make_pastie(item['id'], item.get('metadata'))
+        pastie.retries = item.get('retries') or {}
+        if item.get('content') is not None:
+            pastie.pastie_content = base64.b64decode(item['content'])
+        return pastie
+
+    def done(self, pastie_id, downloaded=True):
+        '''
+        The pastie is downloaded, or it is given up or dropped: then it is
+        no longer claimed in the cluster, so another node can download it.
+        '''
+        self.pending.discard(pastie_id)
+        if self.journal:
+            self.journal.ack(pastie_id)
+        if cluster and not downloaded:
+            cluster.release(self.name, pastie_id)
+
+    def replay_journal(self):
+        ''' Return the pasties that were waiting for a download before the restart. '''
+        pasties = []
+        for pastie_id in self.journal.replay():
+            if not self.seen_pastie(pastie_id) and pastie_id not in self.pending:
+                self.pending.add(pastie_id)
+                pasties.append(self.make_pastie(pastie_id))
+            else:
+                self.journal.ack(pastie_id)
+        if pasties:
+            logger.info('Queued again {count} pasties of {site} that were waiting for a download.'.format(count=len(pasties), site=self.name))
+        return pasties
+
+    def too_large(self, pastie_id):
+        ''' The pastie is larger than max-size: drop it, and do not download it again at the next polls. '''
+        logger.warning('Pastie {site} {id} is larger than {max} bytes, dropping it'.format(site=self.name, id=pastie_id, max=self.max_size))
+        self.seen_pasties.add(pastie_id)
 
     def seen_pastie(self, pastie_id):
         ''' check if the pastie was already downloaded. '''
-        # first look in memory if we have already seen this pastie
-        if self.seen_pasties.count(pastie_id):
-            return True
-        # look on the filesystem.  # LATER remove this filesystem lookup as it will give problems on long term
-        if yamlconfig['archive']['save-all']:
-            # check if the pastie was already saved on the disk
-            if os.path.exists(verify_directory_exists(self.archive_dir) + os.sep + self.pastie_id_to_filename(pastie_id)):
-                return True
-        # TODO look in the database if it was already seen
+        return pastie_id in self.seen_pasties
 
     def seen_pastie_and_remember(self, pastie):
         '''
         Check if the pastie was already downloaded
         and remember that we've seen it
         '''
-        seen = False
-        if self.seen_pastie(pastie.id):
-            seen = True
-        else:
-            # We have not yet seen the pastie.
-            # Keep in memory that we've seen it using
-            # appendleft for performance reasons.
-            # (faster later when we iterate over the deque)
-            self.seen_pasties.appendleft(pastie.id)
-        # add / update the pastie in the database
-        if db:
-            db.queue.put(pastie)
-        return seen
+        return not self.seen_pasties.add(pastie.id)
 
     def pastie_id_to_filename(self, pastie_id):
         filename = pastie_id.replace('/', '_')
@@ -212,7 +805,17 @@ class PastieSite(threading.Thread):
         return filename
 
 
-def verify_directory_exists(directory):
+def fsync_directory(directory):
+    ''' Make the creation of the files in the directory durable. '''
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def day_directory(directory):
+    ''' Return the year/month/day subdirectory of today. '''
     d = datetime.now()
     year = str(d.year)
     month = str(d.month)
@@ -222,12 +825,745 @@ def verify_directory_exists(directory):
     day = str(d.day)
     if len(day) < 2:
         day = "0" + day
-    fullpath = directory + os.sep + year + os.sep + month + os.sep + day
+    return directory + os.sep + year + os.sep + month + os.sep + day
+
+
+def verify_directory_exists(directory):
+    fullpath = day_directory(directory)
     if not os.path.isdir(fullpath):
         os.makedirs(fullpath)
     return fullpath
 
 
+def parse_regex_flags(value):
+    '''
+    Convert the regex-flags setting of a search rule to an integer.
+    Accepts an integer or a combination of re flags like
+    're.MULTILINE + re.DOTALL' or 're.MULTILINE | re.DOTALL'.
+    '''
+    if isinstance(value, int):
+        return value
+    flags = 0
+    for token in re.split(r'[+|]', str(value)):
+        token = token.strip()
+        if not token:
+            continue
+        if token.isdigit():
+            flags |= int(token)
+            continue
+        if token.startswith('re.'):
+            token = token[3:]
+        flag = getattr(re, token, None)
+        if not isinstance(flag, int):
+            raise ValueError('unknown regex flag "{0}"'.format(token))
+        flags |= flag
+    return flags
+
+
+def required_literal(parsed):
+    '''
+    Return the longest literal byte string that every match of the parsed
+    regular expression must contain, or an empty string if there is none.
+    '''
+    best = b''
+    run = bytearray()
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(av)
+            continue
+        if op == sre_parse.AT:
+            # anchors do not consume characters, the literal run continues
+            continue
+        if len(run) > len(best):
+            best = bytes(run)
+        run = bytearray()
+        sub = None
+        if op == sre_parse.SUBPATTERN:
+            # python 3.6+ stores the scoped flags before the subpattern
+            if len(av) == 4 and (av[1] or av[2]):
+                continue
+            sub = av[-1]
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            sub = av[2]
+        if sub is not None:
+            literal = required_literal(sub)
+            if len(literal) > len(best):
+                best = literal
+    if len(run) > len(best):
+        best = bytes(run)
+    return best
+
+
+def position_dependent(parsed):
+    '''
+    Return True if the parsed regular expression looks at the text around a
+    match (anchors, word boundaries, lookarounds), so it can match a chunk of
+    the content where it does not match the whole content.
+    '''
+    for op, av in parsed:
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            return True
+        if op == sre_parse.SUBPATTERN:
+            subs = [av[-1]]
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) or op == getattr(sre_parse, 'POSSESSIVE_REPEAT', None):
+            subs = [av[2]]
+        elif op == sre_parse.BRANCH:
+            subs = av[1]
+        elif op == sre_parse.GROUPREF_EXISTS:
+            subs = [sub for sub in av[1:] if sub]
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            subs = [av]
+        else:
+            continue
+        if any(position_dependent(sub) for sub in subs):
+            return True
+    return False
+
+
+class SearchRule(object):
+    '''
+    A single entry of the search section of the configuration file,
+    with the regular expressions compiled.
+    '''
+    min_literal_length = 3  # shorter literals are not selective enough to prefilter on
+
+    def __init__(self, config):
+        self.config = config
+        self.flags = re.IGNORECASE
+        if 'regex-flags' in config:
+            self.flags = parse_regex_flags(config['regex-flags'])
+        pattern = config['search'].encode('utf8')
+        self.regex = re.compile(pattern, self.flags)
+        self.exclude = None
+        if 'exclude' in config and config['exclude']:
+            self.exclude = re.compile(config['exclude'].encode('utf8'), self.flags)
+        self.count = 0
+        if 'count' in config and config['count']:
+            self.count = int(config['count'])
+        # the inline flags of the pattern are taken into account by the compiled regex
+        self.ignorecase = bool(self.regex.flags & re.IGNORECASE)
+        self.literal = None
+        parsed = sre_parse.parse(pattern, self.flags)
+        if not self.regex.flags & re.LOCALE:
+            literal = required_literal(parsed)
+            if len(literal) >= self.min_literal_length:
+                self.literal = literal.lower() if self.ignorecase else literal
+        # what decides if the rule can be matched on the chunks of a download, see SearchStream
+        self.max_width = parsed.getwidth()[1]
+        self.position_dependent = position_dependent(parsed)
+        if self.exclude:
+            parsed = sre_parse.parse(self.exclude.pattern, self.flags)
+            self.max_width = max(self.max_width, parsed.getwidth()[1])
+            self.position_dependent = self.position_dependent or position_dependent(parsed)
+
+    def description(self):
+        return self.config.get('description') or self.config['search']
+
+    def streamable(self, overlap):
+        ''' Whether matching the chunks of the content that overlap by overlap bytes finds the same as matching the whole content. '''
+        return not self.position_dependent and self.max_width <= overlap
+
+    def match(self, content):
+        '''
+        Check if the rule matches the content, taking the count and
+        exclude settings into account.
+        '''
+        if self.count > 1:
+            hits = 0
+            for _ in self.regex.finditer(content):
+                hits += 1
+                if hits >= self.count:
+                    break
+            else:
+                return False
+        elif not self.regex.search(content):
+            return False
+        if self.exclude and self.exclude.search(content):
+            return False
+        return True
+
+
+class SearchEngine(object):
+    '''
+    Search engine built once from the search section of the configuration file.
+    A literal prefilter decides which regular expressions can possibly match
+    a pastie, so only those candidates are run against the content.
+    '''
+    def __init__(self, rules):
+        self.rules = [SearchRule(rule) for rule in rules or []]
+        self.rule_calls = [0] * len(self.rules)  # number of times a regex ran, per rule
+        self.rule_seconds = [0.0] * len(self.rules)  # time spent in the regexes, per rule
+        self.rule_hits = [0] * len(self.rules)  # number of pasties matched, per rule
+        self.rule_overruns = [0] * len(self.rules)  # number of pasties where the rule took longer than the budget
+        self.quarantined = {}  # position of a rule -> end of its quarantine (None for ever)
+        self.rule_budget = 0
+        self.quarantine_after = 3
+        self.quarantine_time = 3600
+        self.timings_lock = threading.Lock()
+        self.literals = set()
+        self.literals_nocase = set()
+        for rule in self.rules:
+            if rule.literal is None:
+                continue
+            if rule.ignorecase:
+                self.literals_nocase.add(rule.literal)
+            else:
+                self.literals.add(rule.literal)
+        self.automaton = self.build_automaton(self.literals)
+        self.automaton_nocase = self.build_automaton(self.literals_nocase)
+        # to find the ignorecase literals in a memory map, which cannot be lowercased in place
+        self.literal_regexes_nocase = [(literal, re.compile(re.escape(literal), re.IGNORECASE)) for literal in self.literals_nocase]
+
+    @staticmethod
+    def build_automaton(literals):
+        if not ahocorasick or not literals:
+            return None
+        automaton = ahocorasick.Automaton()
+        for literal in literals:
+            key = literal.decode('latin-1') if ahocorasick.unicode else literal
+            automaton.add_word(key, literal)
+        automaton.make_automaton()
+        return automaton
+
+    @staticmethod
+    def find_literals(content, literals, automaton):
+        # the automaton needs bytes, a memory map is searched with find()
+        if automaton and isinstance(content, bytes):
+            if ahocorasick.unicode:
+                content = content.decode('latin-1')
+            return set(literal for _, literal in automaton.iter(content))
+        return set(literal for literal in literals if content.find(literal) != -1)
+
+    def search(self, content):
+        '''
+        Return the list of search rules (as found in the configuration file)
+        that match the content.
+        '''
+        return [self.rules[index].config for index in self.search_indexes(content)]
+
+    def search_indexes(self, content):
+        '''
+        Return the positions of the search rules that match the content.
+        '''
+        indexes, timings = self.search_indexes_timed(content, self.skipped_indexes())
+        self.add_timings(timings, indexes)
+        return indexes
+
+    def search_indexes_timed(self, content, skip=()):
+        '''
+        Return the positions of the search rules that match the content,
+        and the (position, seconds) of every regex that ran.
+        The rules at the positions in skip are not run.
+        '''
+        indexes = []
+        timings = []
+        for index in self.candidate_indexes(content):
+            if index in skip:
+                continue
+            start = time.time()
+            if self.rules[index].match(content):
+                indexes.append(index)
+            timings.append((index, time.time() - start))
+        return indexes, timings
+
+    def set_budget(self, seconds, quarantine_after=3, quarantine_time=3600):
+        '''
+        Quarantine a search rule when its regex took longer than seconds on
+        quarantine_after pasties: it is skipped for quarantine_time seconds,
+        or until the restart if quarantine_time is 0. A regex cannot be
+        interrupted, so the budget is checked after it finished.
+        '''
+        self.rule_budget = seconds
+        self.quarantine_after = quarantine_after
+        self.quarantine_time = quarantine_time
+
+    def skipped_indexes(self):
+        ''' Return the positions of the search rules in quarantine. '''
+        if not self.quarantined:
+            return ()
+        now = time.time()
+        with self.timings_lock:
+            for index, end in list(self.quarantined.items()):
+                if end is not None and end <= now:
+                    del self.quarantined[index]
+                    logger.info('Search rule {rule} is no longer in quarantine'.format(rule=self.rules[index].description()))
+            return set(self.quarantined)
+
+    def add_timings(self, timings, indexes=()):
+        '''
+        Count the (position, seconds) timings of the regexes that ran on a
+        pastie and the positions of the rules that matched it.
+        '''
+        with self.timings_lock:
+            for index, seconds in timings:
+                self.rule_calls[index] += 1
+                self.rule_seconds[index] += seconds
+                if self.rule_budget and seconds > self.rule_budget:
+                    self.rule_overruns[index] += 1
+                    rule = self.rules[index]
+                    logger.warning('Search rule {rule} took {seconds:.2f} seconds on a pastie'.format(rule=rule.description(), seconds=seconds))
+                    if self.rule_overruns[index] % self.quarantine_after == 0 and index not in self.quarantined:
+                        self.quarantined[index] = time.time() + self.quarantine_time if self.quarantine_time else None
+                        logger.error('Search rule {rule} took longer than {budget} seconds on {count} pasties, it is skipped {until}'.format(
+                            rule=rule.description(), budget=self.rule_budget, count=self.rule_overruns[index],
+                            until='for {0} seconds'.format(self.quarantine_time) if self.quarantine_time else 'until the restart'))
+            for index in indexes:
+                self.rule_hits[index] += 1
+
+    def rule_stats(self):
+        '''
+        Return (rule, calls, hits, seconds, overruns, quarantined) for every search rule.
+        '''
+        with self.timings_lock:
+            return [(rule, self.rule_calls[index], self.rule_hits[index], self.rule_seconds[index],
+                     self.rule_overruns[index], index in self.quarantined)
+                    for index, rule in enumerate(self.rules)]
+
+    def slowest_rules(self, count=5):
+        ''' Return the rule_stats() of the count search rules that took the most time. '''
+        return sorted(self.rule_stats(), key=lambda entry: entry[3], reverse=True)[:count]
+
+    def candidate_indexes(self, content):
+        '''
+        Return the positions of the search rules that pass the literal prefilter.
+        The content is bytes, or a memory map of them.
+        '''
+        found = set()
+        if self.literals:
+            found.update(self.find_literals(content, self.literals, self.automaton))
+        if self.literals_nocase:
+            if isinstance(content, bytes):
+                found.update(self.find_literals(content.lower(), self.literals_nocase, self.automaton_nocase))
+            else:
+                found.update(literal for literal, regex in self.literal_regexes_nocase if regex.search(content))
+        return [index for index, rule in enumerate(self.rules)
+                if rule.literal is None or rule.literal in found]
+
+    def stream(self, overlap=4096):
+        ''' Return a SearchStream to search content while it is downloaded. '''
+        return SearchStream(self, overlap)
+
+
+class SearchStream(object):
+    '''
+    Searches content that arrives in chunks, while it is downloaded.
+    Every chunk is searched together with the last overlap bytes of the
+    data before it, so a match spanning two chunks is found as long as it
+    is shorter than the overlap. Matches that lie completely in the overlap
+    were counted with the previous chunk and are not counted again.
+    The rules that can match longer text than the overlap, or that look at
+    the text around a match (anchors like $, word boundaries, lookarounds),
+    would not find the same in the chunks: they are matched on the whole
+    content once it is downloaded.
+    '''
+    def __init__(self, engine, overlap=4096):
+        self.engine = engine
+        self.overlap = overlap
+        self.tail = b''
+        self.hits = [0] * len(engine.rules)
+        self.excluded = [False] * len(engine.rules)
+        self.seconds = {}  # time spent per rule on this pastie, counted by search()
+        self.skip = engine.skipped_indexes()
+        self.whole = set(index for index, rule in enumerate(engine.rules) if not rule.streamable(overlap))
+
+    def feed(self, chunk):
+        data = self.tail + chunk
+        tail_length = len(self.tail)
+        for index, rule in enumerate(self.engine.rules):
+            if rule.exclude and not self.excluded[index] and index not in self.whole and rule.exclude.search(data):
+                self.excluded[index] = True
+        for index in self.engine.candidate_indexes(data):
+            rule = self.engine.rules[index]
+            needed = max(rule.count, 1)
+            if self.excluded[index] or self.hits[index] >= needed or index in self.skip or index in self.whole:
+                continue
+            start = time.time()
+            for match in rule.regex.finditer(data):
+                if match.end() <= tail_length:
+                    continue
+                self.hits[index] += 1
+                if self.hits[index] >= needed:
+                    break
+            self.seconds[index] = self.seconds.get(index, 0) + time.time() - start
+        self.tail = data[-self.overlap:]
+
+    def search(self, content):
+        '''
+        Return the search rules that matched the content fed so far. The
+        content is the whole content, for the rules that cannot be matched
+        on the chunks.
+        '''
+        return [self.engine.rules[index].config for index in self.search_indexes(content)]
+
+    def search_indexes(self, content):
+        '''
+        Return the positions of the search rules that matched the content fed
+        so far, see search(). The content is only used when whole is not empty.
+        '''
+        indexes = [index for index, rule in enumerate(self.engine.rules)
+                   if index not in self.whole and self.hits[index] >= max(rule.count, 1) and not self.excluded[index]]
+        if self.whole:
+            streamed = set(range(len(self.engine.rules))) - self.whole
+            whole_indexes, timings = self.engine.search_indexes_timed(content, streamed.union(self.skip))
+            indexes = sorted(indexes + whole_indexes)
+            for index, seconds in timings:
+                self.seconds[index] = self.seconds.get(index, 0) + seconds
+        self.engine.add_timings(self.seconds.items(), indexes)
+        return indexes
+
+
+def search_pool_init(rules):
+    ''' Build the search engine in a process of the SearchPool. '''
+    global search_engine
+    # CTRL+C and SIGTERM are handled by the main process, which stops the pool, see stop_pool()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    search_engine = SearchEngine(rules)
+
+
+def search_pool_match(content, shm_path=None, skip=()):
+    '''
+    Search the content in a process of the SearchPool. Large content is
+    searched in place in a memory map of the shared memory file shm_path,
+    instead of being pickled or copied.
+    '''
+    if not shm_path:
+        return search_engine.search_indexes_timed(content, skip)
+    with open(shm_path, 'rb') as f:
+        shm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return search_engine.search_indexes_timed(shm, skip)
+        finally:
+            shm.close()
+
+
+def stop_pool(pool, deadline):
+    '''
+    Stop a pool of processes that ignore SIGINT and SIGTERM: let them finish
+    their tasks until the deadline, then kill the ones still busy.
+    '''
+    pool.close()
+    joiner = threading.Thread(target=pool.join)
+    joiner.daemon = True
+    joiner.start()
+    joiner.join(max(deadline - time.time(), 1))
+    if not joiner.is_alive():
+        pool.terminate()
+        return
+    logger.warning('The search processes are still busy, killing them.')
+    # terminate() sends SIGTERM, which they ignore, and waits for them
+    terminator = threading.Thread(target=pool.terminate)
+    terminator.daemon = True
+    terminator.start()
+    end = time.time() + 5
+    while terminator.is_alive() and time.time() < end:
+        kill_children()
+        terminator.join(0.1)
+
+
+def kill_children():
+    ''' Kill the processes of the pools, which ignore SIGTERM. '''
+    for process in multiprocessing.active_children():
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except OSError:
+            pass  # already gone
+
+
+class SearchPool(object):
+    '''
+    Pool of processes that each hold a SearchEngine, so matching the search
+    rules scales over multiple cores. It has the same search() method as the
+    SearchEngine, and is used instead of it when matching/processes is set.
+    Large pasties are written to a memory backed file (/dev/shm) that the
+    processes map, instead of being pickled through a pipe.
+    '''
+    def __init__(self, rules, processes, shared_memory_size=65536):
+        self.engine = SearchEngine(rules)
+        self.shared_memory_size = shared_memory_size
+        self.shared_memory_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.pool = multiprocessing.Pool(processes, search_pool_init, (rules,))
+
+    def search(self, content):
+        shm_path = None
+        if self.shared_memory_size and len(content) >= self.shared_memory_size:
+            fd, shm_path = tempfile.mkstemp(prefix='pystemon-', dir=self.shared_memory_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            args = (None, shm_path, self.engine.skipped_indexes())
+        else:
+            args = (content, None, self.engine.skipped_indexes())
+        try:
+            indexes, timings = self.pool.apply(search_pool_match, args)
+        finally:
+            if shm_path:
+                os.unlink(shm_path)
+        self.engine.add_timings(timings, indexes)
+        return [self.engine.rules[index].config for index in indexes]
+
+    def set_budget(self, seconds, quarantine_after=3, quarantine_time=3600):
+        self.engine.set_budget(seconds, quarantine_after, quarantine_time)
+
+    def stop(self, deadline):
+        stop_pool(self.pool, deadline)
+
+    def rule_stats(self):
+        return self.engine.rule_stats()
+
+    def slowest_rules(self, count=5):
+        return self.engine.slowest_rules(count)
+
+
+def compress_member(content, compression):
+    ''' Compress the content of a pastie as a standalone member of a segment. '''
+    if compression == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(content) + compressor.flush()
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(content)
+    return content
+
+
+def decompress_member(data, compression):
+    if compression == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+segment_extensions = {'gzip': '.seg.gz', 'zstd': '.seg.zst', None: '.seg'}
+
+
+class ArchiveSegmentWriter(threading.Thread):
+    '''
+    Appends the pasties saved in a directory to rolling segment files,
+    instead of writing one small file per pastie. Every pastie is a
+    standalone compressed member of the segment, so a gzip segment can be
+    read with zcat. Its id, offset and length are written to the sidecar
+    index file (segment name + '.idx').
+    Writes are committed (fsync) as a group: when commit_size bytes are
+    pending, or every commit_time seconds. The callbacks given to append()
+    are called with the location of the pastie once it is committed.
+    '''
+    def __init__(self, directory, compression, segment_size=64 * 1024 * 1024, commit_size=1024 * 1024, commit_time=5):
+        threading.Thread.__init__(self)
+        self.kill_received = False
+        self.directory = directory
+        self.compression = compression
+        self.segment_size = segment_size
+        self.commit_size = commit_size
+        self.commit_time = commit_time
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_path = None
+        self.segment_day = None
+        self.index = None
+        self.pending_bytes = 0
+        self.pending_callbacks = []
+        self.new_directories = set()
+
+    def open_segment(self):
+        '''
+        Start a new segment. Must be called with the lock held, returns the
+        callbacks of the previous segment to call once the lock is released.
+        '''
+        callbacks = []
+        if self.segment:
+            callbacks = self.close_segment()
+        directory = verify_directory_exists(self.directory)
+        self.segment_day = directory
+        self.segment_path = directory + os.sep + datetime.now().strftime('%H%M%S%f') + segment_extensions[self.compression]
+        self.segment = open(self.segment_path, 'ab')
+        self.index = open(self.segment_path + '.idx', 'ab')
+        self.new_directories.add(directory)
+        return callbacks
+
+    def close_segment(self):
+        callbacks = self.commit_locked()
+        self.segment.close()
+        self.index.close()
+        self.segment = None
+        self.index = None
+        return callbacks
+
+    def append(self, pastie_id, content, callback=None):
+        '''
+        Append the content of a pastie to the current segment.
+        Returns the (segment path, offset, length) of the pastie.
+        '''
+        data = compress_member(content, self.compression)
+        callbacks = []
+        with self.lock:
+            if not self.segment or self.segment.tell() >= self.segment_size or self.segment_day != day_directory(self.directory):
+                callbacks = self.open_segment()
+            offset = self.segment.tell()
+            self.segment.write(data)
+            self.index.write(u'{0}\t{1}\t{2}\t{3:.0f}\n'.format(pastie_id, offset, len(data), time.time()).encode('utf8'))
+            location = (self.segment_path, offset, len(data))
+            if callback:
+                self.pending_callbacks.append((callback, location))
+            self.pending_bytes += len(data)
+            if self.pending_bytes >= self.commit_size:
+                callbacks.extend(self.commit_locked())
+        self.run_callbacks(callbacks)
+        return location
+
+    def commit_locked(self):
+        '''
+        Make the pending writes durable. Must be called with the lock held,
+        returns the callbacks to call once the lock is released.
+        '''
+        if self.segment and (self.pending_bytes or self.pending_callbacks):
+            for f in (self.segment, self.index):
+                f.flush()
+                os.fsync(f.fileno())
+            for directory in self.new_directories:
+                fsync_directory(directory)
+            self.new_directories = set()
+        callbacks = self.pending_callbacks
+        self.pending_callbacks = []
+        self.pending_bytes = 0
+        return callbacks
+
+    def commit(self):
+        with self.lock:
+            callbacks = self.commit_locked()
+        self.run_callbacks(callbacks)
+
+    def run_callbacks(self, callbacks):
+        for callback, location in callbacks:
+            try:
+                callback(location)
+            except Exception as e:
+                logger.error('Archive commit callback failed: {e}'.format(e=e))
+                logger.debug(traceback.format_exc())
+
+    def run(self):
+        while not self.kill_received:
+            time.sleep(self.commit_time)
+            self.commit()
+
+
+class ArchiveSegmentReader(object):
+    '''
+    Reads the pasties from the segment files written by ArchiveSegmentWriter,
+    by id through the index files, or sequentially for rescans.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.locations = {}  # pastie id -> (segment path, offset, length)
+        self.indexed = {}  # segment path -> number of bytes of its index file read
+
+    def segments(self):
+        ''' Return the paths of all segments, oldest first. '''
+        paths = []
+        for root, dirs, files in os.walk(self.directory):
+            for filename in files:
+                if filename.endswith('.idx'):
+                    paths.append(os.path.join(root, filename[:-len('.idx')]))
+        return sorted(paths)
+
+    @staticmethod
+    def compression_of(segment_path):
+        for compression, extension in segment_extensions.items():
+            if compression and segment_path.endswith(extension):
+                return compression
+        return None
+
+    @staticmethod
+    def parse_index_line(line):
+        ''' Return the (pastie id, offset, length) of a line of an index file, raises ValueError if it is invalid. '''
+        pastie_id, offset, length, timestamp = line.decode('utf8').rstrip('\n').split('\t')
+        return pastie_id, int(offset), int(length)
+
+    @classmethod
+    def read_index(cls, segment_path):
+        ''' Yield the (pastie id, offset, length) entries of a segment. '''
+        size = os.path.getsize(segment_path)
+        with open(segment_path + '.idx', 'rb') as f:
+            for line in f:
+                try:
+                    pastie_id, offset, length = cls.parse_index_line(line)
+                except ValueError:
+                    continue  # truncated line, for example after a crash
+                if offset + length <= size:
+                    yield pastie_id, offset, length
+
+    def refresh(self):
+        ''' Index the entries added to the segments since the last refresh, and the new segments. '''
+        for segment_path in self.segments():
+            position = self.indexed.get(segment_path, 0)
+            if os.path.getsize(segment_path + '.idx') <= position:
+                continue
+            size = os.path.getsize(segment_path)
+            with open(segment_path + '.idx', 'rb') as f:
+                f.seek(position)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # still being written
+                    try:
+                        pastie_id, offset, length = self.parse_index_line(line)
+                    except ValueError:
+                        position += len(line)
+                        continue
+                    if offset + length > size:
+                        break  # the content is not written yet, or was lost in a crash
+                    self.locations[pastie_id] = (segment_path, offset, length)
+                    position += len(line)
+            self.indexed[segment_path] = position
+
+    def get(self, pastie_id):
+        ''' Return the content of the pastie, or None if it is not in the archive. '''
+        if pastie_id not in self.locations:
+            # the pastie can have been appended since the segments were indexed
+            self.refresh()
+            if pastie_id not in self.locations:
+                return None
+        segment_path, offset, length = self.locations[pastie_id]
+        with open(segment_path, 'rb') as f:
+            f.seek(offset)
+            return decompress_member(f.read(length), self.compression_of(segment_path))
+
+    def iter_pasties(self, segment_path):
+        ''' Yield the (pastie id, content) of a segment, using a memory map of the segment. '''
+        compression = self.compression_of(segment_path)
+        with open(segment_path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for pastie_id, offset, length in self.read_index(segment_path):
+                    yield pastie_id, decompress_member(segment[offset:offset + length], compression)
+            finally:
+                segment.close()
+
+
+archive_writers = {}
+archive_writers_lock = threading.Lock()
+
+
+def get_archive_writer(directory):
+    ''' Return the running ArchiveSegmentWriter of the directory. '''
+    with archive_writers_lock:
+        writer = archive_writers.get(directory)
+        if writer is None:
+            archive_config = yamlconfig['archive']
+            compression = None
+            if archive_config['compress']:
+                compression = archive_config.get('segment-compression', 'gzip')
+                if compression == 'zstd' and not zstandard:
+                    exit('ERROR: Cannot import the zstandard Python library. Are you sure it is installed?')
+            writer = ArchiveSegmentWriter(directory, compression,
+                                          archive_config.get('segment-size', 64 * 1024 * 1024),
+                                          archive_config.get('commit-size', 1024 * 1024),
+                                          archive_config.get('commit-time', 5))
+            writer.setDaemon(True)
+            writer.start()
+            archive_writers[directory] = writer
+    return writer
+
+
 class Pastie():
     def __init__(self, site, pastie_id):
         self.site = site
@@ -235,108 +1571,133 @@ class Pastie():
         self.pastie_content = None
         self.matches = []
         self.md5 = None
-        self.url = self.site.download_url.format(id=self.id)
+        self.content_hash = None
+        self.duplicate_of = None  # "site/id" of the pastie with the same content
+        self.local_path = None  # path of the saved file, or (segment path, offset, length)
+        self.stream_matcher = None  # SearchStream that searched the content while downloading
+        self.url = self.site.download_url.format(id=self.id) if self.site.download_url else None
         self.public = False
+        self.retries = {}  # kind of error -> number of retries, see RetryLater
+        self.metadata = {}  # what the site lists about the pastie, see SiteAdapter
 
     def hash_pastie(self):
         if self.pastie_content:
             try:
-                self.md5 = hashlib.md5(self.pastie_content).hexdigest()
-                logger.debug('Pastie {site} {id} has md5: "{md5}"'.format(site=self.site.name, id=self.id, md5=self.md5))
+                # a streamed download is already hashed
+                if self.content_hash is None:
+                    hasher = new_content_hasher()
+                    hasher.update(self.pastie_content)
+                    self.content_hash = hasher.hexdigest()
+                if content_hash_algorithm() == 'xxhash':
+                    logger.debug('Pastie {site} {id} has xxhash: "{hash}"'.format(site=self.site.name, id=self.id, hash=self.content_hash))
+                else:
+                    self.md5 = self.content_hash
+                    logger.debug('Pastie {site} {id} has md5: "{md5}"'.format(site=self.site.name, id=self.id, md5=self.md5))
             except Exception as e:
                 logger.error('Pastie {site} {id} md5 problem: {e}'.format(site=self.site.name, id=self.id, e=e))
 
     def fetch_pastie(self):
-        response = download_url(self.url)
-        self.pastie_content = response.content
+        self.pastie_content = self.site.adapter.fetch(self)
         return self.pastie_content
 
     def save_pastie(self, directory):
         if not self.pastie_content:
             raise SystemExit('BUG: Content not set, sannot save')
+        if yamlconfig['archive'].get('format') == 'segments':
+            # the pastie is published once the segment is committed
+            callback = self.publish_location if redis_publisher else None
+            location = get_archive_writer(directory).append(self.id, self.pastie_content, callback)
+            if self.local_path is None:
+                self.local_path = location
+            return
         full_path = verify_directory_exists(directory) + os.sep + self.site.pastie_id_to_filename(self.id)
-        if yamlconfig['redis']['queue']:
-            r = redis.StrictRedis(host=yamlconfig['redis']['server'], port=yamlconfig['redis']['port'], db=yamlconfig['redis']['database'])
-        if self.site.archive_compress:
-            f = gzip.open(full_path, 'w')
-            f.write(self.pastie_content.encode('utf8'))
-            f.flush()
-            os.fsync(f.fileno())
-            f.close()
-        else:
-            f = open(full_path, 'w')
-            f.write(self.pastie_content.encode('utf8'))
+        with open(full_path, 'wb') as f:
+            if self.site.archive_compress:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    gz.write(self.pastie_content)
+            else:
+                f.write(self.pastie_content)
             f.flush()
             os.fsync(f.fileno())
-            f.close()
-        if yamlconfig['redis']['queue']:
-            time.sleep(3)
-            r.lpush('pastes', full_path)
-#            with gzip.open(full_path, 'wb') as f:
-#                f.write(self.pastie_content)
-#                if yamlconfig['redis']['queue']:
-#                    r.lpush('pastes', full_path)
-#        else:
-#            with open(full_path, 'wb') as f:
-#                f.write(self.pastie_content)
-#                if yamlconfig['redis']['queue']:
-#                    r.lpush('pastes', full_path)
+        if self.local_path is None:
+            self.local_path = full_path
+        if redis_publisher:
+            # make sure the file is durable before others are told about it
+            fsync_directory(os.path.dirname(full_path))
+            redis_publisher.publish(self, full_path)
+
+    def publish_location(self, location):
+        ''' Publish the (segment path, offset, length) of the saved pastie to Redis. '''
+        redis_publisher.publish(self, u'{0}:{1}:{2}'.format(*location))
 
     def fetch_and_process_pastie(self):
         # double check if the pastie was already downloaded,
         # and remember that we've seen it
         if self.site.seen_pastie(self.id):
             return None
-        # download pastie
-        self.fetch_pastie()
+        # download pastie, unless the adapter of the site already did with others
+        if self.pastie_content is None:
+            start = time.time()
+            self.fetch_pastie()
+            self.count_download(time.time() - start)
+        else:
+            self.count_download(0)
+        return self.process_pastie()
+
+    def count_download(self, seconds):
+        labels = (('site', self.site.name),)
+        stats.observe('pystemon_fetch_seconds', labels, seconds)
+        if self.pastie_content:
+            stats.inc('pystemon_pasties_total', labels)
+            stats.inc('pystemon_downloaded_bytes_total', labels, len(self.pastie_content))
+
+    def process_pastie(self):
         # save the pastie on the disk
         if self.pastie_content:
             # take checksum
             self.hash_pastie()
             # keep in memory that the pastie was seen successfully
             self.site.seen_pastie_and_remember(self)
+            # skip the content we already have, only record it as an alias
+            if deduplicator and self.content_hash:
+                self.duplicate_of = deduplicator.original_of(self)
+                if self.duplicate_of:
+                    logger.info('Pastie {site} {id} has the same content as {original}, skipping it'.format(site=self.site.name, id=self.id, original=self.duplicate_of))
+                    if db:
+                        db.put(self)
+                    return self.pastie_content
             # Save pastie to archive dir if configured
             if yamlconfig['archive']['save-all']:
                 self.save_pastie(self.site.archive_dir)
             # search for data in pastie
             self.search_content()
+            # add / update the pastie in the database
+            if db:
+                db.put(self)
         return self.pastie_content
 
     def search_content(self):
         if not self.pastie_content:
             raise SystemExit('BUG: Content not set, cannot search')
             return False
-        # search for the regexes in the htmlPage
-        for regex in yamlconfig['search']:
-            # LATER first compile regex, then search using compiled version
-            regex_flags = re.IGNORECASE
-            if 'regex-flags' in regex:
-                regex_flags = eval(regex['regex-flags'])
-            m = re.findall(regex['search'].encode(), self.pastie_content, regex_flags)
-            if m:
-                # the regex matches the text
-                # ignore if not enough counts
-                if 'count' in regex and len(m) < int(regex['count']):
-                    continue
-                # ignore if exclude
-                if 'exclude' in regex and re.search(regex['exclude'].encode(), self.pastie_content, regex_flags):
-                    continue
-                # we have a match, add to match list
-                self.matches.append(regex)
-                if 'public' in regex:
-                    self.public = regex['public']
-                else:
-                    self.public = False
+        # search for the regexes in the htmlPage, unless that was done while downloading
+        if self.stream_matcher:
+            self.matches = self.stream_matcher.search(self.pastie_content)
+        else:
+            self.matches = search_engine.search(self.pastie_content)
+        for regex in self.matches:
+            if 'public' in regex:
+                self.public = regex['public']
+            else:
+                self.public = False
         if self.matches:
+            stats.inc('pystemon_matches_total', (('site', self.site.name),))
             self.action_on_match()
 
     def action_on_match(self):
         msg = 'Found hit for {matches} in pastie {url}'.format(
             matches=self.matches_to_text(), url=self.url)
         logger.info(msg)
-        # store info in DB
-        if db:
-            db.queue.put(self)
         # Save pastie to disk if configured
         if yamlconfig['archive']['save']:
             self.save_pastie(self.site.save_dir)
@@ -352,7 +1713,7 @@ class Pastie():
             else:
                 descriptions.append(match['search'])
         if descriptions:
-            return '[{}]'.format(', '.join(descriptions.decode('utf-8', 'ignore')))
+            return u'[{}]'.format(u', '.join(descriptions))
         else:
             return ''
 
@@ -361,26 +1722,21 @@ class Pastie():
         for match in self.matches:
             descriptions.append(match['search'])
         if descriptions:
-            return '[{}]'.format(', '.join(descriptions.decode('utf-8', 'ignore')))
+            return u'[{}]'.format(u', '.join(descriptions))
         else:
             return ''
 
     def send_email_alert(self):
-        msg = MIMEMultipart()
         if self.public:
             alert = "Found hit for {matches} in pastie {url}".format(matches=self.matches_to_text(), url=self.url)
         else:
             alert = "Found hit in pastie {url}".format(url=self.url)
-        # headers
-        msg['Subject'] = yamlconfig['email']['subject'].format(subject=alert)
-        msg['From'] = yamlconfig['email']['from']
         # build the list of recipients
         recipients = []
         recipients.append(yamlconfig['email']['to'])  # first the global alert email
         for match in self.matches:                    # per match, the custom additional email
             if 'to' in match and match['to']:
                 recipients.extend(match['to'].split(","))
-        msg['Bcc'] = ','.join(recipients)  # here the list needs to be comma separated
         # message body including full paste rather than attaching it
         message = '''
 I found a hit for a regular expression on one of the pastebin sites.
@@ -393,22 +1749,443 @@ Below (after newline) is the content of the pastie:
 
 {content}
 
-        '''.format(site=self.site.name, url=self.url, content=self.pastie_content.encode('utf8'))
-        # '''.format(site=self.site.name, url=self.url, matches=self.matches_to_regex(), content=self.pastie_content.encode('utf8'))
-        msg.attach(MIMEText(message))
-        # send out the mail
+        '''.format(site=self.site.name, url=self.url, content=self.pastie_content.decode('utf8', 'replace'))
+        # '''.format(site=self.site.name, url=self.url, matches=self.matches_to_regex(), content=self.pastie_content.decode('utf8', 'replace'))
+        # the email dispatcher sends it, so this thread does not wait for the mail server
+        email_dispatcher.put(recipients, alert, message)
+
+
+class EmailDispatcher(threading.Thread):
+    '''
+    Sends the email alerts from its own thread, so the download threads do
+    not wait for the mail server. The SMTP session is kept open between
+    alerts, reopened when the server closed it, and closed after
+    idle-timeout seconds without alerts.
+    With digest set, the alerts are collected per recipient for that many
+    seconds (or until digest-max alerts) and sent as one mail.
+    The alerts can also be delivered to a local maildir or mbox file.
+    '''
+    def __init__(self, config):
+        threading.Thread.__init__(self)
+        self.kill_received = False
+        self.config = config
+        self.sink = config.get('sink', 'smtp')
+        self.mailbox = None
+        if self.sink == 'maildir':
+            self.mailbox = mailbox.Maildir(config['path'], create=True)
+        elif self.sink == 'mbox':
+            self.mailbox = mailbox.mbox(config['path'])
+        elif self.sink != 'smtp':
+            raise ValueError('Unknown email sink {sink}'.format(sink=self.sink))
+        self.digest_time = config.get('digest', 0)
+        self.digest_size = config.get('digest-max', 50)
+        self.idle_timeout = config.get('idle-timeout', 60)
+        # an alert is [time queued, recipients, subject, body], as JSON so it can spill to disk
+        self.queue = make_sink_queue('email', encode=json.dumps, decode=json.loads)
+        self.lock = threading.RLock()
+        self.smtp = None
+        self.last_used = 0
+        self.digests = OrderedDict()  # recipient -> alerts waiting for the digest
+
+    def put(self, recipients, subject, body):
+        self.queue.put([time.time(), recipients, subject, body])
+
+    def run(self):
+        while not self.kill_received:
+            try:
+                alert = self.queue.get(timeout=1)
+            except Empty:
+                alert = None
+            try:
+                if alert and self.digest_time:
+                    with self.lock:
+                        for recipient in alert[1]:
+                            self.digests.setdefault(recipient, []).append(alert)
+                elif alert:
+                    self.deliver(alert[1], alert[2], alert[3], [alert])
+                self.send_digests()
+                with self.lock:
+                    if self.smtp and time.time() - self.last_used > self.idle_timeout:
+                        self.disconnect()
+            # catch unknown errors
+            except Exception as e:
+                logger.error("Email dispatcher crashed unexpectectly, recovering...: {e}".format(e=e))
+                logger.debug(traceback.format_exc())
+            finally:
+                if alert:
+                    self.queue.task_done()
+
+    def send_digests(self, force=False):
+        ''' Send the digests that are old or large enough, or all of them with force. '''
+        with self.lock:
+            now = time.time()
+            for recipient, alerts in list(self.digests.items()):
+                if force or len(alerts) >= self.digest_size or now - alerts[0][0] >= self.digest_time:
+                    del self.digests[recipient]
+                    if len(alerts) == 1:
+                        self.deliver([recipient], alerts[0][2], alerts[0][3], alerts)
+                        continue
+                    subject = u'{count} hits, the first: {subject}'.format(count=len(alerts), subject=alerts[0][2])
+                    body = u'\n\n'.join(u'==== {subject} ====\n{body}'.format(subject=alert[2], body=alert[3]) for alert in alerts)
+                    self.deliver([recipient], subject, body, alerts)
+
+    def flush(self, deadline=None):
+        ''' Send all the queued alerts and the digests now, or the ones queued until the deadline. '''
+        if deadline is None:
+            self.queue.join()
+        else:
+            drain_queue(self.queue, deadline)
+        self.send_digests(force=True)
+        with self.lock:
+            self.disconnect()
+
+    def deliver(self, recipients, subject, body, alerts):
+        msg = MIMEMultipart()
+        template = self.config['subject']
+        if isinstance(template, bytes):
+            template = template.decode('utf8')  # python 2
+        msg['Subject'] = Header(template.format(subject=subject), 'utf-8')
+        msg['From'] = self.config['from']
+        msg['Bcc'] = ','.join(recipients)  # here the list needs to be comma separated
+        if not isinstance(body, str):
+            body = body.encode('utf8')  # python 2
+        msg.attach(MIMEText(body, 'plain', 'utf-8'))
+        with self.lock:
+            if self.mailbox is not None:
+                self.mailbox.add(msg)
+                self.mailbox.flush()
+                sent = True
+            else:
+                sent = self.send_smtp(recipients, msg)
+        if sent:
+            now = time.time()
+            for alert in alerts:
+                stats.observe('pystemon_sink_lag_seconds', (('sink', 'email'),), now - alert[0])
+
+    def connect(self):
+        self.smtp = smtplib.SMTP(self.config['server'], self.config['port'])
+        # login to the SMTP server if configured
+        if 'username' in self.config and self.config['username']:
+            self.smtp.login(self.config['username'], self.config['password'])
+
+    def disconnect(self):
+        if self.smtp is None:
+            return
         try:
-            s = smtplib.SMTP(yamlconfig['email']['server'], yamlconfig['email']['port'])
-            # login to the SMTP server if configured
-            if 'username' in yamlconfig['email'] and yamlconfig['email']['username']:
-                s.login(yamlconfig['email']['username'], yamlconfig['email']['password'])
-            # send the mail
-            s.sendmail(yamlconfig['email']['from'], recipients, msg.as_string())
-            s.close()
-        except smtplib.SMTPException as e:
-            logger.error("ERROR: unable to send email: {0}".format(e))
-        except Exception as e:
-            logger.error("ERROR: unable to send email. Are your email setting correct?: {e}".format(e=e))
+            self.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self.smtp = None
+
+    def send_smtp(self, recipients, msg):
+        '''
+        Send the mail, reconnecting and waiting for the mail server to come
+        back if needed. Returns False if the mail server refused the mail.
+        '''
+        delay = 1
+        while True:
+            reused = self.smtp is not None
+            try:
+                if self.smtp is None:
+                    self.connect()
+                self.smtp.sendmail(self.config['from'], recipients, msg.as_string())
+                self.last_used = time.time()
+                return True
+            except smtplib.SMTPException as e:
+                if not isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+                    logger.error("ERROR: unable to send email: {0}".format(e))
+                    return False
+                error = e
+            except socket.error as e:
+                error = e
+            self.disconnect()
+            if reused:
+                # the server closed the connection while it was idle, reconnect right away
+                continue
+            if self.kill_received:
+                logger.error("ERROR: unable to send email, giving up: {e}".format(e=error))
+                return False
+            logger.error("ERROR: unable to send email, trying again in {delay} seconds: {e}".format(delay=delay, e=error))
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+def start_email_dispatcher():
+    ''' Start the thread sending the email alerts, if they are enabled. '''
+    global email_dispatcher
+    email_dispatcher = None
+    if not yamlconfig['email']['alert']:
+        return None
+    try:
+        email_dispatcher = EmailDispatcher(yamlconfig['email'])
+    except (ValueError, KeyError) as e:
+        exit('ERROR: Cannot send the email alerts: {e}'.format(e=e))
+    email_dispatcher.setDaemon(True)
+    email_dispatcher.start()
+    return email_dispatcher
+
+
+queue_policies = ('block', 'drop-oldest', 'spill')
+
+
+class BoundedQueue(Queue):
+    '''
+    Queue with a maximum size and a policy for when it is full:
+    block    wait until there is room, so the producer slows down
+    drop-oldest
+             drop the oldest item to make room, on_drop is called with it
+    spill    append the item to a file, the items in the file come back in
+             the queue in order when there is room again, also after a restart.
+             encode and decode turn an item into a line of text and back.
+             The position in the file of the last item taken out of the queue
+             is kept in a second file (.offset), so after a restart the items
+             that were taken out before do not come back.
+    A maxsize of 0 means unbounded, like a normal Queue.
+    '''
+    def __init__(self, name, maxsize=0, policy='block', spill_dir=None, encode=None, decode=None, on_drop=None):
+        Queue.__init__(self, maxsize)
+        if policy not in queue_policies:
+            raise ValueError('Unknown queue policy {policy} for queue {name}'.format(policy=policy, name=name))
+        self.name = name
+        self.policy = policy
+        self.on_drop = on_drop
+        self.encode = encode or (lambda item: item)
+        self.decode = decode or (lambda line: line)
+        self.dropped = 0  # number of items dropped
+        self.spilled = 0  # number of items spilled to disk
+        self.spill_size = 0  # number of items in the spill file now
+        self.spill_writer = None
+        self.spill_reader = None
+        self.spill_offset = None
+        self.spill_ends = deque()  # per item in memory, the end of its line in the spill file, or None
+        self.spill_pending = 0  # number of items read back from the spill file and still in memory
+        if policy == 'spill':
+            if not os.path.exists(spill_dir):
+                os.makedirs(spill_dir)
+            spill_filename = spill_dir + os.sep + name + '.spill'
+            self.spill_writer = open(spill_filename, 'ab')
+            self.spill_reader = open(spill_filename, 'rb')
+            offset_filename = spill_filename + '.offset'
+            self.spill_offset = open(offset_filename, 'r+b' if os.path.exists(offset_filename) else 'w+b')
+            # items spilled before a restart, and not read back yet
+            try:
+                offset = int(self.spill_offset.read().strip() or 0)
+            except ValueError:
+                offset = 0
+            if offset > os.path.getsize(spill_filename):
+                offset = 0  # the spill file was emptied, but the offset not written yet
+            self.spill_reader.seek(offset)
+            for line in self.spill_reader:
+                self.spill_size += 1
+            self.spill_reader.seek(offset)
+            self.unfinished_tasks += self.spill_size
+            if self.spill_size:
+                logger.info('Queue {name} has {count} items spilled to disk'.format(name=name, count=self.spill_size))
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == 'block' or not self.maxsize:
+            return Queue.put(self, item, block, timeout)
+        with self.not_full:
+            if self.spill_size or self._qsize() >= self.maxsize:
+                if self.policy == 'drop-oldest':
+                    oldest = self.queue.popleft()
+                    self.unfinished_tasks -= 1
+                    self.dropped += 1
+                    logger.debug('Queue {name} is full, dropped the oldest item'.format(name=self.name))
+                    if self.on_drop:
+                        self.on_drop(oldest)
+                    self._put(item)
+                else:
+                    self.spill_writer.write(self.encode(item).encode('utf8') + b'\n')
+                    self.spill_writer.flush()
+                    self.spill_size += 1
+                    self.spilled += 1
+            else:
+                self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _qsize(self, len=len):
+        # items in the spill file count, so get() does not wait while there are some
+        return len(self.queue) + self.spill_size
+
+    def _put(self, item):
+        Queue._put(self, item)
+        if self.spill_offset is not None:
+            self.spill_ends.append(None)
+
+    def _get(self):
+        if not self.queue:
+            self.unspill()
+        item = self.queue.popleft()
+        if self.spill_offset is not None:
+            end = self.spill_ends.popleft()
+            if end is not None:
+                self.spill_pending -= 1
+                if not self.spill_size and not self.spill_pending:
+                    # everything is read back and taken out, start with an empty file
+                    self.spill_writer.truncate(0)
+                    self.spill_reader.seek(0)
+                    end = 0
+                self.write_spill_offset(end)
+        if self.spill_size and len(self.queue) < self.maxsize:
+            self.unspill()
+        return item
+
+    def unspill(self):
+        ''' Move the oldest spilled item back into the queue. '''
+        line = self.spill_reader.readline()
+        self.spill_size -= 1
+        self.queue.append(self.decode(line.rstrip(b'\n').decode('utf8')))
+        self.spill_ends.append(self.spill_reader.tell())
+        self.spill_pending += 1
+
+    def write_spill_offset(self, offset):
+        # fixed width, so it is overwritten in place
+        self.spill_offset.seek(0)
+        self.spill_offset.write(u'{0:020d}\n'.format(offset).encode('utf8'))
+        self.spill_offset.flush()
+
+    def depth(self):
+        ''' Return the number of items in the queue, including the spilled ones. '''
+        with self.mutex:
+            return self._qsize()
+
+
+class DownloadJournal(threading.Thread):
+    '''
+    Append-only journal of the pasties of a site waiting for a download, so a
+    restart or a crash does not lose them. An E record is written when a
+    pastie is queued, and an A record when it is done with: downloaded, given
+    up or dropped. At startup the pasties with an E record but no A record are
+    queued again. Writes are made durable (fsync) as a group: every batch_size
+    records, or every batch_time seconds. The journal is compacted at startup,
+    and when most of its records are acknowledged.
+    '''
+    def __init__(self, filename, batch_size=100, batch_time=1):
+        threading.Thread.__init__(self)
+        self.kill_received = False
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_time = batch_time
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # ids of the pasties queued and not acknowledged, oldest first
+        self.records = 0  # number of records in the file
+        self.unsynced = 0  # number of records written since the last fsync
+        self.journal = None
+        if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.load()
+        with self.lock:
+            self.compact_locked()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # torn by a crash while it was written
+                try:
+                    kind, pastie_id = line[:1], json.loads(line[2:].decode('utf8'))
+                except ValueError:
+                    continue
+                if kind == b'E':
+                    self.pending[pastie_id] = True
+                elif kind == b'A':
+                    self.pending.pop(pastie_id, None)
+
+    def compact_locked(self):
+        ''' Rewrite the journal with only the pending pasties. Must be called with the lock held. '''
+        if self.journal:
+            self.journal.close()
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'wb') as f:
+            for pastie_id in self.pending:
+                f.write(b'E ' + json.dumps(pastie_id).encode('utf8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.filename)
+        fsync_directory(os.path.dirname(self.filename) or '.')
+        self.journal = open(self.filename, 'ab')
+        self.records = len(self.pending)
+        self.unsynced = 0
+
+    def replay(self):
+        ''' Return the ids of the pasties that were waiting for a download, oldest first. '''
+        with self.lock:
+            return list(self.pending)
+
+    def write_locked(self, kind, pastie_id):
+        self.journal.write(kind + b' ' + json.dumps(pastie_id).encode('utf8') + b'\n')
+        self.records += 1
+        self.unsynced += 1
+        if self.unsynced >= self.batch_size:
+            self.commit_locked()
+
+    def enqueue(self, pastie_id):
+        with self.lock:
+            if pastie_id not in self.pending:
+                self.pending[pastie_id] = True
+                self.write_locked(b'E', pastie_id)
+
+    def ack(self, pastie_id):
+        with self.lock:
+            if self.pending.pop(pastie_id, None) is None:
+                return
+            self.write_locked(b'A', pastie_id)
+            if self.records > 10000 and self.records > 4 * len(self.pending):
+                self.compact_locked()
+
+    def commit_locked(self):
+        if self.unsynced:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.unsynced = 0
+
+    def commit(self):
+        with self.lock:
+            self.commit_locked()
+
+    def run(self):
+        while not self.kill_received:
+            time.sleep(self.batch_time)
+            self.commit()
+
+
+def make_sink_queue(name, encode=None, decode=None):
+    '''
+    Return the queue of a sink (db, redis) as set in the queues section.
+    Only sinks with an encode and decode function can spill to disk.
+    '''
+    queues_config = yamlconfig.get('queues') or {}
+    queue_config = queues_config.get(name) or {}
+    if queue_config.get('policy') == 'spill' and not encode:
+        raise ValueError('The {name} queue cannot spill to disk'.format(name=name))
+    return BoundedQueue(name,
+                        queue_config.get('size', 0),
+                        queue_config.get('policy', 'block'),
+                        queues_config.get('spill-dir', 'spill'),
+                        encode=encode,
+                        decode=decode)
+
+
+def queue_stats():
+    '''
+    Return the depth, number of dropped and number of spilled items
+    of the download and sink queues, by name.
+    '''
+    stats = {}
+    all_queues = [('download/' + name, queue) for name, queue in queues.items()]
+    if db:
+        all_queues.append(('db', db.queue))
+    if redis_publisher:
+        all_queues.append(('redis', redis_publisher.queue))
+    if email_dispatcher:
+        all_queues.append(('email', email_dispatcher.queue))
+    for name, queue in all_queues:
+        stats[name] = (queue.depth(), queue.dropped, queue.spilled)
+    return stats
 
 
 class ThreadPasties(threading.Thread):
@@ -424,9 +2201,12 @@ class ThreadPasties(threading.Thread):
 
     def run(self):
         while not self.kill_received:
+            # grabs pastie from queue
+            try:
+                pastie = self.queue.get(timeout=1)
+            except Empty:
+                continue
             try:
-                # grabs pastie from queue
-                pastie = self.queue.get()
                 pastie_content = pastie.fetch_and_process_pastie()
                 logger.debug("Queue {name} size: {size}".format(
                     size=self.queue.qsize(), name=self.name))
@@ -437,23 +2217,57 @@ class ThreadPasties(threading.Thread):
                 else:
                     # pastie already downloaded OR error ?
                     pass
-                # signals to queue job is done
-                self.queue.task_done()
+                pastie.site.done(pastie.id)
+            except RetryLater as e:
+                # the retry scheduler puts the pastie back in the queue later
+                if not retry_scheduler.schedule(pastie, self.queue, e.kind):
+                    pastie.site.done(pastie.id, downloaded=False)
             # catch unknown errors
             except Exception as e:
+                pastie.site.done(pastie.id, downloaded=False)
                 msg = "ThreadPasties for {name} crashed unexpectectly, "\
                       "recovering...: {e}".format(name=self.name, e=e)
                 logger.error(msg)
                 logger.debug(traceback.format_exc())
+            # signals to queue job is done
+            self.queue.task_done()
 
 
-def main():
+def main(show_stats=False):
     global queues
     global threads
     global db
+    global retry_scheduler
+    global search_engine
+    global redis_publisher
+    global deduplicator
+    global email_dispatcher
+    global cluster
     queues = {}
     threads = []
 
+    # recognize pasties with content we already have
+    deduplicator = None
+    if (yamlconfig.get('dedup') or {}).get('enable'):
+        deduplicator = ContentDeduplicator(yamlconfig['dedup'])
+
+    # start the search processes before any thread, as they are forked
+    matching_config = yamlconfig.get('matching') or {}
+    if matching_config.get('processes'):
+        search_engine = SearchPool(yamlconfig['search'],
+                                   matching_config['processes'],
+                                   matching_config.get('shared-memory', 65536))
+    if matching_config.get('rule-budget'):
+        search_engine.set_budget(matching_config['rule-budget'],
+                                 matching_config.get('quarantine-after', 3),
+                                 matching_config.get('quarantine-time', 3600))
+
+    # start a thread to put failed pasties back in the queues
+    retry_scheduler = RetryScheduler()
+    retry_scheduler.setDaemon(True)
+    threads.append(retry_scheduler)
+    retry_scheduler.start()
+
     # start a thread to handle the DB data
     db = None
     if yamlconfig['db'] and yamlconfig['db']['sqlite3'] and yamlconfig['db']['sqlite3']['enable']:
@@ -462,10 +2276,29 @@ def main():
             import sqlite3
         except Exception as exc:
             exit('ERROR: Cannot import the sqlite3 Python library. Are you sure it is compiled in python?')
-        db = Sqlite3Database(yamlconfig['db']['sqlite3']['file'])
+        try:
+            db = Sqlite3Database(yamlconfig['db']['sqlite3']['file'],
+                                 yamlconfig['db']['sqlite3'].get('batch-size', 500),
+                                 yamlconfig['db']['sqlite3'].get('batch-time', 1))
+        except ValueError as e:
+            exit('ERROR: {e}'.format(e=e))
         db.setDaemon(True)
         threads.append(db)
         db.start()
+    # start a thread to send the email alerts
+    email_dispatcher = start_email_dispatcher()
+    if email_dispatcher:
+        threads.append(email_dispatcher)
+    # start a thread to publish the saved pasties to Redis
+    redis_publisher = None
+    if yamlconfig['redis']['queue']:
+        try:
+            redis_publisher = RedisPublisher(yamlconfig['redis'])
+        except ValueError as e:
+            exit('ERROR: {e}'.format(e=e))
+        redis_publisher.setDaemon(True)
+        threads.append(redis_publisher)
+        redis_publisher.start()
     # test()
     # Build array of enabled sites.
     sites_enabled = []
@@ -477,42 +2310,385 @@ def main():
             print("Site: {} is disabled.".format(site))
         else:
             print("Site: {} is not enabled or disabled in config file. We just assume it disabled.".format(site))
+    # build the PastieSite objects that download the last pasties
+    sites = [create_pastie_site(site_name) for site_name in sites_enabled]
+
+    # share the sites and the pasties with the other nodes of the cluster
+    cluster_config = yamlconfig.get('cluster') or {}
+    if cluster_config.get('enable'):
+        config = dict(yamlconfig['redis'])
+        config.update(cluster_config)
+        try:
+            cluster = Cluster(config, sites)
+        except redis.RedisError as e:
+            exit('ERROR: Cannot join the cluster: {e}'.format(e=e))
+        logger.info('Joined the cluster as node {node}, {nb} nodes are live.'.format(node=cluster.node, nb=cluster.live_nodes))
+        cluster.setDaemon(True)
+        threads.append(cluster)
+        cluster.start()
+
+    # keep the pasties waiting for a download across restarts
+    journal_config = (yamlconfig.get('queues') or {}).get('journal') or {}
+    if journal_config.get('enable'):
+        for site in sites:
+            site.journal = DownloadJournal(journal_config.get('dir', 'journal') + os.sep + site.name + '.journal',
+                                           journal_config.get('batch-size', 100),
+                                           journal_config.get('batch-time', 1))
+            site.journal.setDaemon(True)
+            threads.append(site.journal)
+            site.journal.start()
+
+    # serve and log the statistics
+    stats_config = yamlconfig.get('stats') or {}
+    if show_stats or stats_config.get('enable'):
+        try:
+            stats_reporter = StatsReporter(stats_config, sites)
+        except socket.error as e:
+            exit('ERROR: Cannot serve the statistics on port {port}: {e}'.format(port=stats_config.get('port'), e=e))
+        stats_reporter.setDaemon(True)
+        threads.append(stats_reporter)
+        stats_reporter.start()
+
+    # stop gracefully on Ctrl-C and SIGTERM, see shutdown()
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+    if yamlconfig.get('engine', 'threads') == 'async':
+        # the async engine module imports this module to share its configuration and pipeline
+        sys.modules.setdefault('pystemon', sys.modules[__name__])
+        try:
+            import pystemon_async
+        except (ImportError, SyntaxError) as e:
+            exit('ERROR: The async engine needs python 3 and the aiohttp library: {e}'.format(e=e))
+        # returns once the queued downloads are done after a signal, or the deadline passed
+        pystemon_async.run(sites)
+        signal.signal(signal.SIGINT, request_shutdown)
+        shutdown(sites, [])
+        exit(0)
+
     # spawn a pool of threads per PastieSite, and pass them a queue instance
-    for site in sites_enabled:
-        queues[site] = Queue()
-        for i in range(yamlconfig['threads']):
-            t = ThreadPasties(queues[site], site)
+    workers = []
+    for site in sites:
+        try:
+            queues[site.name] = site.make_queue()
+        except ValueError as e:
+            exit('ERROR: {e}'.format(e=e))
+        for i in range(site.threads):
+            t = ThreadPasties(queues[site.name], site.name)
             t.setDaemon(True)
             threads.append(t)
+            workers.append(t)
             t.start()
+        if site.journal:
+            for pastie in site.replay_journal():
+                queues[site.name].put(pastie)
 
-    # build threads to download the last pasties
-    for site_name in sites_enabled:
-        t = PastieSite(site_name,
-                       yamlconfig['site'][site_name]['download-url'],
-                       yamlconfig['site'][site_name]['archive-url'],
-                       yamlconfig['site'][site_name]['archive-regex'])
-        if 'update-min' in yamlconfig['site'][site_name] and yamlconfig['site'][site_name]['update-min']:
-            t.update_min = yamlconfig['site'][site_name]['update-min']
-        if 'update-max' in yamlconfig['site'][site_name] and yamlconfig['site'][site_name]['update-max']:
-            t.update_max = yamlconfig['site'][site_name]['update-max']
-        if 'pastie-classname' in yamlconfig['site'][site_name] and yamlconfig['site'][site_name]['pastie-classname']:
-            t.pastie_classname = yamlconfig['site'][site_name]['pastie-classname']
+    # start the threads to download the last pasties
+    for t in sites:
         threads.append(t)
         t.setDaemon(True)
         t.start()
 
-    # wait while all the threads are running and someone sends CTRL+C
-    while True:
-        try:
-            for t in threads:
-                t.join(1)
-        except KeyboardInterrupt:
-            print('')
-            print("Ctrl-c received! Sending kill to threads...")
-            for t in threads:
-                t.kill_received = True
-            exit(0)  # quit immediately
+    # wait while all the threads are running and someone sends CTRL+C or SIGTERM
+    while not shutting_down.wait(1):
+        pass
+    shutdown(sites, workers)
+    for t in threads:
+        t.kill_received = True
+    exit(0)
+
+
+shutting_down = threading.Event()  # set by Ctrl-C or SIGTERM, wakes up the waiting threads
+shutdown_deadline = None  # time by which the shutdown is over, even with work left
+
+
+def request_shutdown(signum, frame):
+    ''' Handler of SIGINT and SIGTERM: the first signal stops gracefully, the second one at once. '''
+    global shutdown_deadline
+    if shutting_down.is_set():
+        print("Stopping at once, the queued pasties and alerts that are not written yet are lost.")
+        kill_children()
+        os._exit(1)
+    print('')
+    print("{signal} received! Finishing the queued work, send it again to stop at once...".format(signal='Ctrl-c' if signum == signal.SIGINT else 'SIGTERM'))
+    shutdown_deadline = time.time() + (yamlconfig.get('shutdown') or {}).get('deadline', 30)
+    shutting_down.set()
+
+
+def drain_queue(queue, deadline):
+    '''
+    Wait until all the items of the queue are processed, or until the
+    deadline. Returns the number of items left.
+    '''
+    while queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.1)
+    return queue.unfinished_tasks
+
+
+def release_pending(sites):
+    '''
+    Give the claims of the pasties that are not downloaded by the shutdown
+    back to the cluster, so another node downloads them. The pasties in the
+    journal are downloaded by this node after the restart.
+    '''
+    if not cluster:
+        return
+    for site in sites:
+        if not site.journal:
+            for pastie_id in list(site.pending):
+                cluster.release(site.name, pastie_id)
+
+
+def shutdown(sites, workers):
+    '''
+    Stop without losing work, before the shutdown deadline: stop polling the
+    sites and give them to the other nodes of the cluster, finish the queued
+    downloads, then write out the database, Redis and email queues and the
+    archive, and close the seen indexes. The pasties that are not downloaded
+    by the deadline stay in the journal if it is enabled, otherwise they are
+    left to the other nodes of the cluster.
+    '''
+    deadline = shutdown_deadline or time.time()
+    # no new pasties
+    for site in sites:
+        site.kill_received = True
+    if retry_scheduler:
+        retry_scheduler.kill_received = True
+    if cluster:
+        cluster.kill_received = True
+        cluster.leave()
+    # finish the downloads
+    left = sum(drain_queue(queue, deadline) for queue in queues.values())
+    waiting = retry_scheduler.qsize() if retry_scheduler else 0
+    for t in workers:
+        t.kill_received = True
+    for t in workers:
+        t.join(max(deadline - time.time(), 0))
+    if isinstance(search_engine, SearchPool):
+        search_engine.stop(deadline)
+    if left or waiting:
+        kept = any(site.journal for site in sites)
+        logger.warning("{left} queued pasties and {waiting} pasties waiting for a retry are not downloaded{kept}.".format(
+            left=left, waiting=waiting, kept=', they are kept in the journal' if kept else ''))
+    release_pending(sites)
+    # write out the sinks, the archive first as the segments are published to Redis once committed
+    for writer in list(archive_writers.values()):
+        writer.commit()
+    for name, sink in (('database', db), ('Redis', redis_publisher), ('email', email_dispatcher)):
+        if sink:
+            left = drain_queue(sink.queue, deadline)
+            if left:
+                logger.warning("{left} items of the {name} queue are not written.".format(left=left, name=name))
+            sink.kill_received = True
+            sink.join(max(deadline - time.time(), 0))
+    if email_dispatcher:
+        # the digests that are not due yet
+        email_dispatcher.flush(deadline)
+    for site in sites:
+        if site.journal:
+            site.journal.commit()
+        site.seen_pasties.close()
+    if deduplicator:
+        deduplicator.index.close()
+    log_slowest_rules()
+    logger.info("Stopped.")
+
+
+def rule_fingerprint(rule):
+    ''' Identify a search rule, a changed rule gets another fingerprint. '''
+    return hashlib.sha1(json.dumps(rule, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def iter_archive(directory):
+    '''
+    Yield the archived files and segments of all sites as (site name, kind, path),
+    kind being 'file' or 'segment'.
+    '''
+    if not os.path.isdir(directory):
+        return
+    for site_name in sorted(os.listdir(directory)):
+        site_dir = directory + os.sep + site_name
+        if not os.path.isdir(site_dir):
+            continue
+        for root, dirs, files in os.walk(site_dir):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.endswith('.idx'):
+                    yield site_name, 'segment', os.path.join(root, filename[:-len('.idx')])
+                elif not filename.endswith(tuple(segment_extensions.values())):
+                    yield site_name, 'file', os.path.join(root, filename)
+
+
+def rescan_init(rules):
+    ''' Build the search engine with the rules to rescan in a process of the rescan pool. '''
+    global search_engine
+    # CTRL+C and SIGTERM are handled by the main process, which stops the pool, see stop_pool()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    search_engine = SearchEngine(rules)
+
+
+def open_archived(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def rescan_file(path, chunk_size=65536):
+    '''
+    Search an archived file in chunks, so a large file is not read in memory
+    at once. It is read whole only for the search rules that cannot be
+    matched on the chunks (see SearchStream), or when it matched, for the
+    actions on the hit. Returns the content, or None, and the rule positions.
+    '''
+    matcher = search_engine.stream()
+    chunks = [] if matcher.whole else None
+    with open_archived(path) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            matcher.feed(chunk)
+            if chunks is not None:
+                chunks.append(chunk)
+    content = b''.join(chunks) if chunks is not None else None
+    indexes = matcher.search_indexes(content)
+    if indexes and content is None:
+        with open_archived(path) as f:
+            content = f.read()
+    return content, indexes
+
+
+def rescan_unit(unit):
+    '''
+    Search an archived file or segment in a process of the rescan pool.
+    Returns the number of pasties searched, the hits as
+    (site name, pastie id, path, content, rule positions), and whether
+    the file or segment could be read completely.
+    '''
+    site_name, kind, path = unit
+    count = 0
+    hits = []
+    try:
+        if kind == 'segment':
+            pasties = ArchiveSegmentReader(os.path.dirname(path)).iter_pasties(path)
+            for pastie_id, content in pasties:
+                count += 1
+                indexes = search_engine.search_indexes(content)
+                if indexes:
+                    hits.append((site_name, pastie_id, path, content, indexes))
+        else:
+            pastie_id = os.path.basename(path)
+            if pastie_id.endswith('.gz'):
+                pastie_id = pastie_id[:-len('.gz')]
+            content, indexes = rescan_file(path)
+            count += 1
+            if indexes:
+                hits.append((site_name, pastie_id, path, content, indexes))
+    except (IOError, OSError, EOFError, zlib.error) as e:
+        logger.error('Cannot read archived pasties from {path}: {e}'.format(path=path, e=e))
+        return count, hits, False
+    return count, hits, True
+
+
+def rescan(all_rules=False):
+    '''
+    Search the archived pasties (archive/dir-all) again, for the search rules
+    that are new or changed since the previous rescan, or for all rules.
+    Hits go through the same actions as new pasties (save, email alert).
+    '''
+    global db
+    global redis_publisher
+    db = None
+    redis_publisher = None
+    archive_dir = yamlconfig['archive']['dir-all']
+    checkpoint_file = yamlconfig['archive'].get('rescan-checkpoint') or archive_dir + os.sep + 'rescan-checkpoint.json'
+    fingerprints = [rule_fingerprint(rule) for rule in yamlconfig['search']]
+    known = set()
+    if not all_rules and os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'rb') as f:
+            known = set(json.loads(f.read().decode('utf8'))['rules'])
+    rules = [rule for rule, fingerprint in zip(yamlconfig['search'], fingerprints) if fingerprint not in known]
+    if not rules:
+        logger.info('No new or changed search rules since the last rescan.')
+        return
+    logger.info('Rescanning the archive {dir} for {count} search rules'.format(dir=archive_dir, count=len(rules)))
+    processes = (yamlconfig.get('matching') or {}).get('processes') or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, rescan_init, (rules,))
+    start_email_dispatcher()
+    sites = {}
+    scanned = 0
+    found = 0
+    failed = 0
+    started = time.time()
+    try:
+        for count, hits, complete in pool.imap_unordered(rescan_unit, iter_archive(archive_dir), chunksize=16):
+            scanned += count
+            if not complete:
+                failed += 1
+            for site_name, pastie_id, path, content, indexes in hits:
+                found += 1
+                if site_name not in sites:
+                    sites[site_name] = create_pastie_site(site_name) if site_name in yamlconfig['site'] else None
+                if not sites[site_name]:
+                    logger.info('Found hit for {matches} in archived pastie {site} {id} ({path})'.format(
+                        matches=[rules[index].get('description') or rules[index]['search'] for index in indexes],
+                        site=site_name, id=pastie_id, path=path))
+                    continue
+                pastie = Pastie(sites[site_name], pastie_id)
+                pastie.pastie_content = content
+                pastie.matches = [rules[index] for index in indexes]
+                pastie.public = pastie.matches[-1].get('public', False)
+                pastie.action_on_match()
+    finally:
+        stop_pool(pool, time.time() + (yamlconfig.get('shutdown') or {}).get('deadline', 30))
+        for writer in archive_writers.values():
+            writer.commit()
+        if email_dispatcher:
+            email_dispatcher.flush()
+    logger.info('Rescanned {count} pasties in {time:.0f} seconds, {found} hits.'.format(count=scanned, time=time.time() - started, found=found))
+    if failed:
+        # the next rescan searches the archive for these rules again
+        logger.warning('{failed} archived files or segments could not be read, the rescan checkpoint is not updated.'.format(failed=failed))
+        return
+    with open(checkpoint_file, 'wb') as f:
+        f.write(json.dumps({'rules': fingerprints, 'timestamp': time.time()}).encode('utf8'))
+
+
+def create_pastie_site(site_name):
+    site_config = yamlconfig['site'][site_name]
+    site = PastieSite(site_name,
+                      site_config.get('download-url'),
+                      site_config.get('archive-url'),
+                      site_config.get('archive-regex'))
+    if 'update-min' in site_config and site_config['update-min']:
+        site.update_min = site_config['update-min']
+    if 'update-max' in site_config and site_config['update-max']:
+        site.update_max = site_config['update-max']
+    if 'pastie-classname' in site_config and site_config['pastie-classname']:
+        site.pastie_classname = site_config['pastie-classname']
+    if 'threads' in site_config and site_config['threads']:
+        site.threads = site_config['threads']
+    if 'retry' in site_config and site_config['retry']:
+        site.retry.update(site_config['retry'])
+    if 'stream' in site_config:
+        site.stream = site_config['stream']
+    if 'max-size' in site_config:
+        site.max_size = site_config['max-size']
+    if 'queue' in site_config and site_config['queue']:
+        site.queue_config = site_config['queue']
+    if 'rate-limit' in site_config and site_config['rate-limit']:
+        rate_config = dict(yamlconfig.get('rate-limit') or {})
+        rate_config.update(site_config['rate-limit'])
+        site.rate_limiter = RateLimiter(site_name, rate_config)
+    rate_limiters[site_name] = site.rate_limiter
+    try:
+        site.adapter = load_site_adapter(site_config.get('adapter') or 'regex')(site, site_config)
+    except ValueError as e:
+        exit('ERROR: {e} for site {site}'.format(e=e, site=site_name))
+    if isinstance(site.adapter, RegexAdapter) and not site.archive_regex:
+        exit('ERROR: Missing archive-regex for site {site}'.format(site=site_name))
+    return site
 
 
 user_agents_list = []
@@ -532,260 +2708,1070 @@ def load_user_agents_from_file(filename):
 
 
 def get_random_user_agent():
-    global proxies_list
     if user_agents_list:
         return random.choice(user_agents_list)
     return None
 
 
-proxies_failed = []
-proxies_lock = threading.Lock()
-proxies_list = []
+class Proxy(object):
+    ''' Health of a proxy: success rate and latency, and its circuit breaker. '''
+    def __init__(self, url):
+        self.url = url
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None  # moving average of the download time, in seconds
+        self.open_until = 0  # the proxy is not used before this time
+        self.recovery = 0  # seconds of the last time the circuit was opened
 
+    def score(self):
+        ''' Higher is better: the success rate divided by the latency. '''
+        # a new proxy starts with the benefit of the doubt
+        success_rate = (self.successes + 1.0) / (self.successes + self.failures + 1.0)
+        return success_rate / (self.latency or 1.0)
 
-def load_proxies_from_file(filename):
-    global proxies_list
-    try:
-        f = open(filename)
-    except Exception as e:
-        logger.error('Configuration problem: proxyfile "{file}" not found or not readable: {e}'.format(file=filename, e=e))
-    for line in f:
-        line = line.strip()
-        if line:  # LATER verify if the proxy line has the correct structure
-            proxies_list.append(line)
-    logger.debug('Found {count} proxies in file "{file}"'.format(file=filename, count=len(proxies_list)))
 
+class RandomSet(object):
+    '''
+    A set that returns a random item in constant time: the items are kept
+    in a list, with their position in a dict. A removed item is replaced by
+    the last item of the list.
+    '''
+    def __init__(self, items=()):
+        self.items = []
+        self.positions = {}
+        for item in items:
+            self.add(item)
 
-def get_random_proxy():
-    global proxies_list
-    proxy = None
-    proxies_lock.acquire()
-    if proxies_list:
-        proxy = random.choice(proxies_list)
-    proxies_lock.release()
-    return proxy
+    def __len__(self):
+        return len(self.items)
 
+    def __contains__(self, item):
+        return item in self.positions
 
-def failed_proxy(proxy):
-    proxies_failed.append(proxy)
-    if proxies_failed.count(proxy) >= 2 and proxies_list.count(proxy) >= 1:
-        logger.info("Removing proxy {0} from proxy list because of to many errors errors.".format(proxy))
-        proxies_lock.acquire()
-        proxies_list.remove(proxy)
-        proxies_lock.release()
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
 
+    def remove(self, item):
+        position = self.positions.pop(item)
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
 
-class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    def choice(self):
+        return random.choice(self.items)
+
+
+class ProxyPool(object):
     '''
-    This class is only necessary to not follow HTTP redirects in webpages.
-    It is used by the download_url() function
+    The proxies of the proxy file. A proxy is chosen with the power of two
+    choices: the best scoring of two random proxies, so the fast and reliable
+    proxies get most downloads without sorting on every request.
+    After failures consecutive failures a proxy is taken out for recovery
+    seconds. When it comes back, one failure takes it out again for twice
+    as long, up to max-recovery, and one success puts it back in full use.
+    The file is reloaded when it changed, every reload seconds.
     '''
-    def http_error_302(self, req, fp, code, msg, headers):
-        infourl = urllib2.addinfourl(fp, headers, req.get_full_url())
-        infourl.status = code
-        infourl.code = code
-        return infourl
-    http_error_301 = http_error_303 = http_error_307 = http_error_302
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.proxies = {}  # url -> Proxy
+        self.closed = RandomSet()  # the proxies in use
+        self.opened = []  # heap of (open until, url) of the proxies taken out
+        self.filename = None
+        self.mtime = None
+        self.next_check = 0
+        self.reload_interval = 60
+        self.max_failures = 2
+        self.min_recovery = 300
+        self.max_recovery = 3600
+
+    def configure(self, config):
+        self.filename = config['file']
+        self.reload_interval = config.get('reload', 60)
+        self.max_failures = config.get('failures', 2)
+        self.min_recovery = config.get('recovery', 300)
+        self.max_recovery = config.get('max-recovery', 3600)
+        self.load()
+
+    def load(self):
+        ''' (Re)load the proxy file, keeping the health of the known proxies. '''
+        try:
+            self.mtime = os.stat(self.filename).st_mtime
+            with open(self.filename) as f:
+                urls = [line.strip() for line in f if line.strip()]  # LATER verify if the proxy line has the correct structure
+        except (IOError, OSError) as e:
+            logger.error('Configuration problem: proxyfile "{file}" not found or not readable: {e}'.format(file=self.filename, e=e))
+            return
+        with self.lock:
+            self.proxies = dict((url, self.proxies.get(url) or Proxy(url)) for url in urls)
+            now = time.time()
+            self.closed = RandomSet(proxy for proxy in self.proxies.values() if proxy.open_until <= now)
+            self.opened = [(proxy.open_until, proxy.url) for proxy in self.proxies.values() if proxy.open_until > now]
+            heapq.heapify(self.opened)
+        logger.debug('Found {count} proxies in file "{file}"'.format(file=self.filename, count=len(urls)))
+
+    def check_file(self, now):
+        self.next_check = now + self.reload_interval
+        try:
+            mtime = os.stat(self.filename).st_mtime
+        except OSError:
+            return
+        if mtime != self.mtime:
+            logger.info('Proxy file "{file}" changed, reloading it'.format(file=self.filename))
+            self.load()
+
+    def choose(self):
+        ''' Return the url of the proxy to use for a download, or None. '''
+        now = time.time()
+        if self.filename and now >= self.next_check:
+            self.check_file(now)
+        with self.lock:
+            # proxies whose recovery time is over get a new chance
+            while self.opened and self.opened[0][0] <= now:
+                open_until, url = heapq.heappop(self.opened)
+                self.closed.add(self.proxies[url])
+                logger.info('Trying proxy {0} again'.format(url))
+            if not self.closed:
+                if not self.opened:
+                    return None
+                # all proxies are out, use the one that comes back first
+                return self.opened[0][1]
+            first = self.closed.choice()
+            second = self.closed.choice()
+            return (first if first.score() >= second.score() else second).url
+
+    def success(self, url, seconds):
+        with self.lock:
+            proxy = self.proxies.get(url)
+            if proxy is None:
+                return
+            proxy.successes += 1
+            proxy.consecutive_failures = 0
+            proxy.recovery = 0
+            proxy.latency = seconds if proxy.latency is None else 0.8 * proxy.latency + 0.2 * seconds
+
+    def failure(self, url):
+        with self.lock:
+            proxy = self.proxies.get(url)
+            if proxy is None:
+                return
+            proxy.failures += 1
+            proxy.consecutive_failures += 1
+            if proxy not in self.closed:
+                return
+            # a proxy that came back is taken out again at its first failure
+            if proxy.consecutive_failures < self.max_failures and not proxy.recovery:
+                return
+            proxy.recovery = min(self.max_recovery, proxy.recovery * 2 or self.min_recovery)
+            proxy.open_until = time.time() + proxy.recovery
+            proxy.consecutive_failures = 0
+            self.closed.remove(proxy)
+            heapq.heappush(self.opened, (proxy.open_until, proxy.url))
+        logger.info("Not using proxy {0} for {1} seconds because of too many errors.".format(url, proxy.recovery))
+
+    def counts(self):
+        ''' Return the number of proxies in use and taken out. '''
+        with self.lock:
+            return len(self.closed), len(self.opened)
+
+
+proxy_pool = ProxyPool()
 
 
-class TLS1Connection(httplib.HTTPSConnection):
-    """Like HTTPSConnection but more specific"""
-    def __init__(self, host, **kwargs):
-        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+def get_random_proxy():
+    return proxy_pool.choose()
 
-    def connect(self):
-        """Overrides HTTPSConnection.connect to specify TLS version"""
-        # Standard implementation from HTTPSConnection, which is not
-        # designed for extension, unfortunately
-        sock = socket.create_connection(
-            (self.host, self.port),
-            self.timeout, self.source_address)
-        if getattr(self, '_tunnel_host', None):
-            self.sock = sock
-            self._tunnel()
-
-        # This is the only difference; default wrap_socket uses SSLv23
-        self.sock = ssl.wrap_socket(
-            sock, self.key_file, self.cert_file,
-            ssl_version=ssl.PROTOCOL_TLSv1)
-
-
-class TLS1Handler(urllib2.HTTPSHandler):
-    """Like HTTPSHandler but more specific"""
-    def __init__(self):
-        urllib2.HTTPSHandler.__init__(self)
 
-    def https_open(self, req):
-        return self.do_open(TLS1Connection, req)
+def failed_proxy(proxy):
+    if proxy:
+        stats.inc('pystemon_proxy_failures_total', (('proxy', proxy),))
+        proxy_pool.failure(proxy)
 
 
-def download_url(url, data=None, cookie=None, loop_client=0, loop_server=0, loop_paste=0):
-    # Client errors (40x): if more than 5 recursions, give up on URL (used for the 404 case)
-    if loop_client >= retries_client:
-        return None
-    # Server errors (50x): if more than 100 recursions, give up on URL
-    if loop_server >= retries_server:
-        return None
+def succeeded_proxy(proxy, seconds):
+    if proxy:
+        proxy_pool.success(proxy, seconds)
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(url, proxy, threads=None):
+    '''
+    Return the HTTP session for the site of the url and the proxy.
+    Sessions live as long as the process, so connections are kept alive
+    and reused between downloads. The connection pool has room for the
+    threads of the site, and the thread that downloads its list of pasties.
+    '''
+    key = (urlparse(url).netloc, proxy)
+    with sessions_lock:
+        session = sessions.get(key)
+        if session is None:
+            pool_size = (yamlconfig.get('network') or {}).get('pool-size') or (threads or yamlconfig['threads']) + 1
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if proxy:
+                session.proxies = {'http': proxy, 'https': proxy}
+            sessions[key] = session
+    return session
+
+
+class TokenBucket(object):
+    '''
+    Allows rate requests per second on average, and bursts of up to burst
+    requests. Requests that come too soon reserve a token in advance, so
+    they are served in order.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def reserve(self, now):
+        ''' Take a token, and return the number of seconds to wait before it is available. '''
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class RateLimiter(object):
+    '''
+    Limits the requests to a site, of the pollers and of the download threads
+    together, with a token bucket per site (or per site and proxy). The rate
+    adapts to the site: it grows a little after every successful request up to
+    max-rate, and is cut down when the site asks to slow down (additive
+    increase, multiplicative decrease), so it settles just below the rate the
+    site tolerates.
+    '''
+    def __init__(self, name, config):
+        self.name = name
+        self.lock = threading.Lock()
+        self.rate = float(config.get('rate', 0))  # requests per second, 0 is no limit
+        self.burst = config.get('burst', 5)
+        self.min_rate = config.get('min-rate', 0.1)
+        self.max_rate = config.get('max-rate') or self.rate
+        self.increase = config.get('increase', 0.05)  # requests per second added per second at full rate
+        self.decrease = config.get('decrease', 0.5)
+        self.per_proxy = config.get('per-proxy', False)
+        self.buckets = {}  # proxy, or None -> TokenBucket
+        self.slowdowns = 0
+
+    def bucket(self, proxy):
+        key = proxy if self.per_proxy else None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def reserve(self, proxy=None):
+        ''' Return the number of seconds to wait before sending a request. '''
+        if not self.rate:
+            return 0
+        with self.lock:
+            return self.bucket(proxy).reserve(time.time())
+
+    def acquire(self, proxy=None):
+        delay = self.reserve(proxy)
+        if delay:
+            time.sleep(delay)
+
+    def success(self, proxy=None):
+        if not self.rate:
+            return
+        with self.lock:
+            bucket = self.bucket(proxy)
+            if bucket.rate >= self.max_rate:
+                return
+            # one increase per second when the requests come at the full rate
+            bucket.rate = min(self.max_rate, bucket.rate + self.increase / bucket.rate)
+
+    def slowdown(self, proxy=None):
+        ''' The site asked to slow down: lower the rate, and pause until the bucket refills. '''
+        if not self.rate:
+            return
+        with self.lock:
+            self.slowdowns += 1
+            bucket = self.bucket(proxy)
+            bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+            bucket.tokens = min(bucket.tokens, 0)
+        logger.warning('Slowing down to {rate:.2f} requests per second for {name}'.format(rate=bucket.rate, name=self.name))
+
+    def rates(self):
+        ''' Return the current rate per proxy (None without per-proxy). '''
+        with self.lock:
+            return dict((key, bucket.rate) for key, bucket in self.buckets.items())
+
+
+rate_limiters = {}  # site name -> RateLimiter
+
+
+class RetryLater(Exception):
+    '''
+    Raised by download_url() when the download failed but should be tried
+    again later. The kind is the class of the error, each kind has its own
+    retry budget: client (404), server (500, 502, 504), slowdown (429, or the
+    site asks to slow down), network (timeouts, proxy errors) and notready
+    (the pastie is not ready for scraping yet).
+    '''
+    def __init__(self, url, kind):
+        Exception.__init__(self, '{kind} error for {url}'.format(kind=kind, url=url))
+        self.url = url
+        self.kind = kind
 
-    session = requests.Session()
+
+def classify_response(status_code, text):
+    '''
+    Return None if the response can be used, the kind of retry (see RetryLater)
+    if the download should be tried again later, or 'error' if it is useless
+    to try again.
+    '''
+    if 404 == status_code:
+        return 'client'
+    if 429 == status_code:
+        return 'slowdown'
+    if status_code in (500, 502, 504):
+        return 'server'
+    if 403 == status_code and ('Please slow down' in text or 'has temporarily blocked your computer' in text or 'blocked' in text):
+        return 'slowdown'
+    if status_code >= 400:
+        return 'error'
+    if 'File is not ready for scraping yet. Try again in 1 minute.' in text:
+        return 'notready'
+    return None
+
+
+def download_url(url, data=None, cookie=None, stream=False, headers=None, rate_limiter=None, threads=None):
+    '''
+    Download the url once. Returns the response, None if the download failed,
+    or raises RetryLater if it should be tried again later.
+    With stream the body of a successful response is not read yet.
+    The headers are added to the request, for example for a conditional request.
+    With a RateLimiter the request waits for its turn, and the response
+    adjusts the rate. threads is the number of download threads of the
+    site, to size its connection pool.
+    '''
+    # Random Proxy if set in config, chosen once so the proxy that is logged and scored is the one used
     random_proxy = get_random_proxy()
-    if random_proxy:
-        session.proxies = {'http': random_proxy}
+    if rate_limiter:
+        rate_limiter.acquire(random_proxy)
+    session = get_session(url, random_proxy, threads)
+    headers = dict(headers or {})
+    headers['Accept-Charset'] = 'utf-8'
+    # Random User-Agent if set in config
     user_agent = get_random_user_agent()
-    session.headers.update({'User-Agent': get_random_user_agent(), 'Accept-Charset': 'utf-8'})
+    if user_agent:
+        headers['User-Agent'] = user_agent
     if cookie:
-        session.headers.update({'Cookie': cookie})
-    if data:
-        session.headers.update(data)
+        headers['Cookie'] = cookie
     logger.debug('Downloading url: {url} with proxy: {proxy} and user-agent: {ua}'.format(url=url, proxy=random_proxy, ua=user_agent))
+    start = time.time()
     try:
-        opener = None
-        # urllib2.install_opener(urllib2.build_opener(TLS1Handler()))
-
-        # Random Proxy if set in config
-        random_proxy = get_random_proxy()
-        if random_proxy:
-            proxyh = urllib2.ProxyHandler({'http': random_proxy})
-            opener = urllib2.build_opener(proxyh, NoRedirectHandler())
-        # We need to create an opener if it didn't exist yet
-        if not opener:
-            opener = urllib2.build_opener(NoRedirectHandler())
-        # Random User-Agent if set in config
-        user_agent = get_random_user_agent()
-        opener.addheaders = [('Accept-Charset', 'utf-8')]
-        if user_agent:
-            opener.addheaders.append(('User-Agent', user_agent))
-        if cookie:
-            opener.addheaders.append(('Cookie', cookie))
-        logger.debug(
-            'Downloading url: {url} with proxy: {proxy} and user-agent: {ua}'.format(
-                url=url, proxy=random_proxy, ua=user_agent))
         if data:
-            response = opener.open(url, data)
+            response = session.post(url, data=data, headers=headers, allow_redirects=False, timeout=socket.getdefaulttimeout(), stream=stream)
         else:
-            response = opener.open(url)
-        htmlPage = unicode(response.read(), errors='replace')
-        if 'File is not ready for scraping yet. Try again in 1 minute.' in htmlPage:
-            if loop_paste >= retries_paste:
-                logger.warning("Tried to scrape too early for {url}, giving up and saving current content".format(url=url))
-                return htmlPage, response.headers
-            else:
-                loop_paste += 1
-                logger.warning("Tried to scrape too early for {url}, trying again in 60s ({nb}/{total})".format(url=url, nb=loop_paste, total=retries_paste))
-                time.sleep(60)
-                return download_url(url, loop_paste=loop_paste)
-        return htmlPage, response.headers
-    except urllib2.HTTPError, e:
-        failed_proxy(random_proxy)
-        logger.warning("!!Proxy error on {url} for proxy {proxy}.".format(url=url, proxy=random_proxy))
-        if 404 == e.code:
-            htmlPage = e.read()
-            logger.warning("404 from proxy received for {url}. Waiting 1 minute".format(url=url))
-            time.sleep(60)
-            loop_client += 1
-            logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_client, total=retries_client, url=url))
-            return download_url(url, loop_client=loop_client)
-        if 500 == e.code:
-            htmlPage = e.read()
-            logger.warning("500 from proxy received for {url}. Waiting 1 minute".format(url=url))
-            time.sleep(60)
-            loop_server += 1
-            logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-            return download_url(url, loop_server=loop_server)
-        if 504 == e.code:
-            htmlPage = e.read()
-            logger.warning("504 from proxy received for {url}. Waiting 1 minute".format(url=url))
-            time.sleep(60)
-            loop_server += 1
-            logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-            return download_url(url, loop_server=loop_server)
-        if 502 == e.code:
-            htmlPage = e.read()
-            logger.warning("502 from proxy received for {url}. Waiting 1 minute".format(url=url))
-            time.sleep(60)
-            loop_server += 1
-            logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-            return download_url(url, loop_server=loop_server)
-        if 403 == e.code:
-            htmlPage = e.read()
-            if 'Please slow down' in htmlPage or 'has temporarily blocked your computer' in htmlPage or 'blocked' in htmlPage:
-                logger.warning("Slow down message received for {url}. Waiting 1 minute".format(url=url))
-                time.sleep(60)
-                loop_server += 1
-                logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-                return download_url(url, loop_server=loop_server)
-            if 504 == e.code:
-                htmlPage = e.read()
-                logger.warning("504 from proxy received for {url}. Waiting 1 minute".format(url=url))
-                time.sleep(60)
-                loop_server += 1
-                logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-                return download_url(url, loop_server=loop_server)
-            if 502 == e.code:
-                htmlPage = e.read()
-                logger.warning("502 from proxy received for {url}. Waiting 1 minute".format(url=url))
-                time.sleep(60)
-                loop_server += 1
-                logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-                return download_url(url, loop_server=loop_server)
-            if 403 == e.code:
-                htmlPage = e.read()
-                if 'Please slow down' in htmlPage or 'has temporarily blocked your computer' in htmlPage or 'blocked' in htmlPage:
-                    logger.warning("Slow down message received for {url}. Waiting 1 minute".format(url=url))
-                    time.sleep(60)
-                    return download_url(url)
-            logger.warning("ERROR: HTTP Error ##### {e} ######################## {url}".format(e=e, url=url))
-            return None
-        return response
-    except URLError as e:
-        logger.debug("ERROR: URL Error ##### {e} ######################## ".format(e=e, url=url))
+            response = session.get(url, headers=headers, allow_redirects=False, timeout=socket.getdefaulttimeout(), stream=stream)
+    except requests.exceptions.Timeout:
+        logger.debug("ERROR: timeout ############################# " + url)
         if random_proxy:  # remove proxy from the list if needed
             failed_proxy(random_proxy)
-            logger.warning("Failed to download the page {url} because of proxy error {proxy}. Trying again.".format(url=url, proxy=random_proxy))
-            loop_server += 1
-            logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-            return download_url(url, loop_server=loop_server)
-        if 'timed out' in e.reason:
-            logger.warning("Timed out or slow down for {url}. Waiting 1 minute".format(url=url))
-            loop_server += 1
-            logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-            time.sleep(60)
-            return download_url(url, loop_server=loop_server)
-        return None
-    except socket.timeout:
-        logger.debug("ERROR: timeout ############################# " + url)
+        logger.warning("Timed out for {url} with proxy {proxy}.".format(url=url, proxy=random_proxy))
+        raise RetryLater(url, 'network')
+    except requests.exceptions.ConnectionError as e:
+        logger.debug("ERROR: URL Error ##### {e} ######################## ".format(e=e, url=url))
         if random_proxy:  # remove proxy from the list if needed
             failed_proxy(random_proxy)
-            logger.warning("Failed to download the page because of socket error {0} trying again.".format(url))
-            loop_server += 1
-            logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-            return download_url(url, loop_server=loop_server)
+            logger.warning("Failed to download the page {url} because of proxy error {proxy}.".format(url=url, proxy=random_proxy))
+            raise RetryLater(url, 'network')
         return None
     except Exception as e:
         failed_proxy(random_proxy)
-        logger.warning("Failed to download the page because of other HTTPlib error proxy error {0} trying again.".format(url))
-        loop_server += 1
-        logger.warning("Retry {nb}/{total} for {url}".format(nb=loop_server, total=retries_server, url=url))
-        return download_url(url, loop_server=loop_server)
-        # logger.error("ERROR: Other HTTPlib error: {e}".format(e=e))
-        # return None, None
-    # do NOT try to download the url again here, as we might end in enless loop
+        logger.warning("Failed to download the page {url} because of other HTTPlib error: {e}".format(url=url, e=e))
+        raise RetryLater(url, 'network')
+
+    # a 404 comes from the site, other errors can come from the proxy or a site blocking it
+    if response.status_code >= 400 and response.status_code != 404:
+        failed_proxy(random_proxy)
+        logger.warning("!!Proxy error on {url} for proxy {proxy}.".format(url=url, proxy=random_proxy))
+    else:
+        succeeded_proxy(random_proxy, time.time() - start)
+    if stream and response.status_code < 400:
+        # the caller checks the content once it is read
+        if rate_limiter:
+            rate_limiter.success(random_proxy)
+        return response
+    kind = classify_response(response.status_code, response.text)
+    if rate_limiter:
+        if kind == 'slowdown':
+            rate_limiter.slowdown(random_proxy)
+        elif kind is None:
+            rate_limiter.success(random_proxy)
+    if kind == 'error':
+        logger.warning("ERROR: HTTP Error ##### {code} ######################## {url}".format(code=response.status_code, url=url))
+        return None
+    if kind:
+        logger.warning("{kind} error (HTTP {code}) received for {url}.".format(kind=kind, code=response.status_code, url=url))
+        raise RetryLater(url, kind)
+    return response
+
+
+class Histogram(object):
+    ''' Distribution of observed values, as cumulative Prometheus buckets. '''
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        ''' Return the upper bound of the bucket holding the q quantile. '''
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = u'{0}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(u'{0}="{1}"'.format(name, value))
+    return u'{' + u','.join(escaped) + u'}'
+
+
+class Stats(object):
+    '''
+    Counters and histograms of the running process, by name and labels,
+    exported in the Prometheus text format. The values that other objects
+    already count (queues, retries, search rules) are collected when the
+    statistics are rendered.
+    '''
+    help = {
+        'pystemon_archive_poll_seconds': 'Time to download and parse the archive page of a site',
+        'pystemon_fetch_seconds': 'Time to download a pastie',
+        'pystemon_downloaded_bytes_total': 'Bytes of pasties downloaded',
+        'pystemon_pasties_total': 'Pasties downloaded',
+        'pystemon_matches_total': 'Pasties that matched a search rule',
+        'pystemon_proxy_failures_total': 'Failed downloads through a proxy',
+        'pystemon_rate_limit': 'Requests per second allowed to a site',
+        'pystemon_rate_slowdowns_total': 'Times a site asked to slow down',
+        'pystemon_proxies': 'Proxies in use (state="up") and taken out after failures (state="down")',
+        'pystemon_sink_lag_seconds': 'Time between queueing a pastie for a sink and writing it',
+        'pystemon_rule_calls_total': 'Number of times the regular expression of a search rule ran',
+        'pystemon_rule_seconds_total': 'Time spent in the regular expression of a search rule',
+        'pystemon_rule_hits_total': 'Pasties that matched a search rule',
+        'pystemon_rule_overruns_total': 'Pasties where a search rule took longer than matching/rule-budget',
+        'pystemon_rule_quarantined': 'Whether a search rule is skipped because it was too slow',
+        'pystemon_queue_depth': 'Items waiting in a queue',
+        'pystemon_queue_dropped_total': 'Items dropped from a full queue',
+        'pystemon_queue_spilled_total': 'Items spilled to disk from a full queue',
+        'pystemon_retries_total': 'Download retries',
+        'pystemon_retries_given_up_total': 'Downloads given up after the retries',
+        'pystemon_retries_waiting': 'Pasties waiting for a retry',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels=(), value=0):
+        key = (name, tuple(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, labels=()):
+        with self.lock:
+            return self.counters.get((name, tuple(labels)), 0)
+
+    def histogram(self, name, labels=()):
+        with self.lock:
+            return self.histograms.get((name, tuple(labels))) or Histogram()
+
+    def collect(self):
+        '''
+        Return the gauges and counters kept by the queues, the retry
+        scheduler and the search engine, as {(name, labels): value}.
+        '''
+        values = {}
+        for name, (depth, dropped, spilled) in queue_stats().items():
+            labels = (('queue', name),)
+            values[('pystemon_queue_depth', labels)] = depth
+            values[('pystemon_queue_dropped_total', labels)] = dropped
+            values[('pystemon_queue_spilled_total', labels)] = spilled
+        if retry_scheduler:
+            with retry_scheduler.condition:
+                for (site, kind), count in retry_scheduler.retries.items():
+                    values[('pystemon_retries_total', (('site', site), ('kind', kind)))] = count
+                for (site, kind), count in retry_scheduler.gave_up.items():
+                    values[('pystemon_retries_given_up_total', (('site', site), ('kind', kind)))] = count
+            values[('pystemon_retries_waiting', ())] = retry_scheduler.qsize()
+        for site, rate_limiter in rate_limiters.items():
+            for proxy, rate in rate_limiter.rates().items():
+                labels = (('site', site),) + ((('proxy', proxy),) if proxy else ())
+                values[('pystemon_rate_limit', labels)] = rate
+            values[('pystemon_rate_slowdowns_total', (('site', site),))] = rate_limiter.slowdowns
+        if proxy_pool.proxies:
+            up, down = proxy_pool.counts()
+            values[('pystemon_proxies', (('state', 'up'),))] = up
+            values[('pystemon_proxies', (('state', 'down'),))] = down
+        if search_engine:
+            for index, (rule, calls, hits, seconds, overruns, quarantined) in enumerate(search_engine.rule_stats()):
+                # the position in the search section tells apart the rules with the same description
+                labels = (('rule', rule.description()), ('index', index))
+                values[('pystemon_rule_calls_total', labels)] = calls
+                values[('pystemon_rule_hits_total', labels)] = hits
+                values[('pystemon_rule_seconds_total', labels)] = seconds
+                values[('pystemon_rule_overruns_total', labels)] = overruns
+                values[('pystemon_rule_quarantined', labels)] = int(quarantined)
+        return values
+
+    def render(self):
+        ''' Return all statistics in the Prometheus text format. '''
+        with self.lock:
+            values = dict(self.counters)
+            histograms = [(key, list(h.counts), h.count, h.sum) for key, h in self.histograms.items()]
+        values.update(self.collect())
+        lines = []
+        names = sorted(set([name for name, _ in values] + [name for (name, _), _, _, _ in histograms]))
+        for name in names:
+            if name in self.help:
+                lines.append(u'# HELP {0} {1}'.format(name, self.help[name]))
+            if name.endswith('_seconds') and any(key[0] == name for key, _, _, _ in histograms):
+                lines.append(u'# TYPE {0} histogram'.format(name))
+                for (_, labels), counts, count, total in sorted(h for h in histograms if h[0][0] == name):
+                    cumulative = 0
+                    for bound, bucket_count in zip(Histogram.buckets + ('+Inf',), counts):
+                        cumulative += bucket_count
+                        lines.append(u'{0}_bucket{1} {2}'.format(name, prometheus_labels(labels + (('le', bound),)), cumulative))
+                    lines.append(u'{0}_sum{1} {2}'.format(name, prometheus_labels(labels), total))
+                    lines.append(u'{0}_count{1} {2}'.format(name, prometheus_labels(labels), count))
+                continue
+            lines.append(u'# TYPE {0} {1}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+            for (_, labels), value in sorted(item for item in values.items() if item[0][0] == name):
+                lines.append(u'{0}{1} {2}'.format(name, prometheus_labels(labels), value))
+        return u'\n'.join(lines) + u'\n'
+
+    def summary(self, site_name):
+        ''' Return a line with the main statistics of a site, for the log. '''
+        labels = (('site', site_name),)
+        fetch = self.histogram('pystemon_fetch_seconds', labels)
+        poll = self.histogram('pystemon_archive_poll_seconds', labels)
+        return ('{site}: {pasties} pasties, {matches} matches, {bytes} bytes, '
+                'fetch p50 {p50}s p99 {p99}s, poll p50 {poll}s'.format(site=site_name,
+                                                                       pasties=self.counter('pystemon_pasties_total', labels),
+                                                                       matches=self.counter('pystemon_matches_total', labels),
+                                                                       bytes=self.counter('pystemon_downloaded_bytes_total', labels),
+                                                                       p50=fetch.quantile(0.5),
+                                                                       p99=fetch.quantile(0.99),
+                                                                       poll=poll.quantile(0.5)))
+
+
+stats = Stats()
+
+
+def log_slowest_rules():
+    ''' Log the search rules that took the most time, as many as matching/report-top. '''
+    count = (yamlconfig.get('matching') or {}).get('report-top', 5)
+    if not count or not search_engine:
+        return
+    lines = []
+    for rule, calls, hits, seconds, overruns, quarantined in search_engine.slowest_rules(count):
+        if not calls:
+            break
+        lines.append('{rule} {seconds:.3f}s in {calls} runs ({per_call:.2f}ms per run), {hits} hits, {overruns} over budget{quarantined}'.format(
+            rule=rule.description(), seconds=seconds, calls=calls, per_call=1000 * seconds / calls, hits=hits,
+            overruns=overruns, quarantined=', in quarantine' if quarantined else ''))
+    if lines:
+        logger.info('Stats slowest search rules: {0}'.format('; '.join(lines)))
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = stats.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Stats request from {client}: {msg}'.format(client=self.client_address[0], msg=format % args))
+
+
+class StatsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StatsReporter(threading.Thread):
+    '''
+    Serves the statistics over HTTP in the Prometheus text format
+    (http://address:port/metrics), and logs a summary every interval seconds.
+    '''
+    def __init__(self, config, sites):
+        threading.Thread.__init__(self)
+        self.kill_received = False
+        self.sites = sites
+        self.interval = config.get('interval', 60)
+        self.server = None
+        if config.get('port'):
+            self.server = StatsServer((config.get('address', '127.0.0.1'), config['port']), StatsRequestHandler)
+            server_thread = threading.Thread(target=self.server.serve_forever)
+            server_thread.setDaemon(True)
+            server_thread.start()
+            logger.info('Serving the statistics on http://{0}:{1}/metrics'.format(*self.server.server_address))
+
+    def run(self):
+        while not self.kill_received:
+            if shutting_down.wait(self.interval):
+                break
+            for site in self.sites:
+                logger.info('Stats {summary}'.format(summary=stats.summary(site.name)))
+            lines = []
+            for name, (depth, dropped, spilled) in sorted(queue_stats().items()):
+                lines.append('{name} {depth} queued/{dropped} dropped/{spilled} spilled'.format(name=name, depth=depth, dropped=dropped, spilled=spilled))
+            for sink in ('db', 'redis', 'email'):
+                lag = stats.histogram('pystemon_sink_lag_seconds', (('sink', sink),))
+                if lag.count:
+                    lines.append('{sink} lag p50 {p50}s p99 {p99}s'.format(sink=sink, p50=lag.quantile(0.5), p99=lag.quantile(0.99)))
+            if lines:
+                logger.info('Stats queues: {0}'.format(', '.join(lines)))
+            log_slowest_rules()
+
+
+class RetryScheduler(threading.Thread):
+    '''
+    Delay queue for pasties that failed to download. Failed pasties are kept
+    in a heap ordered by the time of their next attempt, with exponential
+    backoff and jitter, and put back in the download queue of their site
+    when that time comes. This way the download threads never sleep on a
+    failing url.
+    '''
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.kill_received = False
+        self.condition = threading.Condition()
+        self.heap = []  # (next attempt, sequence, pastie, queue)
+        self.sequence = 0
+        self.retries = {}  # (site name, kind) -> number of retries
+        self.gave_up = {}  # (site name, kind) -> number of pasties given up
+
+    def next_delay(self, pastie, kind):
+        '''
+        Count the retry of the pastie, and return the delay in seconds
+        before the next attempt, or None if the retry budget is used up.
+        '''
+        retry_config = pastie.site.retry
+        key = (pastie.site.name, kind)
+        attempt = pastie.retries.get(kind, 0) + 1
+        if attempt > retry_config[kind]:
+            with self.condition:
+                self.gave_up[key] = self.gave_up.get(key, 0) + 1
+            logger.warning("Giving up on {url} after {nb} {kind} retries".format(url=pastie.url, nb=attempt - 1, kind=kind))
+            return None
+        pastie.retries[kind] = attempt
+        with self.condition:
+            self.retries[key] = self.retries.get(key, 0) + 1
+        delay = retry_config['delay']
+        if kind in ('slowdown', 'notready'):
+            delay = max(delay, 60)  # the site asks to come back in a minute
+        delay = min(retry_config['max-delay'], delay * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2.0, delay)
+        logger.info("Retry {nb}/{total} for {url} in {delay:.0f} seconds".format(nb=attempt, total=retry_config[kind], url=pastie.url, delay=delay))
+        return delay
+
+    def schedule(self, pastie, queue, kind):
+        '''
+        Put the pastie back in the queue after the retry delay.
+        Returns False if the retry budget is used up.
+        '''
+        delay = self.next_delay(pastie, kind)
+        if delay is None:
+            return False
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.heap, (time.time() + delay, self.sequence, pastie, queue))
+            self.condition.notify()
+        return True
+
+    def qsize(self):
+        return len(self.heap)
+
+    def site_stats(self, site_name):
+        '''
+        Return the number of pasties of the site waiting for a retry,
+        the number of retries and the number of pasties given up.
+        '''
+        with self.condition:
+            waiting = sum(1 for entry in self.heap if entry[2].site.name == site_name)
+            retries = sum(count for (name, kind), count in self.retries.items() if name == site_name)
+            gave_up = sum(count for (name, kind), count in self.gave_up.items() if name == site_name)
+        return waiting, retries, gave_up
+
+    def run(self):
+        while not self.kill_received:
+            due = []
+            with self.condition:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+                if not due:
+                    timeout = self.heap[0][0] - now if self.heap else 1
+                    self.condition.wait(min(timeout, 1))
+            # put the pasties back outside of the lock
+            for _, _, pastie, queue in due:
+                try:
+                    queue.put(pastie, block=False)
+                except Full:
+                    # do not block the retries of the other sites, try again a bit later
+                    with self.condition:
+                        self.sequence += 1
+                        heapq.heappush(self.heap, (time.time() + 1, self.sequence, pastie, queue))
+
+
+class RedisCoordinator(object):
+    '''
+    Shared state of the nodes of a cluster, in Redis: the claims of the
+    pastie ids, the leases of the sites and the live nodes.
+    '''
+    def __init__(self, config, node):
+        self.node = node
+        self.prefix = config.get('prefix', 'pystemon')
+        self.redis = redis.StrictRedis(host=config['server'], port=config['port'], db=config['database'])
+
+    def claim(self, site_name, pastie_id, ttl):
+        ''' Atomically claim the pastie for this node, returns False if another node has it. '''
+        return bool(self.redis.set('{0}:seen:{1}:{2}'.format(self.prefix, site_name, pastie_id), self.node, nx=True, ex=ttl))
+
+    def release(self, site_name, pastie_id):
+        self.redis.delete('{0}:seen:{1}:{2}'.format(self.prefix, site_name, pastie_id))
+
+    def hold_lease(self, site_name, ttl):
+        ''' Take or renew the lease of the site, returns False if another node holds it. '''
+        key = '{0}:lease:{1}'.format(self.prefix, site_name)
+        if self.redis.set(key, self.node, nx=True, ex=ttl):
+            return True
+        return self.if_holder(key, lambda pipe: pipe.expire(key, ttl))
+
+    def drop_lease(self, site_name):
+        key = '{0}:lease:{1}'.format(self.prefix, site_name)
+        self.if_holder(key, lambda pipe: pipe.delete(key))
+
+    def if_holder(self, key, command):
+        ''' Run the command in a transaction if this node holds the key. '''
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                holder = pipe.get(key)
+                if holder is None or holder.decode('utf8') != self.node:
+                    return False
+                pipe.multi()
+                command(pipe)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def heartbeat(self, ttl):
+        ''' Mark this node alive, and return the number of live nodes. '''
+        key = '{0}:nodes'.format(self.prefix)
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(key, {self.node: now})
+        pipe.zremrangebyscore(key, '-inf', now - ttl)
+        pipe.zcard(key)
+        return pipe.execute()[-1]
+
+    def leave(self):
+        self.redis.zrem('{0}:nodes'.format(self.prefix), self.node)
+
+
+local_stores = {}  # prefix -> (lock, keys, nodes) of the LocalCoordinators of the process
+local_stores_lock = threading.Lock()
+
+
+class LocalCoordinator(object):
+    '''
+    Stand-in for the RedisCoordinator in the memory of the process, so the
+    cluster mode can be tried and tested without Redis. The LocalCoordinators
+    with the same prefix share their state, so the nodes coordinate as long
+    as they run in the same process.
+    '''
+    def __init__(self, config, node):
+        self.node = node
+        with local_stores_lock:
+            store = local_stores.setdefault(config.get('prefix', 'pystemon'), (threading.Lock(), {}, {}))
+        self.lock = store[0]
+        self.keys = store[1]  # key -> (value, expiry time)
+        self.nodes = store[2]  # node -> last heartbeat
+
+    def get(self, key):
+        value, expiry = self.keys.get(key, (None, 0))
+        if expiry <= time.time():
+            self.keys.pop(key, None)
+            return None
+        return value
+
+    def claim(self, site_name, pastie_id, ttl):
+        with self.lock:
+            if self.get(('seen', site_name, pastie_id)) is not None:
+                return False
+            self.keys[('seen', site_name, pastie_id)] = (self.node, time.time() + ttl)
+            return True
+
+    def release(self, site_name, pastie_id):
+        with self.lock:
+            self.keys.pop(('seen', site_name, pastie_id), None)
+
+    def hold_lease(self, site_name, ttl):
+        with self.lock:
+            if self.get(('lease', site_name)) not in (None, self.node):
+                return False
+            self.keys[('lease', site_name)] = (self.node, time.time() + ttl)
+            return True
+
+    def drop_lease(self, site_name):
+        with self.lock:
+            if self.get(('lease', site_name)) == self.node:
+                del self.keys[('lease', site_name)]
+
+    def heartbeat(self, ttl):
+        with self.lock:
+            now = time.time()
+            self.nodes[self.node] = now
+            for name, last in list(self.nodes.items()):
+                if last < now - ttl:
+                    del self.nodes[name]
+            return len(self.nodes)
+
+    def leave(self):
+        with self.lock:
+            self.nodes.pop(self.node, None)
+
+
+class Cluster(threading.Thread):
+    '''
+    Shares the work between the pystemon nodes using the same coordination
+    store. Every site is polled by the node holding its lease, and every node
+    holds at most its fair share of the leases: the number of sites divided by
+    the number of live nodes. A pastie id is claimed atomically before it is
+    queued, so it is downloaded once in the cluster, also while a lease moves
+    to another node. The claim is released when the pastie is not downloaded
+    after all (dropped, given up, or left at the shutdown), so another node
+    can download it. The thread keeps the node alive in the store.
+    '''
+    def __init__(self, config, sites):
+        threading.Thread.__init__(self)
+        self.kill_received = False
+        self.node = config.get('node') or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.heartbeat_time = config.get('heartbeat', 10)
+        self.lease_time = config.get('lease-time', 120)
+        self.claim_ttl = config.get('claim-ttl', 2592000)
+        if config.get('backend', 'redis') == 'local':
+            self.store = LocalCoordinator(config, self.node)
+        else:
+            self.store = RedisCoordinator(config, self.node)
+        self.sites = sites
+        self.lock = threading.Lock()  # the site threads share the leases
+        self.leases = set()  # names of the sites this node polls
+        self.live_nodes = self.store.heartbeat(3 * self.heartbeat_time)
+
+    def run(self):
+        while not self.kill_received:
+            if shutting_down.wait(self.heartbeat_time):
+                break
+            try:
+                self.live_nodes = self.store.heartbeat(3 * self.heartbeat_time)
+            except redis.RedisError as e:
+                logger.error('Cannot reach the cluster store: {e}'.format(e=e))
+
+    def fair_share(self):
+        return -(-len(self.sites) // max(self.live_nodes, 1))  # rounded up
+
+    def should_poll(self, site):
+        ''' Take, renew or give away the lease of the site, return True if this node polls it. '''
+        # the lease has to outlive the time between two polls
+        ttl = int(max(self.lease_time, 2 * site.update_max + 10))
+        with self.lock:
+            try:
+                if site.name in self.leases:
+                    if len(self.leases) > self.fair_share():
+                        # more nodes joined, leave the site to one of them
+                        self.store.drop_lease(site.name)
+                        self.leases.discard(site.name)
+                        logger.info('Cluster node {node} stops polling {site}'.format(node=self.node, site=site.name))
+                        return False
+                    if self.store.hold_lease(site.name, ttl):
+                        return True
+                    self.leases.discard(site.name)
+                    logger.warning('Cluster node {node} lost the lease of {site}'.format(node=self.node, site=site.name))
+                    return False
+                if len(self.leases) < self.fair_share() and self.store.hold_lease(site.name, ttl):
+                    self.leases.add(site.name)
+                    logger.info('Cluster node {node} starts polling {site}'.format(node=self.node, site=site.name))
+                    return True
+            except redis.RedisError as e:
+                logger.error('Cannot reach the cluster store: {e}'.format(e=e))
+            return False
+
+    def claim(self, site_name, pastie_id):
+        try:
+            return self.store.claim(site_name, pastie_id, self.claim_ttl)
+        except redis.RedisError as e:
+            # better download a pastie twice than miss it
+            logger.error('Cannot reach the cluster store: {e}'.format(e=e))
+            return True
+
+    def release(self, site_name, pastie_id):
+        try:
+            self.store.release(site_name, pastie_id)
+        except redis.RedisError as e:
+            logger.error('Cannot reach the cluster store: {e}'.format(e=e))
+
+    def leave(self):
+        ''' Give away the leases of this node and leave the cluster. '''
+        try:
+            with self.lock:
+                for site_name in list(self.leases):
+                    self.store.drop_lease(site_name)
+                self.leases.clear()
+            self.store.leave()
+        except redis.RedisError as e:
+            logger.error('Cannot reach the cluster store: {e}'.format(e=e))
+
+
+cluster = None  # the Cluster, in cluster mode
+
+
+class RedisPublisher(threading.Thread):
+    '''
+    Publishes the saved pasties to a Redis list, for other tools to process.
+    All threads share one connection pool, the messages are pushed in
+    batches through a pipeline. A message is the path of the saved file,
+    or a JSON document with the metadata of the pastie if redis/metadata is set.
+    '''
+    def __init__(self, config):
+        threading.Thread.__init__(self)
+        self.kill_received = False
+        # the messages are queued with the time they were queued, as JSON so they can spill to disk
+        self.queue = make_sink_queue('redis', encode=json.dumps, decode=json.loads)
+        self.key = config.get('key', 'pastes')
+        self.metadata = config.get('metadata', False)
+        self.batch_size = config.get('batch-size', 100)
+        self.pool = redis.ConnectionPool(host=config['server'], port=config['port'], db=config['database'])
+        self.redis = redis.StrictRedis(connection_pool=self.pool)
+
+    def publish(self, pastie, full_path):
+        if self.metadata:
+            message = json.dumps({'path': full_path,
+                                  'site': pastie.site.name,
+                                  'id': pastie.id,
+                                  'url': pastie.url,
+                                  'md5': pastie.md5,
+                                  'matches': [match.get('description') or match['search'] for match in pastie.matches]})
+        else:
+            message = full_path
+        self.queue.put([time.time(), message])
+
+    def run(self):
+        while not self.kill_received:
+            try:
+                messages = [self.queue.get(timeout=1)]
+            except Empty:
+                continue
+            while len(messages) < self.batch_size:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            self.push([message for _, message in messages])
+            now = time.time()
+            for queued_time, _ in messages:
+                stats.observe('pystemon_sink_lag_seconds', (('sink', 'redis'),), now - queued_time)
+                self.queue.task_done()
+
+    def push(self, messages):
+        ''' Push the messages, waiting for Redis to come back if it is down. '''
+        delay = 1
+        while True:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for message in messages:
+                    pipe.lpush(self.key, message)
+                pipe.execute()
+                return
+            except redis.RedisError as e:
+                logger.error("Cannot push {count} pasties to Redis, trying again in {delay} seconds: {e}".format(count=len(messages), delay=delay, e=e))
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
 
 
 class Sqlite3Database(threading.Thread):
-    def __init__(self, filename):
+    '''
+    Stores information about the pasties in a SQLite database.
+    The queue is drained in batches, every batch is written with a single
+    transaction of upserts, committed when the batch is full or when
+    batch_time seconds have passed.
+    '''
+    def __init__(self, filename, batch_size=500, batch_time=1):
         threading.Thread.__init__(self)
         self.kill_received = False
-        self.queue = Queue()
+        self.queue = make_sink_queue('db')
         self.filename = filename
+        self.batch_size = batch_size
+        self.batch_time = batch_time
         self.db_conn = None
         self.c = None
+        self.upsert_query = None
+
+    def put(self, pastie):
+        ''' Queue the pastie to be added or updated in the database. '''
+        pastie.db_queued_time = time.time()
+        self.queue.put(pastie)
 
     def run(self):
         self.db_conn = sqlite3.connect(self.filename)
         # create the db if it doesn't exist
         self.c = self.db_conn.cursor()
         try:
+            self.c.execute('PRAGMA journal_mode=WAL')
+            self.c.execute('PRAGMA synchronous=NORMAL')
             # LATER maybe create a table per site. Lookups will be faster as less text-searching is needed
             self.c.execute('''
                 CREATE TABLE IF NOT EXISTS pasties (
@@ -797,78 +3783,101 @@ class Sqlite3Database(threading.Thread):
                     timestamp DATE,
                     matches TEXT
                     )''')
+            # databases of older versions do not have all columns
+            columns = [row[1] for row in self.c.execute('PRAGMA table_info(pasties)')]
+            if 'duplicate_of' not in columns:
+                self.c.execute('ALTER TABLE pasties ADD COLUMN duplicate_of TEXT')
+            self.c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'pasties_site_id'")
+            if not self.c.fetchone():
+                # databases of older versions can have the same pastie more than once, once the index exists they cannot
+                self.c.execute('''DELETE FROM pasties WHERE rowid NOT IN
+                                  (SELECT MAX(rowid) FROM pasties GROUP BY site, id)''')
+                self.c.execute('CREATE UNIQUE INDEX pasties_site_id ON pasties (site, id)')
             self.db_conn.commit()
         except sqlite3.DatabaseError as e:
             logger.error('Problem with the SQLite database {0}: {1}'.format(self.filename, e))
             return None
+        if sqlite3.sqlite_version_info >= (3, 24, 0):
+            self.upsert_query = '''INSERT INTO pasties (site, id, md5, url, local_path, timestamp, matches, duplicate_of)
+                                   VALUES (:site, :id, :md5, :url, :local_path, :timestamp, :matches, :duplicate_of)
+                                   ON CONFLICT (site, id) DO UPDATE SET md5 = excluded.md5,
+                                                                        url = excluded.url,
+                                                                        local_path = excluded.local_path,
+                                                                        timestamp = excluded.timestamp,
+                                                                        matches = excluded.matches,
+                                                                        duplicate_of = excluded.duplicate_of'''
+        else:
+            self.upsert_query = '''INSERT OR REPLACE INTO pasties (site, id, md5, url, local_path, timestamp, matches, duplicate_of)
+                                   VALUES (:site, :id, :md5, :url, :local_path, :timestamp, :matches, :duplicate_of)'''
         # loop over the queue
         while not self.kill_received:
             try:
-                # grabs pastie from queue
-                pastie = self.queue.get()
-                # add the pastie to the DB
-                self.add_or_update(pastie)
-                # signals to queue job is done
-                self.queue.task_done()
+                # grabs a batch of pasties from queue
+                pasties = self.get_batch()
+                if not pasties:
+                    continue
+                # add the pasties to the DB
+                self.add_or_update(pasties)
+                # signals to queue jobs are done
+                for pastie in pasties:
+                    self.queue.task_done()
             # catch unknown errors
             except Exception as e:
                 logger.error("Thread for SQLite crashed unexpectectly, recovering...: {e}".format(e=e))
                 logger.debug(traceback.format_exc())
+        self.db_conn.close()
 
-    def add_or_update(self, pastie):
-        data = {'site': pastie.site.name,
-                'id': pastie.id
-                }
-        self.c.execute('SELECT count(id) FROM pasties WHERE site=:site AND id=:id', data)
-        pastie_in_db = self.c.fetchone()
-        # logger.debug('State of Database for pastie {site} {id} - {state}'.format(site=pastie.site.name, id=pastie.id, state=pastie_in_db))
-        if pastie_in_db and pastie_in_db[0]:
-            self.update(pastie)
-        else:
-            self.add(pastie)
-
-    def add(self, pastie):
+    def get_batch(self):
+        '''
+        Wait for a pastie in the queue, then collect more pasties until the
+        batch is full or the batch time is over.
+        '''
         try:
-            data = {'site': pastie.site.name,
-                    'id': pastie.id,
-                    'md5': pastie.md5,
-                    'url': pastie.url,
-                    'local_path': pastie.site.archive_dir + os.sep + pastie.site.pastie_id_to_filename(pastie.id),
-                    'timestamp': datetime.now(),
-                    'matches': pastie.matches_to_text()
-                    }
-            self.c.execute('INSERT INTO pasties VALUES (:site, :id, :md5, :url, :local_path, :timestamp, :matches)', data)
-            self.db_conn.commit()
-        except sqlite3.DatabaseError as e:
-            logger.error('Cannot add pastie {site} {id} in the SQLite database: {error}'.format(site=pastie.site.name, id=pastie.id, error=e))
-        logger.debug('Added pastie {site} {id} in the SQLite database.'.format(site=pastie.site.name, id=pastie.id))
-
-    def update(self, pastie):
+            pasties = [self.queue.get(timeout=1)]
+        except Empty:
+            return []
+        deadline = time.time() + self.batch_time
+        while len(pasties) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                pasties.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return pasties
+
+    def add_or_update(self, pasties):
+        rows = OrderedDict()
+        for pastie in pasties:
+            # the same pastie can be in the batch more than once, keep the last state
+            rows[(pastie.site.name, pastie.id)] = {
+                'site': pastie.site.name,
+                'id': pastie.id,
+                'md5': pastie.md5,
+                'url': pastie.url,
+                'local_path': u'{0}:{1}:{2}'.format(*pastie.local_path) if isinstance(pastie.local_path, tuple) else pastie.local_path,
+                'timestamp': datetime.now(),
+                'matches': pastie.matches_to_text(),
+                'duplicate_of': pastie.duplicate_of
+            }
         try:
-            data = {'site': pastie.site.name,
-                    'id': pastie.id,
-                    'md5': pastie.md5,
-                    'url': pastie.url,
-                    'local_path': pastie.site.archive_dir + os.sep + pastie.site.pastie_id_to_filename(pastie.id),
-                    'timestamp': datetime.now(),
-                    'matches': pastie.matches_to_text()
-                    }
-            self.c.execute('''UPDATE pasties SET md5 = :md5,
-                                            url = :url,
-                                            local_path = :local_path,
-                                            timestamp  = :timestamp,
-                                            matches = :matches
-                     WHERE site = :site AND id = :id''', data)
+            self.c.executemany(self.upsert_query, list(rows.values()))
             self.db_conn.commit()
         except sqlite3.DatabaseError as e:
-            logger.error('Cannot add pastie {site} {id} in the SQLite database: {error}'.format(site=pastie.site.name, id=pastie.id, error=e))
-        logger.debug('Updated pastie {site} {id} in the SQLite database.'.format(site=pastie.site.name, id=pastie.id))
+            self.db_conn.rollback()
+            logger.error('Cannot add {count} pasties in the SQLite database: {error}'.format(count=len(rows), error=e))
+            return
+        logger.debug('Added or updated {count} pasties in the SQLite database.'.format(count=len(rows)))
+        now = time.time()
+        for pastie in pasties:
+            stats.observe('pystemon_sink_lag_seconds', (('sink', 'db'),), now - pastie.db_queued_time)
 
 
 def parse_config_file(configfile):
     global yamlconfig
     try:
-        yamlconfig = yaml.load(open(configfile))
+        yamlconfig = yaml.safe_load(open(configfile))
     except yaml.YAMLError as exc:
         logger.error("Error in configuration file:")
         if hasattr(exc, 'problem_mark'):
@@ -877,9 +3886,15 @@ def parse_config_file(configfile):
             exit(1)
     # TODO verify validity of config parameters
     for includes in yamlconfig.get("includes", []):
-        yamlconfig.update(yaml.load(open(includes)))
+        yamlconfig.update(yaml.safe_load(open(includes)))
+    global search_engine
+    try:
+        search_engine = SearchEngine(yamlconfig['search'])
+    except (re.error, ValueError) as e:
+        logger.error("Error in search section of the configuration file: {e}".format(e=e))
+        exit(1)
     if yamlconfig['proxy']['random']:
-        load_proxies_from_file(yamlconfig['proxy']['file'])
+        proxy_pool.configure(yamlconfig['proxy'])
     if yamlconfig['user-agent']['random']:
         load_user_agents_from_file(yamlconfig['user-agent']['file'])
     # if yamlconfig['redis']['queue']:
@@ -894,7 +3909,11 @@ if __name__ == "__main__":
     parser.add_option("-d", "--daemon", action="store_true", dest="daemon",
                       help="runs in background as a daemon (NOT IMPLEMENTED)")
     parser.add_option("-s", "--stats", action="store_true", dest="stats",
-                      help="display statistics about the running threads (NOT IMPLEMENTED)")
+                      help="serve statistics about the running threads over HTTP and log them periodically (see the stats section)")
+    parser.add_option("--rescan", action="store_true", dest="rescan",
+                      help="search the archive for the search rules that are new or changed since the last rescan, then exit")
+    parser.add_option("--rescan-all", action="store_true", dest="rescan_all",
+                      help="search the archive for all search rules, then exit")
     parser.add_option("-v", action="store_true", dest="verbose",
                       help="outputs more information")
 
@@ -929,5 +3948,8 @@ if __name__ == "__main__":
         # FIXME run application in background
 
     parse_config_file(options.config)
+    if options.rescan or options.rescan_all:
+        rescan(options.rescan_all)
+        exit(0)
     # run the software
-    main()
+    main(options.stats)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+'''
+Asyncio engine for pystemon, enabled with "engine: async" in the configuration file.
+It needs python 3 and the aiohttp library.
+
+The archive pages are polled and the pasties are downloaded by coroutines,
+so thousands of downloads can be in flight from a single process. Once a
+pastie is downloaded the search/save/alert pipeline of pystemon.py runs
+unchanged in a thread of the executor.
+
+@author:     Christophe Vandeplas <christophe@vandeplas.com>
+@copyright:  AGPLv3
+             http://www.gnu.org/licenses/agpl.html
+'''
+
+import asyncio
+import logging
+import signal
+import socket
+import threading
+import time
+import traceback
+from queue import Full
+
+import aiohttp
+
+import pystemon
+
+logger = logging.getLogger('pystemon')
+
+
+class DownloadQueue(asyncio.Queue):
+    '''
+    Download queue of a site, with the counters of pystemon.BoundedQueue so
+    it shows in the statistics. A full queue makes the poller wait, so
+    nothing is dropped or spilled.
+    '''
+    dropped = 0
+    spilled = 0
+
+    def depth(self):
+        return self.qsize()
+
+    @property
+    def unfinished_tasks(self):
+        return self._unfinished_tasks
+
+
+class RetryQueue(object):
+    '''
+    Hands the pasties that pystemon.RetryScheduler puts back after their
+    retry delay to the download queue of a site, in the event loop. The
+    scheduler runs in its own thread, so the pasties waiting for a retry
+    are counted in the statistics like with the thread engine.
+    '''
+    def __init__(self, queue, loop):
+        self.queue = queue
+        self.loop = loop
+
+    def put(self, pastie, block=True, timeout=None):
+        if self.loop.is_closed():
+            # the engine stopped, the pastie keeps waiting in the scheduler
+            raise Full()
+        asyncio.run_coroutine_threadsafe(self.queue.put(pastie), self.loop)
+
+
+class AsyncEngine(object):
+    '''
+    Runs a polling coroutine per PastieSite, and per site as many download
+    coroutines as the site allows concurrent downloads (the threads setting).
+    '''
+    def __init__(self, sites):
+        self.sites = sites
+        self.queues = {}
+        self.retry_queues = {}
+        self.session = None
+        self.stopping = None
+
+    def stop(self, signum):
+        ''' Handler of SIGINT and SIGTERM, see pystemon.request_shutdown(). '''
+        pystemon.request_shutdown(signum, None)
+        self.stopping.set()
+
+    async def run(self):
+        timeout = aiohttp.ClientTimeout(sock_connect=socket.getdefaulttimeout(),
+                                        sock_read=socket.getdefaulttimeout())
+        connector = aiohttp.TCPConnector(limit=0)  # the concurrency is limited per site
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            # signals can only be handled in the main thread, elsewhere the engine runs until the process exits
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, self.stop, signum)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.session:
+            pollers = []
+            fetchers = []
+            for site in self.sites:
+                # the download queues are bounded by the queues/download size, a full queue makes the poller wait
+                queue_config = dict((pystemon.yamlconfig.get('queues') or {}).get('download') or {})
+                queue_config.update(site.queue_config)
+                self.queues[site.name] = DownloadQueue(queue_config.get('size', 0))
+                pystemon.queues[site.name] = self.queues[site.name]
+                self.retry_queues[site.name] = RetryQueue(self.queues[site.name], loop)
+                pollers.append(asyncio.ensure_future(self.poll_site(site)))
+                for i in range(site.threads):
+                    fetchers.append(asyncio.ensure_future(self.fetch_pasties(site)))
+            await self.stopping.wait()
+            # no new pasties, finish the queued downloads before the deadline
+            for task in pollers:
+                task.cancel()
+            try:
+                await asyncio.wait_for(asyncio.gather(*[queue.join() for queue in self.queues.values()]),
+                                       max(pystemon.shutdown_deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                kept = any(site.journal for site in self.sites)
+                logger.warning("{left} queued pasties are not downloaded{kept}.".format(
+                    left=sum(queue.qsize() for queue in self.queues.values()), kept=', they are kept in the journal' if kept else ''))
+            for task in fetchers:
+                task.cancel()
+            await asyncio.gather(*(pollers + fetchers), return_exceptions=True)
+
+    async def download_url(self, url, max_size=0, headers=None, not_modified=None, rate_limiter=None, too_large=None,
+                           feed=None, chunk_size=65536):
+        '''
+        Asynchronous counterpart of pystemon.download_url(), returns the body
+        of the page, None if the download failed or the body is larger than
+        max_size, or raises pystemon.RetryLater. too_large() is called when
+        the body is larger than max_size. The headers are added to the
+        request, and None is returned as well when not_modified(status, headers)
+        returns True, for conditional requests. With a pystemon.RateLimiter the
+        request waits for its turn, and the response adjusts the rate.
+        With feed, the body is read in chunks of chunk_size bytes, and the
+        coroutine feed(chunk) is awaited for every chunk as it arrives.
+        '''
+        random_proxy = pystemon.get_random_proxy()
+        if rate_limiter:
+            delay = rate_limiter.reserve(random_proxy)
+            if delay:
+                await asyncio.sleep(delay)
+        headers = dict(headers or {})
+        headers['Accept-Charset'] = 'utf-8'
+        user_agent = pystemon.get_random_user_agent()
+        if user_agent:
+            headers['User-Agent'] = user_agent
+        logger.debug('Downloading url: {url} with proxy: {proxy} and user-agent: {ua}'.format(url=url, proxy=random_proxy, ua=user_agent))
+        start = asyncio.get_running_loop().time()
+        try:
+            async with self.session.get(url, headers=headers, proxy=random_proxy, allow_redirects=False) as response:
+                status = response.status
+                if not_modified and not_modified(status, response.headers):
+                    pystemon.succeeded_proxy(random_proxy, asyncio.get_running_loop().time() - start)
+                    return None
+                if max_size and (response.content_length or 0) > max_size:
+                    logger.warning("The page {url} is larger than {max} bytes, dropping it".format(url=url, max=max_size))
+                    if too_large:
+                        too_large()
+                    return None
+                chunks = []
+                size = 0
+                async for chunk in (response.content.iter_chunked(chunk_size) if feed else response.content.iter_any()):
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        logger.warning("The page {url} is larger than {max} bytes, dropping it".format(url=url, max=max_size))
+                        if too_large:
+                            too_large()
+                        return None
+                    if feed:
+                        await feed(chunk)
+                    chunks.append(chunk)
+                body = b''.join(chunks)
+        except asyncio.TimeoutError:
+            logger.debug("ERROR: timeout ############################# " + url)
+            if random_proxy:
+                pystemon.failed_proxy(random_proxy)
+            logger.warning("Timed out for {url} with proxy {proxy}.".format(url=url, proxy=random_proxy))
+            raise pystemon.RetryLater(url, 'network')
+        except aiohttp.ClientError as e:
+            logger.debug("ERROR: URL Error ##### {e} ######################## ".format(e=e))
+            if not random_proxy:
+                return None
+            pystemon.failed_proxy(random_proxy)
+            logger.warning("Failed to download the page {url} because of proxy error {proxy}.".format(url=url, proxy=random_proxy))
+            raise pystemon.RetryLater(url, 'network')
+
+        if status >= 400 and status != 404:
+            pystemon.failed_proxy(random_proxy)
+            logger.warning("!!Proxy error on {url} for proxy {proxy}.".format(url=url, proxy=random_proxy))
+        else:
+            pystemon.succeeded_proxy(random_proxy, asyncio.get_running_loop().time() - start)
+        kind = pystemon.classify_response(status, body.decode('utf8', 'replace'))
+        if rate_limiter:
+            if kind == 'slowdown':
+                rate_limiter.slowdown(random_proxy)
+            elif kind is None:
+                rate_limiter.success(random_proxy)
+        if kind == 'error':
+            logger.warning("ERROR: HTTP Error ##### {code} ######################## {url}".format(code=status, url=url))
+            return None
+        if kind:
+            logger.warning("{kind} error (HTTP {code}) received for {url}.".format(kind=kind, code=status, url=url))
+            raise pystemon.RetryLater(url, kind)
+        return body
+
+    async def poll_site(self, site):
+        loop = asyncio.get_running_loop()
+        queue = self.queues[site.name]
+        if site.journal:
+            for pastie in site.replay_journal():
+                await queue.put(pastie)
+        while True:
+            if pystemon.cluster and not await loop.run_in_executor(None, pystemon.cluster.should_poll, site):
+                # another node of the cluster polls this site, check again later if it still does
+                await asyncio.sleep(site.poll_scheduler.next_delay())
+                continue
+            try:
+                logger.info('Downloading list of new pastes from {name}.'.format(name=site.name))
+                if type(site.adapter).list_recent is not pystemon.ArchivePageAdapter.list_recent:
+                    # the adapter lists the pasties its own way, it can only run blocking
+                    last_pasties = await loop.run_in_executor(None, site.get_last_pasties)
+                else:
+                    start = loop.time()
+                    body = await self.download_url(site.archive_url, headers=site.archive_headers(), not_modified=site.archive_not_modified,
+                                                   rate_limiter=site.rate_limiter)
+                    last_pasties = None
+                    if body:
+                        # in a thread, as the pastie ids are claimed in the cluster store
+                        last_pasties = await loop.run_in_executor(None, site.parse_last_pasties, body.decode('utf8', 'replace'))
+                        pystemon.stats.observe('pystemon_archive_poll_seconds', (('site', site.name),), loop.time() - start)
+                if last_pasties:
+                    # first the old entries and then the new ones
+                    for pastie in reversed(last_pasties):
+                        await queue.put(pastie)
+                    logger.info("Found {amount} new pasties for site {site}. There are now {qsize} pasties to be downloaded.".format(amount=len(last_pasties),
+                                                                                                                                     site=site.name,
+                                                                                                                                     qsize=queue.qsize()))
+            except pystemon.RetryLater as e:
+                logger.warning("Could not download the list of pastes from {name}, will try again at the next check: {e}".format(name=site.name, e=e))
+            # catch unknown errors
+            except Exception as e:
+                logger.error('Poller for {name} crashed unexpectectly, recovering...: {e}'.format(name=site.name, e=e))
+                logger.debug(traceback.format_exc())
+            sleep_time = site.poll_scheduler.next_delay()
+            logger.info('Will check {name} again in {time} seconds'.format(name=site.name, time=sleep_time))
+            await asyncio.sleep(sleep_time)
+
+    def stream_feed(self, hasher, matcher):
+        '''
+        Return the coroutine that hashes and searches the chunks of a streamed
+        download as they arrive, see pystemon.ArchivePageAdapter.fetch_stream().
+        '''
+        loop = asyncio.get_running_loop()
+
+        async def feed(chunk):
+            hasher.update(chunk)
+            if matcher:
+                # the regexes block, they run in a thread of the executor
+                await loop.run_in_executor(None, matcher.feed, chunk)
+        return feed
+
+    async def fetch_pasties(self, site):
+        loop = asyncio.get_running_loop()
+        queue = self.queues[site.name]
+        while True:
+            pastie = await queue.get()
+            try:
+                if site.seen_pastie(pastie.id):
+                    pass
+                elif pastie.pastie_content is not None or type(pastie).fetch_pastie is not pystemon.Pastie.fetch_pastie \
+                        or type(site.adapter).fetch is not pystemon.ArchivePageAdapter.fetch:
+                    # downloaded with others by the adapter, or custom download function, it can only run blocking
+                    await loop.run_in_executor(None, pastie.fetch_and_process_pastie)
+                else:
+                    start = loop.time()
+                    feed = hasher = matcher = None
+                    if site.stream:
+                        hasher = pystemon.new_content_hasher()
+                        matcher = pystemon.search_engine.stream() if isinstance(pystemon.search_engine, pystemon.SearchEngine) else None
+                        feed = self.stream_feed(hasher, matcher)
+                    # a pastie that is too large is not downloaded again at the next polls
+                    pastie.pastie_content = await self.download_url(pastie.url, site.max_size, rate_limiter=site.rate_limiter,
+                                                                    too_large=lambda: site.seen_pasties.add(pastie.id),
+                                                                    feed=feed, chunk_size=site.chunk_size)
+                    if feed and pastie.pastie_content is not None:
+                        pastie.content_hash = hasher.hexdigest()
+                        pastie.stream_matcher = matcher
+                    pastie.count_download(loop.time() - start)
+                    # hash, save, search and alert in a thread, as these block
+                    if await loop.run_in_executor(None, pastie.process_pastie):
+                        logger.debug("Saved new pastie from {0} with id {1}".format(site.name, pastie.id))
+                site.done(pastie.id)
+            except pystemon.RetryLater as e:
+                if not pystemon.retry_scheduler.schedule(pastie, self.retry_queues[site.name], e.kind):
+                    site.done(pastie.id, downloaded=False)
+            # catch unknown errors
+            except Exception as e:
+                site.done(pastie.id, downloaded=False)
+                logger.error("Downloader for {name} crashed unexpectectly, recovering...: {e}".format(name=site.name, e=e))
+                logger.debug(traceback.format_exc())
+            finally:
+                queue.task_done()
+
+
+def run(sites):
+    ''' Run the async engine for the PastieSite objects until SIGINT or SIGTERM, and the queued downloads are done. '''
+    asyncio.run(AsyncEngine(sites).run())
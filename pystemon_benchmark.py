@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+Benchmark of pystemon against a local paste site simulator, so the throughput
+can be measured (and compared between releases) without touching a real site.
+
+The simulator publishes pasties at a given rate on an archive page in the
+format of pastebin.com, and serves their raw content with a configurable size,
+latency and rate of 404, 502 and 403 "slow down" errors. The real pipeline of
+pystemon.py (PastieSite, download threads or the async engine, download_url,
+the retry scheduler and the search engine) downloads and searches them with a
+synthetic set of search rules.
+
+Reported: pasties per second, the p50/p99 latency between the publication of a
+pastie and the end of its processing, and the memory use of the process.
+
+Example:
+  python pystemon_benchmark.py --pasties 2000 --rate 200 --size 2000-20000 --latency 0.02 --error-502 0.02
+
+@author:     Christophe Vandeplas <christophe@vandeplas.com>
+@copyright:  AGPLv3
+             http://www.gnu.org/licenses/agpl.html
+'''
+
+import json
+import logging
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import pystemon
+
+words = [b'the', b'paste', b'config', b'user', b'server', b'host', b'port', b'key', b'value', b'lorem',
+         b'ipsum', b'dolor', b'sit', b'amet', b'function', b'return', b'import', b'print', b'data', b'error']
+
+
+class PasteSiteSimulator(object):
+    '''
+    A simulated paste site. Pasties are published at rate per second (all at
+    once if rate is 0), the archive page lists the archive_size most recent
+    ones. The ids of the pasties start with the prefix letter of the site.
+    '''
+    def __init__(self, prefix, pasties, rate, sizes, latency, errors, hit_rate, rules, archive_size=50, seed=42):
+        self.prefix = prefix
+        self.pasties = pasties
+        self.rate = rate
+        self.latency = latency
+        self.errors = errors  # (404 rate, 502 rate, slow down rate)
+        self.archive_size = archive_size
+        self.start = None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.published = {}  # pastie id -> time of publication
+        self.requests = 0
+        self.errors_sent = 0
+        # a pool of bodies, so no time is spent generating content while serving
+        self.bodies = []
+        for i in range(64):
+            size = self.random.randint(*sizes)
+            body = []
+            length = 0
+            while length < size:
+                word = self.random.choice(words)
+                body.append(word)
+                length += len(word) + 1
+            self.bodies.append(b' '.join(body)[:size])
+        self.hits = set(i for i in range(pasties) if self.random.random() < hit_rate)
+        self.rules = rules
+
+    def pastie_id(self, number):
+        return '{0}{1:07d}'.format(self.prefix, number)
+
+    def content(self, pastie_id):
+        number = int(pastie_id[1:])
+        body = self.bodies[number % len(self.bodies)]
+        if number in self.hits:
+            body = body + '\ntoken{0:04d}-{1:08x}\n'.format(number % self.rules, number).encode('ascii')
+        return body
+
+    def archive(self):
+        now = time.time()
+        if self.start is None:
+            self.start = now
+        if self.rate:
+            count = min(self.pasties, int((now - self.start) * self.rate) + 1)
+        else:
+            count = self.pasties
+        with self.lock:
+            for number in range(len(self.published), count):
+                self.published[self.pastie_id(number)] = now
+        numbers = range(count - 1, max(count - self.archive_size, 0) - 1, -1)
+        return ''.join('<tr><td><a href="/{0}">Untitled</a></td>\n'.format(self.pastie_id(number)) for number in numbers).encode('ascii')
+
+    def error(self):
+        ''' Return the status code and body of an error to send, or None. '''
+        roll = self.random.random()
+        if roll < self.errors[0]:
+            return 404, b'Not found'
+        roll -= self.errors[0]
+        if roll < self.errors[1]:
+            return 502, b'Bad gateway'
+        roll -= self.errors[1]
+        if roll < self.errors[2]:
+            return 403, b'Please slow down'
+        return None
+
+    def published_count(self):
+        with self.lock:
+            return len(self.published)
+
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status = 200
+        if self.path.startswith('/archive/'):
+            body = self.server.simulators[self.path[9:]].archive()
+        elif self.path.startswith('/raw/'):
+            simulator = self.server.simulators[self.path[5]]
+            if simulator.latency:
+                time.sleep(simulator.latency)
+            with simulator.lock:
+                simulator.requests += 1
+                error = simulator.error()
+            if error:
+                status, body = error
+                with simulator.lock:
+                    simulator.errors_sent += 1
+            else:
+                body = simulator.content(self.path[5:])
+        else:
+            status, body = 404, b'Not found'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SimulatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BenchmarkPastie(pystemon.Pastie):
+    ''' Pastie that records when its processing ended. '''
+    done = {}  # pastie id -> end of the processing
+    done_lock = threading.Lock()
+
+    def process_pastie(self):
+        try:
+            return pystemon.Pastie.process_pastie(self)
+        finally:
+            with self.done_lock:
+                self.done[self.id] = time.time()
+
+
+def synthetic_rules(count):
+    ''' A few realistic search rules, completed with token rules up to count rules. '''
+    rules = [{'search': r'-----BEGIN (RSA|EC|OPENSSH) PRIVATE KEY-----', 'description': 'private key'},
+             {'search': r'password\s*[=:]\s*\S{6,}', 'description': 'password'},
+             {'search': r'[a-z0-9._%+-]+@example\.(com|org)', 'description': 'email'}]
+    for i in range(max(count - len(rules), 1)):
+        rules.append({'search': r'token{0:04d}-[0-9a-f]{{8}}'.format(i), 'description': 'token {0}'.format(i)})
+    return rules
+
+
+def site_prefix(number):
+    return chr(ord('a') + number)
+
+
+def build_config(options, port, directory):
+    sites = {}
+    for i in range(options.sites):
+        sites['simulator{0}'.format(i)] = {
+            'enable': True,
+            'archive-url': 'http://127.0.0.1:{0}/archive/{1}'.format(port, site_prefix(i)),
+            'archive-regex': r'<a href="/(\w{8})">.+</a></td>',
+            'download-url': 'http://127.0.0.1:{0}/raw/{{id}}'.format(port),
+            'update-min': 1,
+            'update-max': 1,
+            'pastie-classname': 'BenchmarkPastie',
+        }
+    return {
+        'archive': {'save': options.save, 'save-all': options.save, 'compress': True,
+                    'dir': os.path.join(directory, 'alerts'), 'dir-all': os.path.join(directory, 'archive')},
+        'seen': {'max': 1000000},
+        'db': {'sqlite3': {'enable': False}},
+        'redis': {'queue': False},
+        'email': {'alert': False},
+        'proxy': {'random': False},
+        'user-agent': {'random': False},
+        'search': synthetic_rules(options.rules),
+        'threads': options.threads,
+        'engine': options.engine,
+        'retry': {'delay': options.retry_delay, 'max-delay': options.retry_delay * 8},
+        'matching': {'processes': options.processes},
+        'site': sites,
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def memory_usage():
+    ''' Return the current and the peak resident memory of the process, in MB. '''
+    current = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    peak = None
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 1024.0 / 1024.0 if sys.platform == 'darwin' else peak / 1024.0
+    return current, peak
+
+
+def start_pipeline(sites):
+    ''' Start the download threads and site threads as pystemon.main() does. '''
+    pystemon.retry_scheduler = pystemon.RetryScheduler()
+    pystemon.retry_scheduler.daemon = True
+    pystemon.retry_scheduler.start()
+    if pystemon.yamlconfig['engine'] == 'async':
+        import pystemon_async
+        thread = threading.Thread(target=pystemon_async.run, args=(sites,))
+        thread.daemon = True
+        thread.start()
+        return
+    for site in sites:
+        pystemon.queues[site.name] = site.make_queue()
+        for i in range(site.threads):
+            t = pystemon.ThreadPasties(pystemon.queues[site.name], site.name)
+            t.daemon = True
+            t.start()
+    for site in sites:
+        site.daemon = True
+        site.start()
+
+
+def run_benchmark(options):
+    sizes = [int(size) for size in options.size.split('-')]
+    # the sites are polled every second, the archive page holds the pasties of a few seconds
+    archive_size = max(50, int(options.rate * 3)) if options.rate else options.pasties
+    simulators = {}
+    for i in range(options.sites):
+        simulators[site_prefix(i)] = PasteSiteSimulator(site_prefix(i), options.pasties, options.rate, (sizes[0], sizes[-1]), options.latency,
+                                                        (options.error_404, options.error_502, options.slowdown),
+                                                        options.hit_rate, max(options.rules - 3, 1), archive_size, seed=42 + i)
+    server = SimulatorServer(('127.0.0.1', 0), SimulatorRequestHandler)
+    server.simulators = simulators
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    directory = tempfile.mkdtemp(prefix='pystemon-benchmark-')
+    pystemon.logger = logging.getLogger('pystemon')
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s'))
+    pystemon.logger.addHandler(handler)
+    pystemon.logger.setLevel(logging.DEBUG if options.verbose else logging.ERROR)
+    pystemon.yamlconfig = build_config(options, server.server_address[1], directory)
+    pystemon.BenchmarkPastie = BenchmarkPastie  # pastie-classname is looked up in the pystemon module
+    pystemon.deduplicator = None
+    pystemon.db = None
+    pystemon.redis_publisher = None
+    pystemon.email_dispatcher = None
+    pystemon.queues = {}
+    if options.processes:
+        pystemon.search_engine = pystemon.SearchPool(pystemon.yamlconfig['search'], options.processes)
+    else:
+        pystemon.search_engine = pystemon.SearchEngine(pystemon.yamlconfig['search'])
+    sites = [pystemon.create_pastie_site(name) for name in sorted(pystemon.yamlconfig['site'])]
+
+    start = time.time()
+    start_pipeline(sites)
+    expected = options.pasties * options.sites
+    try:
+        while time.time() - start < options.duration:
+            time.sleep(0.2)
+            gave_up = sum(pystemon.retry_scheduler.gave_up.values())
+            if len(BenchmarkPastie.done) + gave_up >= expected:
+                break
+    finally:
+        server.shutdown()
+        if options.processes:
+            pystemon.search_engine.pool.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    done = dict(BenchmarkPastie.done)
+    elapsed = (max(done.values()) if done else time.time()) - start
+    published = {}
+    for simulator in simulators.values():
+        published.update(simulator.published)
+    latencies = [end - published[pastie_id] for pastie_id, end in done.items() if pastie_id in published]
+    gave_up = sum(pystemon.retry_scheduler.gave_up.values())
+    current_rss, peak_rss = memory_usage()
+    rule_seconds = sum(entry[3] for entry in pystemon.search_engine.rule_stats())
+    return {
+        'pasties': expected,
+        'processed': len(done),
+        'gave_up': gave_up,
+        'missed': len(published) - len(done) - gave_up,
+        'retries': sum(pystemon.retry_scheduler.retries.values()),
+        'requests': sum(simulator.requests for simulator in simulators.values()),
+        'errors': sum(simulator.errors_sent for simulator in simulators.values()),
+        'seconds': round(elapsed, 3),
+        'pasties_per_second': round(len(done) / elapsed, 1) if elapsed > 0 else 0,
+        'latency_p50': round(percentile(latencies, 0.5), 4),
+        'latency_p99': round(percentile(latencies, 0.99), 4),
+        'search_seconds': round(rule_seconds, 3),
+        'rss_mb': round(current_rss, 1) if current_rss else None,
+        'peak_rss_mb': round(peak_rss, 1) if peak_rss else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("--pasties", type="int", default=1000, help="number of pasties per site (default: %default)")
+    parser.add_option("--sites", type="int", default=1, help="number of simulated sites (default: %default)")
+    parser.add_option("--rate", type="float", default=200, help="pasties published per second, 0 for all at once (default: %default)")
+    parser.add_option("--size", default="1000-10000", help="size of the pasties in bytes, or a range MIN-MAX (default: %default)")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds before the simulator answers a download (default: %default)")
+    parser.add_option("--error-404", type="float", default=0.0, help="fraction of the downloads answered with 404 (default: %default)")
+    parser.add_option("--error-502", type="float", default=0.0, help="fraction of the downloads answered with 502 (default: %default)")
+    parser.add_option("--slowdown", type="float", default=0.0,
+                      help="fraction of the downloads answered with 403 slow down, these are retried after at least a minute (default: %default)")
+    parser.add_option("--rules", type="int", default=50, help="number of search rules (default: %default)")
+    parser.add_option("--hit-rate", type="float", default=0.05, help="fraction of the pasties that match a rule (default: %default)")
+    parser.add_option("--threads", type="int", default=4, help="download threads per site (default: %default)")
+    parser.add_option("--processes", type="int", default=0, help="search processes, see matching/processes (default: %default)")
+    parser.add_option("--engine", default="threads", help="threads or async (default: %default)")
+    parser.add_option("--retry-delay", type="float", default=0.5, help="seconds before the first retry (default: %default)")
+    parser.add_option("--save", action="store_true", default=False, help="also save the pasties in a temporary archive")
+    parser.add_option("--duration", type="float", default=300, help="maximum number of seconds to run (default: %default)")
+    parser.add_option("--json", action="store_true", dest="json", help="print the results as JSON")
+    parser.add_option("-v", action="store_true", dest="verbose", help="show the log of pystemon")
+    (options, args) = parser.parse_args()
+
+    results = run_benchmark(options)
+    if options.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        print('Processed {processed}/{pasties} pasties in {seconds} seconds: {pasties_per_second} pasties/s'.format(**results))
+        print('Latency from publication to processed: p50 {latency_p50}s p99 {latency_p99}s'.format(**results))
+        print('Downloads: {requests} requests, {errors} errors, {retries} retries, {gave_up} given up, {missed} not processed'.format(**results))
+        print('Search: {search_seconds} seconds in the regular expressions'.format(**results))
+        print('Memory: {rss_mb} MB resident, {peak_rss_mb} MB peak'.format(**results))
+    sys.stdout.flush()
+    # the threads of pystemon keep waiting on their queues, do not wait for them
+    os._exit(0)
@@ -0,0 +1,23 @@
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pystemon  # noqa: E402
+
+# the logger is set up by the command line part of pystemon.py
+pystemon.logger = logging.getLogger('pystemon')
+
+
+@pytest.fixture
+def make_site(tmp_path, monkeypatch):
+    ''' Return a function that builds a PastieSite with a minimal configuration. '''
+    monkeypatch.setattr(pystemon, 'yamlconfig', {
+        'archive': {'dir': str(tmp_path / 'alerts'), 'dir-all': str(tmp_path / 'archive'),
+                    'save': False, 'save-all': False, 'compress': False},
+        'threads': 1,
+    }, raising=False)
+    return lambda name='site': pystemon.PastieSite(name, 'http://{0}/{{id}}'.format(name), None, None)
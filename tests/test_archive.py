@@ -0,0 +1,122 @@
+import gzip
+import os
+
+import pystemon
+
+from pystemon import ArchiveSegmentReader, ArchiveSegmentWriter
+
+
+def test_write_and_read(tmp_path):
+    writer = ArchiveSegmentWriter(str(tmp_path), 'gzip')
+    locations = []
+    writer.append('a', b'first pastie', locations.append)
+    writer.append('b/c', b'second pastie', locations.append)
+    assert locations == []  # not committed yet
+    writer.commit()
+    assert len(locations) == 2
+    reader = ArchiveSegmentReader(str(tmp_path))
+    assert reader.get('a') == b'first pastie'
+    assert reader.get('b/c') == b'second pastie'
+    assert reader.get('missing') is None
+    segment_path = reader.segments()[0]
+    assert segment_path.endswith('.seg.gz')
+    # every pastie is a standalone gzip member, the segment reads like one gzip file
+    with gzip.open(segment_path, 'rb') as f:
+        assert f.read() == b'first pastiesecond pastie'
+    assert list(reader.iter_pasties(segment_path)) == [('a', b'first pastie'), ('b/c', b'second pastie')]
+
+
+def test_reader_sees_later_pasties(tmp_path):
+    writer = ArchiveSegmentWriter(str(tmp_path), None, segment_size=30)
+    writer.append('a', b'x' * 20)
+    writer.commit()
+    reader = ArchiveSegmentReader(str(tmp_path))
+    assert reader.get('a') == b'x' * 20
+    assert reader.get('b') is None
+    # appended to the same segment
+    writer.append('b', b'y' * 20)
+    writer.commit()
+    assert reader.get('b') == b'y' * 20
+    # the segment is full, a new one is started
+    writer.append('c', b'z' * 20)
+    writer.commit()
+    assert len(reader.segments()) == 2
+    assert reader.get('c') == b'z' * 20
+    assert reader.get('a') == b'x' * 20
+
+
+def test_unfinished_index_entries(tmp_path):
+    writer = ArchiveSegmentWriter(str(tmp_path), None)
+    writer.append('a', b'content')
+    writer.commit()
+    segment_path = writer.segment_path
+    # an entry whose content is not written yet, and a line that is still being written
+    with open(segment_path + '.idx', 'ab') as f:
+        f.write(b'b\t7\t5\t0\n')
+        f.write(b'c\t12\t')
+    reader = ArchiveSegmentReader(str(tmp_path))
+    assert reader.get('b') is None
+    assert list(reader.read_index(segment_path)) == [('a', 0, 7)]
+    with open(segment_path, 'ab') as f:
+        f.write(b'later')
+    assert reader.get('b') == b'later'
+    assert os.path.getsize(segment_path) == 12
+
+
+def test_rescan_unit(tmp_path, monkeypatch):
+    monkeypatch.setattr(pystemon, 'search_engine', pystemon.SearchEngine([{'search': 'secret'}]), raising=False)
+    with gzip.open(str(tmp_path / 'abc.gz'), 'wb') as f:
+        f.write(b'a secret')
+    count, hits, complete = pystemon.rescan_unit(('site', 'file', str(tmp_path / 'abc.gz')))
+    assert (count, complete) == (1, True)
+    assert [(hit[1], hit[4]) for hit in hits] == [('abc', [0])]
+    # a unit that cannot be read is reported, so the rescan checkpoint is not written
+    (tmp_path / 'broken.gz').write_bytes(b'not gzip')
+    count, hits, complete = pystemon.rescan_unit(('site', 'file', str(tmp_path / 'broken.gz')))
+    assert (count, hits, complete) == (0, [], False)
+
+
+def test_rollover_publishes_the_closed_segment(tmp_path):
+    writer = ArchiveSegmentWriter(str(tmp_path), None, segment_size=30)
+    locations = []
+    writer.append('a', b'x' * 40, locations.append)
+    first_segment = writer.segment_path
+    # the segment is full, 'a' is committed when the next one is started
+    writer.append('b', b'y' * 40, locations.append)
+    assert locations == [(first_segment, 0, 40)]
+    writer.commit()
+    assert locations == [(first_segment, 0, 40), (writer.segment_path, 0, 40)]
+    assert writer.segment_path != first_segment
+
+
+def test_new_segment_every_day(tmp_path, monkeypatch):
+    writer = ArchiveSegmentWriter(str(tmp_path), None)
+    writer.append('a', b'content')
+    monkeypatch.setattr(pystemon, 'day_directory', lambda directory: directory + os.sep + 'tomorrow')
+    writer.append('b', b'content')
+    assert os.path.dirname(writer.segment_path) == str(tmp_path / 'tomorrow')
+
+
+def test_rescan_file_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(pystemon, 'search_engine', pystemon.SearchEngine([{'search': 'secret'}, {'search': '^last line$', 'regex-flags': 're.MULTILINE'}]), raising=False)
+    path = str(tmp_path / 'big.gz')
+    with gzip.open(path, 'wb') as f:
+        f.write(b'x' * 100000 + b' a secret \n' + b'y' * 100000 + b'\nlast line')
+    content, indexes = pystemon.rescan_file(path, chunk_size=1000)
+    assert indexes == [0, 1]
+    assert content.endswith(b'last line')
+    # only streamed rules: the file is read again for the hit
+    monkeypatch.setattr(pystemon, 'search_engine', pystemon.SearchEngine([{'search': 'secret'}]))
+    content, indexes = pystemon.rescan_file(path, chunk_size=1000)
+    assert indexes == [0]
+    assert len(content) == 200021
+
+
+def test_iter_archive(tmp_path):
+    writer = ArchiveSegmentWriter(str(tmp_path / 'site'), 'gzip')
+    writer.append('a', b'content')
+    writer.commit()
+    (tmp_path / 'site' / 'my.segment.gz').write_bytes(b'')
+    units = [(site, kind, os.path.basename(path)) for site, kind, path in pystemon.iter_archive(str(tmp_path))]
+    assert sorted(kind for site, kind, name in units) == ['file', 'segment']
+    assert ('site', 'file', 'my.segment.gz') in units
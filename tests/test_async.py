@@ -0,0 +1,71 @@
+import asyncio
+import threading
+from queue import Full
+
+import pytest
+
+import pystemon
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web  # noqa: E402
+
+import pystemon_async  # noqa: E402
+
+
+def test_retry_queue_from_another_thread():
+    async def scenario():
+        queue = pystemon_async.DownloadQueue()
+        retry_queue = pystemon_async.RetryQueue(queue, asyncio.get_running_loop())
+        thread = threading.Thread(target=retry_queue.put, args=('pastie',), kwargs={'block': False})
+        thread.start()
+        thread.join()
+        return await asyncio.wait_for(queue.get(), 5), retry_queue
+
+    item, retry_queue = asyncio.run(scenario())
+    assert item == 'pastie'
+    # the engine stopped, the scheduler keeps the pastie
+    with pytest.raises(Full):
+        retry_queue.put('pastie', block=False)
+
+
+def test_streamed_download(monkeypatch):
+    monkeypatch.setattr(pystemon, 'user_agents_list', None, raising=False)
+    monkeypatch.setattr(pystemon, 'deduplicator', None, raising=False)
+    engine = pystemon.SearchEngine([{'search': 'secret'}, {'search': 'secret$'}])
+    content = b'x' * 5000 + b' a secret ' + b'y' * 5000 + b' secret'
+
+    async def handler(request):
+        return web.Response(body=content)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/pastie', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        server = web.TCPSite(runner, '127.0.0.1', 0)
+        await server.start()
+        port = runner.addresses[0][1]
+        async_engine = pystemon_async.AsyncEngine([])
+        hasher = pystemon.new_content_hasher()
+        matcher = engine.stream()
+        chunks = []
+        feed = async_engine.stream_feed(hasher, matcher)
+
+        async def counting_feed(chunk):
+            chunks.append(chunk)
+            await feed(chunk)
+        try:
+            async with aiohttp.ClientSession() as async_engine.session:
+                body = await async_engine.download_url('http://127.0.0.1:{0}/pastie'.format(port), feed=counting_feed, chunk_size=1000)
+        finally:
+            await runner.cleanup()
+        return body, chunks, hasher, matcher
+
+    body, chunks, hasher, matcher = asyncio.run(scenario())
+    assert body == content
+    assert len(chunks) > 1 and max(len(chunk) for chunk in chunks) <= 1000
+    expected = pystemon.new_content_hasher()
+    expected.update(content)
+    assert hasher.hexdigest() == expected.hexdigest()
+    # the anchored rule is matched on the whole content
+    assert matcher.search_indexes(body) == [0, 1]
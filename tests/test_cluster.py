@@ -0,0 +1,95 @@
+import pytest
+
+import pystemon
+from pystemon import Cluster
+
+
+@pytest.fixture(autouse=True)
+def local_store(monkeypatch):
+    monkeypatch.setattr(pystemon, 'local_stores', {})
+
+
+class Site(object):
+    def __init__(self, name):
+        self.name = name
+        self.update_max = 30
+
+
+def make_cluster(node, sites):
+    return Cluster({'backend': 'local', 'node': node}, sites)
+
+
+def test_local_nodes_share_the_store():
+    first = make_cluster('first', [])
+    second = make_cluster('second', [])
+    assert second.live_nodes == 2
+    assert first.claim('site', '1')
+    assert not second.claim('site', '1')
+    first.release('site', '1')
+    assert second.claim('site', '1')
+    # another prefix is another cluster
+    other = Cluster({'backend': 'local', 'node': 'other', 'prefix': 'other'}, [])
+    assert other.live_nodes == 1
+    assert other.claim('site', '1')
+
+
+def test_leases_fair_share():
+    sites = [Site('a'), Site('b')]
+    first = make_cluster('first', sites)
+    assert [first.should_poll(site) for site in sites] == [True, True]
+    second = make_cluster('second', sites)
+    first.live_nodes = second.live_nodes = 2
+    # the second node gets nothing while the first holds both leases
+    assert [second.should_poll(site) for site in sites] == [False, False]
+    # the first gives one site away at its next poll
+    assert first.should_poll(sites[0]) is False
+    assert first.should_poll(sites[1]) is True
+    assert [second.should_poll(site) for site in sites] == [True, False]
+    second.leave()
+    first.live_nodes = 1
+    assert first.should_poll(sites[0]) is True
+
+
+def test_dropped_pastie_is_released(make_site, monkeypatch):
+    site = make_site()
+    node = make_cluster('first', [site])
+    other = make_cluster('second', [site])
+    monkeypatch.setattr(pystemon, 'cluster', node)
+    site.queue_config = {'size': 1, 'policy': 'drop-oldest'}
+    queue = site.make_queue()
+    pasties = site.queue_listing([('2', {}), ('1', {})])
+    assert [pastie.id for pastie in pasties] == ['2', '1']
+    assert not other.claim('site', '1')
+    for pastie in reversed(pasties):
+        queue.put(pastie)
+    # pastie 1 is dropped, another node can download it
+    assert site.pending == set(['2'])
+    assert other.claim('site', '1')
+    assert not other.claim('site', '2')
+    # a downloaded pastie stays claimed
+    site.done('2')
+    assert not other.claim('site', '2')
+
+
+def test_shutdown_releases_pending(make_site, monkeypatch):
+    site = make_site()
+    node = make_cluster('first', [site])
+    other = make_cluster('second', [site])
+    monkeypatch.setattr(pystemon, 'cluster', node)
+    site.queue_listing([('1', {})])
+    pystemon.release_pending([site])
+    assert other.claim('site', '1')
+
+
+def test_pastie_claimed_elsewhere_is_not_seen(make_site, monkeypatch):
+    site = make_site()
+    site.incremental = False
+    node = make_cluster('first', [site])
+    other = make_cluster('second', [site])
+    monkeypatch.setattr(pystemon, 'cluster', node)
+    assert other.claim('site', '1')
+    assert site.queue_listing([('1', {})]) == []
+    assert not site.seen_pastie('1')
+    # the other node gives up, this one downloads it at its next poll
+    other.release('site', '1')
+    assert [pastie.id for pastie in site.queue_listing([('1', {})])] == ['1']
@@ -0,0 +1,53 @@
+from pystemon import DownloadJournal
+
+
+def test_replay_after_restart(tmp_path):
+    filename = str(tmp_path / 'site.journal')
+    journal = DownloadJournal(filename, batch_size=100)
+    for pastie_id in ('1', '2', '3'):
+        journal.enqueue(pastie_id)
+    journal.ack('2')
+    journal.ack('unknown')
+    journal.commit()
+    assert DownloadJournal(filename).replay() == ['1', '3']
+
+
+def test_torn_record(tmp_path):
+    filename = str(tmp_path / 'site.journal')
+    journal = DownloadJournal(filename)
+    journal.enqueue('1')
+    journal.enqueue('2')
+    journal.commit()
+    # a crash while the acknowledgement of 1 was written
+    with open(filename, 'ab') as f:
+        f.write(b'A "1')
+    assert DownloadJournal(filename).replay() == ['1', '2']
+
+
+def test_compacted_at_startup(tmp_path):
+    filename = str(tmp_path / 'site.journal')
+    journal = DownloadJournal(filename)
+    for pastie_id in range(10):
+        journal.enqueue(str(pastie_id))
+        if pastie_id != 5:
+            journal.ack(str(pastie_id))
+    journal.commit()
+    journal = DownloadJournal(filename)
+    assert journal.replay() == ['5']
+    with open(filename, 'rb') as f:
+        assert f.read() == b'E "5"\n'
+
+
+def test_site_replay(make_site, tmp_path):
+    site = make_site()
+    site.journal = DownloadJournal(str(tmp_path / 'site.journal'))
+    site.queue_listing([('3', {}), ('2', {}), ('1', {})])
+    site.done('2')
+    site.journal.commit()
+    # after a restart, the pasties seen in between are not queued again
+    site = make_site()
+    site.journal = DownloadJournal(str(tmp_path / 'site.journal'))
+    site.seen_pasties.add('3')
+    assert [pastie.id for pastie in site.replay_journal()] == ['1']
+    assert site.pending == set(['1'])
+    assert site.journal.replay() == ['1']
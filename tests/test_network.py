@@ -0,0 +1,38 @@
+import pystemon
+
+
+def test_session_pool_fits_the_threads_of_the_site(monkeypatch):
+    monkeypatch.setattr(pystemon, 'yamlconfig', {'threads': 2}, raising=False)
+    monkeypatch.setattr(pystemon, 'sessions', {})
+    session = pystemon.get_session('http://busy/1', None, threads=10)
+    assert session.get_adapter('http://busy/1')._pool_maxsize == 11
+    assert pystemon.get_session('http://busy/2', None) is session
+    session = pystemon.get_session('http://quiet/1', 'http://proxy:3128')
+    assert session.get_adapter('https://quiet/1')._pool_maxsize == 3
+    assert session.proxies == {'http': 'http://proxy:3128', 'https': 'http://proxy:3128'}
+
+
+def test_random_set():
+    items = pystemon.RandomSet('abcd')
+    items.remove('a')
+    items.remove('d')
+    assert len(items) == 2
+    assert 'a' not in items and 'b' in items
+    assert set(items.choice() for _ in range(50)) == set('bc')
+
+
+def test_proxy_taken_out_and_back(tmp_path, monkeypatch):
+    proxy_file = tmp_path / 'proxies.txt'
+    proxy_file.write_text(u'http://a:1\nhttp://b:1\n')
+    pool = pystemon.ProxyPool()
+    pool.configure({'file': str(proxy_file), 'failures': 1, 'recovery': 10})
+    pool.failure('http://a:1')
+    assert pool.counts() == (1, 1)
+    assert set(pool.choose() for _ in range(20)) == set(['http://b:1'])
+    pool.failure('http://b:1')
+    # all proxies are out, the one that comes back first is used
+    assert pool.choose() == 'http://a:1'
+    now = pystemon.time.time()
+    monkeypatch.setattr(pystemon.time, 'time', lambda: now + 11)
+    assert pool.choose() in ('http://a:1', 'http://b:1')
+    assert pool.counts() == (2, 0)
@@ -0,0 +1,86 @@
+from queue import Empty
+
+import pytest
+
+import pystemon
+from pystemon import BoundedQueue
+
+
+def drain(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            return items
+        queue.task_done()
+
+
+def test_block():
+    queue = BoundedQueue('test', 2)
+    queue.put(1)
+    queue.put(2)
+    with pytest.raises(Exception):
+        queue.put(3, timeout=0.01)
+    assert drain(queue) == [1, 2]
+
+
+def test_drop_oldest():
+    dropped = []
+    queue = BoundedQueue('test', 2, 'drop-oldest', on_drop=dropped.append)
+    for item in range(5):
+        queue.put(item)
+    assert dropped == [0, 1, 2]
+    assert queue.dropped == 3
+    assert drain(queue) == [3, 4]
+    assert queue.unfinished_tasks == 0
+
+
+def test_spill_keeps_order(tmp_path):
+    queue = BoundedQueue('test', 2, 'spill', str(tmp_path), encode=str, decode=int)
+    for item in range(6):
+        queue.put(item)
+    assert queue.spilled == 4
+    assert queue.depth() == 6
+    assert queue.get() == 0
+    queue.put(6)  # the spilled items go first
+    assert drain(queue) == [1, 2, 3, 4, 5, 6]
+    assert queue.unfinished_tasks == 1
+    # everything was read back, the spill file is emptied
+    assert (tmp_path / 'test.spill').read_bytes() == b''
+
+
+def test_spill_restart(tmp_path):
+    queue = BoundedQueue('test', 1, 'spill', str(tmp_path), encode=str, decode=int)
+    for item in range(5):
+        queue.put(item)
+    assert [queue.get() for _ in range(3)] == [0, 1, 2]
+    # the items taken out do not come back, item 3 was read back in memory but not taken out
+    queue = BoundedQueue('test', 1, 'spill', str(tmp_path), encode=str, decode=int)
+    assert queue.depth() == 2
+    assert drain(queue) == [3, 4]
+    queue.put(5)
+    queue.put(6)
+    # item 5 never spilled, it is lost like the items of a queue in memory
+    queue = BoundedQueue('test', 1, 'spill', str(tmp_path), encode=str, decode=int)
+    assert drain(queue) == [6]
+
+
+def test_spilled_pastie_keeps_its_state(make_site, tmp_path):
+    site = make_site()
+    site.queue_config = {'size': 1, 'policy': 'spill'}
+    pystemon.yamlconfig['queues'] = {'spill-dir': str(tmp_path / 'spill')}
+    queue = site.make_queue()
+    first = site.make_pastie('1')
+    second = site.make_pastie('2', {'title': 'hello'})
+    second.retries = {'server': 2}
+    second.pastie_content = b'\x00bulk content'
+    queue.put(first)
+    queue.put(second)
+    assert queue.spilled == 1
+    assert queue.get() is first
+    pastie = queue.get()
+    assert pastie is not second
+    assert (pastie.id, pastie.metadata, pastie.retries, pastie.pastie_content) == ('2', {'title': 'hello'}, {'server': 2}, b'\x00bulk content')
+    # a line spilled by an older version only has the id
+    assert site.decode_pastie('3').id == '3'
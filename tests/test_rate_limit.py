@@ -0,0 +1,53 @@
+import pytest
+
+from pystemon import RateLimiter, TokenBucket
+
+
+def test_token_bucket_burst():
+    bucket = TokenBucket(2, 3)
+    now = bucket.last
+    assert [bucket.reserve(now) for _ in range(3)] == [0, 0, 0]
+    # the next requests reserve a token in advance, in order
+    assert bucket.reserve(now) == pytest.approx(0.5)
+    assert bucket.reserve(now) == pytest.approx(1.0)
+    assert bucket.reserve(now + 1.0) == pytest.approx(0.5)
+
+
+def test_no_limit():
+    limiter = RateLimiter('site', {})
+    assert limiter.reserve() == 0
+    limiter.slowdown()
+    limiter.success()
+    assert limiter.rates() == {}
+
+
+def test_slowdown_and_recovery():
+    limiter = RateLimiter('site', {'rate': 10, 'decrease': 0.5, 'min-rate': 1})
+    limiter.reserve()
+    limiter.slowdown()
+    assert limiter.rates() == {None: 5.0}
+    assert limiter.slowdowns == 1
+    for _ in range(10):
+        limiter.success()
+    assert 5.0 < limiter.rates()[None] < 10
+    # additive increase brings the rate back up to the configured rate, and not above
+    for _ in range(10000):
+        limiter.success()
+    assert limiter.rates() == {None: 10.0}
+
+
+def test_min_and_max_rate():
+    limiter = RateLimiter('site', {'rate': 2, 'max-rate': 4, 'min-rate': 1, 'decrease': 0.1})
+    limiter.slowdown()
+    assert limiter.rates() == {None: 1}
+    for _ in range(10000):
+        limiter.success()
+    assert limiter.rates() == {None: 4}
+
+
+def test_per_proxy():
+    limiter = RateLimiter('site', {'rate': 10, 'per-proxy': True})
+    limiter.reserve('http://a')
+    limiter.reserve('http://b')
+    limiter.slowdown('http://a')
+    assert limiter.rates() == {'http://a': 5.0, 'http://b': 10.0}
@@ -0,0 +1,31 @@
+import multiprocessing
+import os
+import signal
+import time
+
+import pystemon
+
+
+def test_search_pool_survives_sigterm():
+    pool = pystemon.SearchPool([{'search': 'password'}], 1)
+    try:
+        assert pool.search(b'password') == [{'search': 'password'}]
+        # like the SIGTERM systemd sends to the whole process group
+        for process in multiprocessing.active_children():
+            os.kill(process.pid, signal.SIGTERM)
+        time.sleep(0.5)
+        assert all(process.is_alive() for process in multiprocessing.active_children())
+        assert pool.search(b'password') == [{'search': 'password'}]
+    finally:
+        pool.stop(time.time())
+    assert not multiprocessing.active_children()
+
+
+def test_stop_pool_kills_busy_processes():
+    pool = pystemon.SearchPool([{'search': 'password'}], 1)
+    pool.pool.apply_async(time.sleep, (60,))
+    time.sleep(0.2)
+    start = time.time()
+    pool.stop(time.time() + 1)
+    assert time.time() - start < 10
+    assert not multiprocessing.active_children()
@@ -0,0 +1,12 @@
+import pystemon
+
+
+def test_rules_with_the_same_description(monkeypatch):
+    engine = pystemon.SearchEngine([{'search': 'a', 'description': 'same'}, {'search': 'b', 'description': 'same'}])
+    engine.search_indexes(b'a')
+    monkeypatch.setattr(pystemon, 'search_engine', engine, raising=False)
+    monkeypatch.setattr(pystemon, 'retry_scheduler', None, raising=False)
+    monkeypatch.setattr(pystemon, 'queue_stats', dict)
+    lines = pystemon.Stats().render().splitlines()
+    assert 'pystemon_rule_hits_total{rule="same",index="0"} 1' in lines
+    assert 'pystemon_rule_hits_total{rule="same",index="1"} 0' in lines
@@ -0,0 +1,54 @@
+import pytest
+
+from pystemon import SearchEngine
+
+
+def stream_search(engine, content, chunk_size, overlap=16):
+    stream = engine.stream(overlap)
+    for start in range(0, len(content), chunk_size):
+        stream.feed(content[start:start + chunk_size])
+    return stream.search(content)
+
+
+rules = [{'search': 'password'},
+         {'search': 'secret$'},
+         {'search': '^-----BEGIN'},
+         {'search': '\\btoken\\b'},
+         {'search': 'BEGIN.{0,10000}END', 'regex-flags': 're.DOTALL'},
+         {'search': 'key=[0-9]{4}', 'count': 2},
+         {'search': 'leak', 'exclude': 'no leak'},
+         {'search': 'api(?=_key)'}]
+
+
+@pytest.mark.parametrize('content', [
+    b'a password here',
+    b'the secret is out',
+    b'the secret',
+    b'xx-----BEGIN' + b' ' * 40,
+    b'tokens and tokenizer',
+    b'a token',
+    b'BEGIN' + b'x' * 100 + b'END',
+    b'key=1234 and key=5678',
+    b'key=1234' + b' ' * 50,
+    b'a leak' + b' ' * 50 + b'no leak',
+    b'my api_key',
+    b'',
+])
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64])
+def test_stream_same_as_whole(content, chunk_size):
+    engine = SearchEngine(rules)
+    assert stream_search(engine, content, chunk_size) == engine.search(content)
+
+
+def test_streamable():
+    engine = SearchEngine(rules)
+    assert [rule.streamable(16) for rule in engine.rules] == [True, False, False, False, False, True, True, False]
+    assert engine.rules[4].streamable(100000) is True
+
+
+def test_match_across_chunks():
+    engine = SearchEngine([{'search': 'password'}])
+    stream = engine.stream(16)
+    stream.feed(b'my pass')
+    stream.feed(b'word')
+    assert stream.search(b'my password') == [engine.rules[0].config]